@@ -0,0 +1,403 @@
+# Handler-level benchmarks for bot.py on synthetic marketplace states.
+#
+#   python bench.py                                   # 1k, 100k and 1M users, JSON store
+#   python bench.py --users 1000,100000 --backend json,binary,sqlite --iterations 500
+#   python bench.py --baseline old_bench_output.txt   # compare with an earlier run
+#
+# For every (backend, user count) a child process loads a copy of a generated data.json
+# (cached under --data-dir), drives the real handler coroutines with stub Update/Context/Bot
+# objects and measures latency percentiles, then repeats a few calls under tracemalloc for
+# allocations. Persistence is timed on its own: one journaled op and, for the JSON store, a
+# full snapshot. Backend "binary" is the JSON store with SNAPSHOT_FORMAT=binary (data.snap).
+# Each run appends one JSON line per dataset to --output (bench_output.txt).
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import os
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+import uuid
+from pathlib import Path
+HERE = Path(__file__).resolve().parent
+DEFAULT_USERS = "1000,100000,1000000"
+DEFAULT_ITERATIONS = 200
+ALLOC_ITERATIONS = 20 # Calls per handler repeated under tracemalloc
+SNAPSHOT_ITERATIONS = 3
+FIRST_UID = 1_000_000_000
+SEED = 1234
+# Share of users with each kind of pending item in the generated state
+PENDING_SHARE = 0.02 # submission waiting for review
+WAITING_BUYER_SHARE = 0.005 # approved, admin prompt for the buyer open
+WAITING_COUNT_SHARE = 0.002 # approved folder, admin prompt for the group count open
+PENDING_WITHDRAWAL_SHARE = 0.01
+MAX_GROUPS_PER_USER = 4 # Sold/closed groups in a user's history, uniform 0..max
+MAX_WITHDRAWALS_PER_USER = 2 # Closed withdrawals in a user's history, uniform 0..max
+# ========================
+# Synthetic data.json
+# ========================
+def iso(ts: float):
+    return datetime.datetime.utcfromtimestamp(ts).isoformat() + "Z"
+def generate_state(n_users: int):
+    # The snapshot layout JsonStore writes, built as plain JSON dicts
+    rng = random.Random(SEED)
+    start = time.time() - 2 * 86400
+    d = {
+        "users": {}, "submissions": {}, "submission_seq": 0, "withdrawals": {}, "withdrawal_seq": 0,
+        "pending_requests": {}, "sell_enabled": True, "global_prices": {"2016-22": "11$", "2023": "6$", "2024 (1-3)": "5$", "2024 (4)": "4$", "2024 (5-6)": "1$"},
+        "journal_seq": 0, "meta": {}, "outbox": {}, "links": {},
+    }
+    sold = withdrawn = approved = 0
+    prompt_id = 10 ** 9
+    def add_submission(uid, links, status, t, **extra):
+        d["submission_seq"] += 1
+        sub_id = str(d["submission_seq"])
+        d["submissions"][sub_id] = {"id": sub_id, "seller_id": uid, "links": links, "year": "2023", "type": "single", "time": t, "status": status, "ownership_status": "none", **extra}
+        for link in links:
+            d["links"][link] = {"owner": uid, "status": status}
+        return sub_id
+    for i in range(n_users):
+        uid = FIRST_UID + i
+        t = iso(start + rng.random() * 86400)
+        groups = [f"t.me/+g{i}x{j}" for j in range(rng.randint(0, MAX_GROUPS_PER_USER))]
+        for link in groups:
+            d["links"][link] = {"owner": uid, "status": "sold"}
+        wids = []
+        for _ in range(rng.randint(0, MAX_WITHDRAWALS_PER_USER)):
+            d["withdrawal_seq"] += 1
+            wid = str(d["withdrawal_seq"])
+            d["withdrawals"][wid] = {"id": wid, "uid": uid, "method": "upi", "address": f"user{i}@bank", "amount": 1.0, "status": "Approved", "time": t}
+            wids.append(wid)
+            approved += 1
+            withdrawn += 1.0
+        sold += len(groups)
+        user = {"balance": float(rng.randint(0, 50)), "sales": len(groups), "start_time": t, "groups": groups, "withdrawals": wids}
+        d["users"][str(uid)] = user
+        r = rng.random()
+        if r < PENDING_SHARE:
+            links = [f"t.me/+p{i}x{j}" for j in range(rng.randint(1, 3))]
+            add_submission(uid, links, "pending", t)
+            user["groups"] += links
+        elif r < PENDING_SHARE + WAITING_BUYER_SHARE + WAITING_COUNT_SHARE:
+            req_type = "buyer" if r < PENDING_SHARE + WAITING_BUYER_SHARE else "count"
+            links = [f"t.me/+w{i}x{j}" for j in range(rng.randint(1, 3))]
+            status = "approved_waiting_target" if req_type == "buyer" else "approved_waiting_count"
+            sub_id = add_submission(uid, links, status, t, approved_count=len(links) if req_type == "buyer" else None)
+            user["groups"] += links
+            prompt_id += 1
+            d["pending_requests"][str(prompt_id)] = {"type": req_type, "seller_id": uid, "submission_id": sub_id, "time": t}
+        if rng.random() < PENDING_WITHDRAWAL_SHARE and user["balance"] >= 2:
+            d["withdrawal_seq"] += 1
+            wid = str(d["withdrawal_seq"])
+            d["withdrawals"][wid] = {"id": wid, "uid": uid, "method": "binance", "address": str(uid), "amount": 2.0, "status": "Pending", "time": t}
+            wids.append(wid)
+            user["balance"] -= 2.0
+    d["stats"] = {"users": n_users, "sold": sold, "withdrawals": approved, "withdrawn": withdrawn, "joined_24h": [], "sold_24h": [], "withdrawals_24h": []}
+    return d
+def dataset_dir(data_dir: Path, n_users: int, backend: str):
+    # Pristine state for one size, generated once and reused across runs
+    base = data_dir / f"users-{n_users}"
+    snapshot = base / "data.json"
+    if not snapshot.exists():
+        base.mkdir(parents=True, exist_ok=True)
+        t = time.perf_counter()
+        with open(base / "data.json.tmp", "w", encoding="utf8") as f:
+            json.dump(generate_state(n_users), f, ensure_ascii=False)
+        os.replace(base / "data.json.tmp", snapshot)
+        print(f"Generated {snapshot} ({snapshot.stat().st_size / 1e6:.1f}MB) in {time.perf_counter() - t:.1f}s", file=sys.stderr)
+    if backend == "sqlite" and not (base / "data.sqlite3").exists():
+        subprocess.run([sys.executable, str(HERE / "bot.py"), "migrate-sqlite", str(snapshot), str(base / "data.sqlite3.tmp")], cwd=base, check=True)
+        os.replace(base / "data.sqlite3.tmp", base / "data.sqlite3")
+    if backend == "binary" and not (base / "data.snap").exists():
+        subprocess.run([sys.executable, str(HERE / "bot.py"), "convert-snapshot", str(snapshot), str(base / "data.snap")], cwd=base, check=True)
+    return base
+# ========================
+# Stub Telegram objects
+# ========================
+class StubBot:
+    def __init__(self):
+        self.message_ids = iter(range(1, 1 << 62))
+        self.sent = 0
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent += 1
+        return StubMessage(self, chat_id, text)
+    async def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        return True
+    async def set_my_commands(self, *args, **kwargs):
+        return True
+class StubMessage:
+    def __init__(self, bot, chat_id, text=None, reply_to=None):
+        self.bot = bot
+        self.message_id = next(bot.message_ids)
+        self.chat = types.SimpleNamespace(id=chat_id)
+        self.text = text
+        self.reply_to_message = reply_to
+    async def reply_text(self, text, **kwargs):
+        return StubMessage(self.bot, self.chat.id, text)
+    async def edit_text(self, text, **kwargs):
+        return self
+class StubQuery:
+    def __init__(self, bot, user, data):
+        self.from_user = user
+        self.data = data
+        self.message = StubMessage(bot, user.id)
+    async def answer(self, *args, **kwargs):
+        return True
+    async def edit_message_text(self, text, **kwargs):
+        return self.message
+def stub_update(bot, uid, text=None, data=None, reply_to=None):
+    user = types.SimpleNamespace(id=uid, username=f"u{uid}", first_name="Bench", is_bot=False)
+    return types.SimpleNamespace(
+        effective_user=user,
+        effective_chat=types.SimpleNamespace(id=uid),
+        message=StubMessage(bot, uid, text, reply_to) if text is not None else None,
+        callback_query=StubQuery(bot, user, data) if data is not None else None,
+    )
+def stub_context(bot, user_data=None):
+    return types.SimpleNamespace(bot=bot, user_data=user_data if user_data is not None else {}, chat_data={}, bot_data={}, job_queue=None, application=None)
+# ========================
+# Measurement
+# ========================
+def percentile(sorted_values, p):
+    # Nearest-rank percentile of an ascending list
+    return sorted_values[max(0, min(len(sorted_values) - 1, round(p / 100 * len(sorted_values)) - 1))]
+async def measure(setup, call, iterations: int, alloc_iterations: int):
+    # setup() builds the arguments of one call outside the timed region
+    latencies = []
+    for _ in range(iterations):
+        args = await setup()
+        t = time.perf_counter()
+        await call(*args)
+        latencies.append(time.perf_counter() - t)
+    peaks, retained = [], []
+    tracemalloc.start()
+    for _ in range(alloc_iterations):
+        args = await setup()
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        await call(*args)
+        current, peak = tracemalloc.get_traced_memory()
+        peaks.append(peak - before)
+        retained.append(current - before)
+    tracemalloc.stop()
+    latencies.sort()
+    ms = [x * 1000 for x in latencies]
+    return {
+        "n": len(ms),
+        "mean_ms": statistics.fmean(ms),
+        "p50_ms": percentile(ms, 50),
+        "p90_ms": percentile(ms, 90),
+        "p99_ms": percentile(ms, 99),
+        "max_ms": ms[-1],
+        "alloc_peak_kb": statistics.median(peaks) / 1024 if peaks else None,
+        "alloc_retained_kb": statistics.fmean(retained) / 1024 if retained else None,
+    }
+def rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            return next(int(line.split()[1]) / 1024 for line in f if line.startswith("VmRSS:"))
+    except (OSError, StopIteration):
+        return None
+async def run_benchmarks(bot, n_users: int, iterations: int, backend: str):
+    store = bot.store
+    stub = StubBot()
+    rng = random.Random(SEED)
+    admin = bot.ADMIN_ID
+    def random_uid():
+        return FIRST_UID + rng.randrange(n_users)
+    def fresh_links(n):
+        return [f"t.me/+bench{uuid.uuid4().hex[:16]}" for _ in range(n)]
+    # Pools of pending items consumed by the review handlers, topped up when they run dry
+    pending_subs = list(store.submissions(statuses=[bot.GroupStatus.PENDING]))
+    pending_wds = list(store.pending_withdrawals())
+    buyer_prompts = [msg_id for msg_id, req in store.pending_requests().items() if req.type == "buyer"]
+    def next_submission():
+        if pending_subs:
+            return pending_subs.pop()
+        return store.submit_groups(random_uid(), fresh_links(2), "2023", "single", bot.now())
+    def next_withdrawal():
+        if pending_wds:
+            return pending_wds.pop()
+        uid = random_uid()
+        store.credit(uid, 2.0)
+        return store.open_withdrawal(uid, "upi", "bench@bank", 2.0, bot.now())
+    def next_buyer_prompt():
+        if buyer_prompts:
+            return buyer_prompts.pop()
+        uid = random_uid()
+        sub_id = store.submit_groups(uid, fresh_links(2), "2023", "single", bot.now())
+        store.set_submission_status(sub_id, bot.GroupStatus.WAITING_TARGET, approved_count=2)
+        msg_id = str(next(stub.message_ids))
+        store.open_request(msg_id, "buyer", uid, sub_id, bot.now())
+        return msg_id
+    async def handler_call(handler, update, context):
+        await handler(update, context)
+    def on_update(make):
+        # setup for a handler called as handler(update, context)
+        async def setup():
+            handler, update, context = make()
+            return handler, update, context
+        return setup
+    cases = {
+        "cmd_stats": lambda: (bot.cmd_stats, stub_update(stub, admin, "/stats"), stub_context(stub)),
+        "cmd_price": lambda: (bot.cmd_price, stub_update(stub, random_uid(), "/price"), stub_context(stub)),
+        "cmd_balance": lambda: (bot.cmd_balance, stub_update(stub, random_uid(), "/balance"), stub_context(stub)),
+        "sell_receive_link": lambda: (bot.sell_receive_link, stub_update(stub, random_uid(), " ".join(fresh_links(3))), stub_context(stub, {"in_sell": True, "sell_type": "single"})),
+        "sell_receive_year": lambda: (bot.sell_receive_year, stub_update(stub, random_uid(), "2023"), stub_context(stub, {"in_sell": True, "sell_type": "single", "sell_links": fresh_links(3)})),
+        "admin_callback_handler:approve_group": lambda: (bot.admin_callback_handler, stub_update(stub, admin, data=f"approve_group:{next_submission()}"), stub_context(stub)),
+        "admin_callback_handler:reject_group": lambda: (bot.admin_callback_handler, stub_update(stub, admin, data=f"reject_group:{next_submission()}"), stub_context(stub)),
+        "admin_callback_handler:approve_withdraw": lambda: (bot.admin_callback_handler, stub_update(stub, admin, data=f"approve_withdraw:{next_withdrawal()}"), stub_context(stub)),
+        "review_callback": lambda: (bot.review_callback, stub_update(stub, admin, data="review:g:n:0"), stub_context(stub)),
+        "admin_inspect_handler": lambda: (bot.admin_inspect_handler, stub_update(stub, admin, str(random_uid())), stub_context(stub)),
+        "button_router:balance": lambda: (bot.button_router, stub_update(stub, random_uid(), "💵 Balance"), stub_context(stub)),
+        "button_router:buyer_reply": lambda: (bot.button_router, stub_update(stub, admin, "@buyer", reply_to=types.SimpleNamespace(message_id=next_buyer_prompt())), stub_context(stub)),
+        "withdraw_get_amount": lambda: (bot.withdraw_get_amount, stub_update(stub, random_uid(), "0.5"), stub_context(stub, {"withdraw_method": "upi", "withdraw_address": "bench@bank"})),
+    }
+    handlers = {}
+    for name, make in cases.items():
+        handlers[name] = await measure(on_update(make), handler_call, iterations, min(iterations, ALLOC_ITERATIONS))
+    # Persistence: one journaled op, and for the JSON store the snapshot that folds the journal
+    async def credit_setup():
+        return (random_uid(),)
+    async def credit(uid):
+        store.credit(uid, 0.01)
+    persistence = {"journal_append": await measure(credit_setup, credit, iterations, min(iterations, ALLOC_ITERATIONS))}
+    if backend != "sqlite":
+        async def snapshot_setup():
+            store.credit(random_uid(), 0.01) # compact() is a no-op without new ops
+            return ()
+        persistence["snapshot"] = await measure(snapshot_setup, store.persistence.compact, SNAPSHOT_ITERATIONS, 1)
+    return handlers, persistence
+# ========================
+# Child: one dataset, one process
+# ========================
+def run_child(base: Path, n_users: int, backend: str, iterations: int, fsync: bool):
+    work = base / f"run-{backend}"
+    shutil.rmtree(work, ignore_errors=True)
+    work.mkdir()
+    name = {"json": "data.json", "binary": "data.snap", "sqlite": "data.sqlite3"}[backend]
+    shutil.copy(base / name, work / name)
+    os.chdir(work)
+    os.environ.update(
+        STORAGE_BACKEND="sqlite" if backend == "sqlite" else "json",
+        SNAPSHOT_FORMAT="binary" if backend == "binary" else "json",
+        SQLITE_PATH=str(work / "data.sqlite3"),
+        JOURNAL_FSYNC="1" if fsync else "0",
+        JOURNAL_COMPACT_OPS=str(1 << 62), # Snapshots are timed explicitly, never in the middle of a handler run
+        JOURNAL_COMPACT_SECONDS="1e9",
+    )
+    logging.basicConfig(level=logging.WARNING) # bot.py's own basicConfig is then a no-op
+    sys.path.insert(0, str(HERE))
+    import bot
+    t = time.perf_counter()
+    bot.use_store(bot.open_store())
+    load_s = time.perf_counter() - t
+    rss = rss_mb()
+    handlers, persistence = asyncio.run(run_benchmarks(bot, n_users, iterations, backend))
+    result = {
+        "backend": backend,
+        "users": n_users,
+        "fsync": fsync,
+        "iterations": iterations,
+        "dataset_mb": (base / name).stat().st_size / 1e6,
+        "load_s": load_s,
+        "rss_after_load_mb": rss,
+        "handlers": handlers,
+        "persistence": persistence,
+    }
+    shutil.rmtree(work, ignore_errors=True)
+    print(json.dumps(result))
+# ========================
+# Report & comparison
+# ========================
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=HERE, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+def print_result(result):
+    print(f"\n== {result['backend']} store, {result['users']:,} users ({result['dataset_mb']:.1f}MB): load {result['load_s']:.2f}s, RSS {result['rss_after_load_mb'] or 0:.0f}MB")
+    print(f"{'':42} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'max ms':>9} {'alloc KB':>9}")
+    for name, m in {**result["handlers"], **result["persistence"]}.items():
+        print(f"{name:42} {m['p50_ms']:9.3f} {m['p90_ms']:9.3f} {m['p99_ms']:9.3f} {m['max_ms']:9.3f} {m['alloc_peak_kb'] or 0:9.1f}")
+def load_results(path: Path):
+    # Latest result per (backend, users) in a bench output file
+    latest = {}
+    with open(path, encoding="utf8") as f:
+        for line in f:
+            if line.strip():
+                rec = json.loads(line)
+                latest[(rec["backend"], rec["users"])] = rec
+    return latest
+def compare(results, baseline_path: Path, threshold: float, min_delta_ms: float):
+    # p50 and p99 against the baseline's. Only p50 decides a regression (p99 of a few hundred
+    # calls is noisy), and only when it moved by more than min_delta_ms as well.
+    baseline = load_results(baseline_path)
+    regressions = 0
+    for result in results:
+        base = baseline.get((result["backend"], result["users"]))
+        if base is None:
+            print(f"\nNo baseline for {result['backend']} / {result['users']:,} users")
+            continue
+        print(f"\n== vs baseline {base.get('revision') or '?'} ({base.get('time', '?')}): {result['backend']} store, {result['users']:,} users")
+        base_metrics = {**base["handlers"], **base["persistence"]}
+        for name, m in {**result["handlers"], **result["persistence"]}.items():
+            old = base_metrics.get(name)
+            if old is None:
+                continue
+            changes = []
+            for key in ("p50_ms", "p99_ms"):
+                change = m[key] / old[key] - 1 if old[key] else 0.0
+                changes.append(f"{key[:3]} {old[key]:.3f} -> {m[key]:.3f} ({change:+.0%})")
+            flagged = m["p50_ms"] > old["p50_ms"] * (1 + threshold) and m["p50_ms"] - old["p50_ms"] > min_delta_ms
+            regressions += flagged
+            print(f"{'REGRESSION ' if flagged else '           '}{name:42} {'  '.join(changes)}")
+    return regressions
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark bot.py handlers on synthetic data")
+    parser.add_argument("--users", default=DEFAULT_USERS, help="comma-separated dataset sizes")
+    parser.add_argument("--backend", default="json", help="comma-separated: json, binary, sqlite")
+    parser.add_argument("--iterations", type=int, default=DEFAULT_ITERATIONS, help="timed calls per handler")
+    parser.add_argument("--fsync", action="store_true", help="fsync every journal append, as the bot does by default")
+    parser.add_argument("--data-dir", type=Path, default=Path(tempfile.gettempdir()) / "bot-bench", help="where generated datasets are cached")
+    parser.add_argument("--output", type=Path, default=HERE / "bench_output.txt", help="results file, one JSON line per dataset (appended)")
+    parser.add_argument("--baseline", type=Path, help="earlier results file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="relative p50 slowdown reported as a regression")
+    parser.add_argument("--min-delta-ms", type=float, default=0.05, help="smaller p50 slowdowns are never reported")
+    parser.add_argument("--child", nargs=3, metavar=("DIR", "USERS", "BACKEND"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        run_child(Path(args.child[0]), int(args.child[1]), args.child[2], args.iterations, args.fsync)
+        return
+    revision = git_revision()
+    results = []
+    for backend in args.backend.split(","):
+        for n_users in (int(n) for n in args.users.split(",")):
+            base = dataset_dir(args.data_dir, n_users, backend)
+            cmd = [sys.executable, str(Path(__file__).resolve()), "--child", str(base), str(n_users), backend, "--iterations", str(args.iterations)]
+            if args.fsync:
+                cmd.append("--fsync")
+            out = subprocess.run(cmd, capture_output=True, text=True)
+            if out.returncode != 0:
+                print(out.stderr, file=sys.stderr)
+                sys.exit(f"Benchmark failed for {backend} / {n_users} users")
+            result = json.loads(out.stdout.strip().splitlines()[-1])
+            result.update(time=datetime.datetime.utcnow().isoformat() + "Z", revision=revision, python=sys.version.split()[0])
+            results.append(result)
+            print_result(result)
+            with open(args.output, "a", encoding="utf8") as f:
+                f.write(json.dumps(result) + "\n")
+    if args.baseline:
+        regressions = compare(results, args.baseline, args.threshold, args.min_delta_ms)
+        if regressions:
+            sys.exit(f"\n{regressions} regression(s) over {args.threshold:.0%}")
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,30 @@
+import array
+import asyncio
+import bisect
+import collections
+import collections.abc
+import contextlib
+import copy
+import heapq
+import hmac
 import json
 import logging
+import mmap
 import re
+import secrets
+import signal
+import sqlite3
+import struct
+import sys
+import threading
+import time
+import uuid
 import datetime
+import enum
+import functools
+import itertools
 import os
+from http import HTTPStatus
 from pathlib import Path
 from telegram import (
     Update,
@@ -12,18 +34,26 @@ from telegram import (
     BotCommand,
 )
 from telegram.ext import (
+    Application,
     ApplicationBuilder,
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
     ConversationHandler,
     ContextTypes,
+    ApplicationHandlerStop,
+    BaseHandler,
+    BasePersistence,
+    PersistenceInput,
     filters,
 )
+from telegram.request import HTTPXRequest
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
 # ========================
 # CONFIG - set these
 # ========================
 BOT_TOKEN = os.getenv("BOT_TOKEN", "8075394934:AAHU9tRE9vemQIDzxRuX4UhxMUtw5mSlMy4")
+BOT_API_URL = os.getenv("BOT_API_URL", "https://api.telegram.org/bot") # Bot API endpoint the token is appended to (point at a local server for load tests)
 ADMIN_ID = int(os.getenv("ADMIN_ID", "5405985282")) # Your Telegram numeric ID
 LINKS_CHANNEL = os.getenv("LINKS_CHANNEL", "-1003234042802") # Your links channel ID (e.g., -100xxxxxxxxxx)
 WITHDRAW_CHANNEL = os.getenv("WITHDRAW_CHANNEL", "-1003224533856") # Your withdrawals channel ID (e.g., -100xxxxxxxxxx)
@@ -36,61 +66,1985 @@ DEFAULT_PRICES = {
     "2024 (5-6)": "1$",
 }
 MAX_LINKS_PER_SUBMISSION = 10 # Maximum number of links allowed in one submission
+PRICE_CACHE_SIZE = 10000 # Users whose effective price table and /price text are kept cached
+REVIEW_PAGE_SIZE = 5 # Entries per page in the admin review queues
+WITHDRAW_HISTORY_PAGE_SIZE = 5 # Entries per page of a user's withdrawal history
+TELEGRAM_MESSAGE_LIMIT = 4096 # Longest text Telegram accepts in one message
+SWEEP_INTERVAL_SECONDS = 60 # How often the expiry sweeper looks for due deadlines
+SUBMISSION_REVIEW_TTL_HOURS = float(os.getenv("SUBMISSION_REVIEW_TTL_HOURS", "168")) # Submissions nobody approved or rejected expire after this long (0 = never)
+SUBMISSION_DEAL_TTL_HOURS = float(os.getenv("SUBMISSION_DEAL_TTL_HOURS", "336")) # Approved ones still waiting for a count or buyer expire this long after their last status or ownership change; once a transfer is requested they go to the admin instead (0 = never)
+REQUEST_TTL_HOURS = float(os.getenv("REQUEST_TTL_HOURS", "24")) # Unanswered admin reply prompts are sent again after this long (0 = never)
+WITHDRAWAL_REMIND_HOURS = float(os.getenv("WITHDRAWAL_REMIND_HOURS", "24")) # The admin is reminded of a withdrawal pending this long, and again every period after (0 = never)
+JOURNAL_COMPACT_OPS = int(os.getenv("JOURNAL_COMPACT_OPS", "5000")) # Fold the journal into data.json after this many ops...
+JOURNAL_COMPACT_SECONDS = float(os.getenv("JOURNAL_COMPACT_SECONDS", "300")) # ...or at least this often
+JOURNAL_FSYNC = os.getenv("JOURNAL_FSYNC", "1") == "1" # fsync every journal append before acknowledging it
+SNAPSHOT_FORMAT = os.getenv("SNAPSHOT_FORMAT", "json") # "json" (data.json) or "binary" (data.snap: users, withdrawals and links are decoded on first use)
+USER_HOT_ITEMS = int(os.getenv("USER_HOT_ITEMS", "20")) # Groups and closed withdrawals kept in memory per user; older ones go to data.archive
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json") # "json" (data.json + journal) or "sqlite"
+SQLITE_PATH = Path(os.getenv("SQLITE_PATH", "data.sqlite3"))
+STATS_BUCKET_SECONDS = 900 # Resolution of the rolling 24h counters
+STATS_WINDOW_BUCKETS = 24 * 60 * 60 // STATS_BUCKET_SECONDS
+STATS_TOP_SELLERS = 20 # Sellers listed in /stats
+GLOBAL_SEND_RATE = float(os.getenv("GLOBAL_SEND_RATE", "25")) # Outbound messages/second across all chats (Telegram allows ~30)
+PER_CHAT_SEND_RATE = 1.0 # Outbound messages/second to one chat
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "10")) # Sends in flight at once during a broadcast
+BROADCAST_PAGE_SIZE = 100 # Users fetched per page; the cursor is persisted after each page
+BROADCAST_PROGRESS_SECONDS = 10 # How often the admin's progress message is edited
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", "8")) # Parallel senders for queued notifications
+OUTBOX_MAX_ATTEMPTS = 8 # Transient failures before a notification is dropped
+OUTBOX_BACKOFF_MAX = 300 # Cap (seconds) for the exponential retry delay
+OUTBOX_DRAIN_SECONDS = 5 # How long shutdown waits for the queue to empty
+DIGEST_SECONDS = float(os.getenv("DIGEST_SECONDS", "60")) # Posts to LINKS_CHANNEL / WITHDRAW_CHANNEL are collected into one digest this long (0 = post each right away)
+DIGEST_MAX_EVENTS = int(os.getenv("DIGEST_MAX_EVENTS", "50")) # ...or until a channel has this many waiting
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "64")) # Updates processed in parallel (one at a time per user)
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", "1000")) # Received-but-unprocessed updates before ingest pushes back
+CONVERSATION_TIMEOUT = int(os.getenv("CONVERSATION_TIMEOUT", "600")) # Seconds a half-finished /sell, /withdraw or /admin flow stays open
+CONVERSATION_FLUSH_SECONDS = float(os.getenv("CONVERSATION_FLUSH_SECONDS", "5")) # How often changed conversation state and user_data are written to the store
+INBOUND_LIMIT_SELL = os.getenv("INBOUND_LIMIT_SELL", "5/600") # "burst/seconds": sales a user may start at once, refilled over that many seconds ("0" = unlimited)
+INBOUND_LIMIT_WITHDRAW = os.getenv("INBOUND_LIMIT_WITHDRAW", "5/600") # Same for withdrawal requests
+INBOUND_LIMIT_OTHER = os.getenv("INBOUND_LIMIT_OTHER", "20/20") # Same for every other message or button press (the admin is never limited)
+BOT_MODE = os.getenv("BOT_MODE", "polling") # "polling" or "webhook"
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "") # Public HTTPS base URL; leave empty to serve without calling setWebhook
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "") # Checked against X-Telegram-Bot-Api-Secret-Token; generated if empty and WEBHOOK_URL is set, required otherwise
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40")) # Parallel deliveries Telegram may open
+WEBHOOK_MAX_BODY = 1 << 20 # Largest request body accepted (bytes)
+WEBHOOK_IDLE_TIMEOUT = 60 # Seconds a keep-alive connection may sit idle
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1") # Keep it local: the endpoint has no authentication
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9464")) # Prometheus text endpoint (GET /metrics); 0 disables it
+METRICS_SUMMARY_TOP = 12 # Handlers / API methods listed by /metrics, by total time
 # ========================
 # Logging
 # ========================
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 # ========================
+# Metrics
+# ========================
+# In-process counters and histograms, cheap enough to leave on under full load: an
+# observation is a perf_counter() pair, one bisect and a few additions, without locks since
+# everything is recorded on the event loop. Rendered in the Prometheus text format on the
+# local endpoint (GET /metrics on METRICS_LISTEN:METRICS_PORT) and summarised by /metrics.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0) # Seconds
+SIZE_BUCKETS = tuple(1 << n for n in range(8, 30, 2)) # Bytes, 256B..256MB
+class Histogram:
+    __slots__ = ("bounds", "counts", "sum", "count")
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1) # Last slot: above the highest bound
+        self.sum = 0.0
+        self.count = 0
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+    def quantile(self, q: float):
+        # Upper bound of the bucket the q-quantile falls in; inf past the highest bound
+        rank, seen = q * self.count, 0
+        for bound, n in zip(self.bounds, self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return float("inf")
+def label_value(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+def label_text(names, values, le=None):
+    pairs = [f'{k}="{label_value(v)}"' for k, v in zip(names, values)]
+    if le is not None:
+        pairs.append(f'le="{le}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+class Metrics:
+    # name -> (type, help, label names). Histograms named *_bytes use SIZE_BUCKETS.
+    FAMILIES = {
+        "bot_update_seconds": ("histogram", "Update processing time, waiting behind the same user's earlier updates included", ()),
+        "bot_handler_seconds": ("histogram", "Time spent in each registered handler callback", ("handler",)),
+        "bot_handler_errors_total": ("counter", "Handler callbacks that raised", ("handler",)),
+        "bot_updates_shed_total": ("counter", "Updates dropped by inbound throttling, by action class", ("action",)),
+        "bot_api_seconds": ("histogram", "Bot API requests by method, including the network", ("method",)),
+        "bot_api_errors_total": ("counter", "Failed Bot API requests by method and HTTP status ('network' when there was no response)", ("method", "code")),
+        "bot_journal_append_seconds": ("histogram", "Journal appends (write, flush and fsync)", ()),
+        "bot_journal_append_bytes": ("histogram", "Size of each journal entry", ()),
+        "bot_snapshot_seconds": ("histogram", "Full data.json snapshots (archiving, encoding and the atomic write)", ()),
+        "bot_snapshot_bytes": ("histogram", "Size of each data.json snapshot", ()),
+        "bot_sqlite_commit_seconds": ("histogram", "SQLite transaction commits", ()),
+        "bot_update_backlog": ("gauge", "Updates received and not yet processed", ()),
+        "bot_outbox_pending": ("gauge", "Notifications queued for delivery", ()),
+        "bot_digest_pending": ("gauge", "Channel posts waiting for the next digest", ()),
+        "bot_expiry_watched": ("gauge", "Pending items with a live expiry deadline", ()),
+        "bot_throttle_buckets": ("gauge", "Per-user inbound token buckets held in memory", ()),
+        "bot_start_time_seconds": ("gauge", "Unix time the process started", ()),
+    }
+    def __init__(self):
+        self.series = {name: {} for name in self.FAMILIES} # name -> {label values: count or Histogram}
+        self.gauges = {} # name -> () -> current value, read when rendering
+        self.started = time.time()
+        self.gauge("bot_start_time_seconds", lambda: self.started)
+        self.server = None
+    def observe(self, name: str, value: float, *labels):
+        series = self.series[name]
+        hist = series.get(labels)
+        if hist is None:
+            hist = series[labels] = Histogram(SIZE_BUCKETS if name.endswith("_bytes") else LATENCY_BUCKETS)
+        hist.observe(value)
+    def inc(self, name: str, *labels, value: int = 1):
+        series = self.series[name]
+        series[labels] = series.get(labels, 0) + value
+    def gauge(self, name: str, read):
+        self.gauges[name] = read
+    def render(self) -> str:
+        out = []
+        for name, (kind, help_text, label_names) in self.FAMILIES.items():
+            out.append(f"# HELP {name} {help_text}")
+            out.append(f"# TYPE {name} {kind}")
+            if kind == "gauge":
+                if name in self.gauges:
+                    out.append(f"{name} {self.gauges[name]()}")
+                continue
+            for labels, value in sorted(self.series[name].items()):
+                if kind == "counter":
+                    out.append(f"{name}{label_text(label_names, labels)} {value}")
+                    continue
+                cumulative = 0
+                for bound, n in zip(value.bounds, value.counts):
+                    cumulative += n
+                    out.append(f"{name}_bucket{label_text(label_names, labels, bound)} {cumulative}")
+                out.append(f"{name}_bucket{label_text(label_names, labels, '+Inf')} {value.count}")
+                out.append(f"{name}_sum{label_text(label_names, labels)} {value.sum}")
+                out.append(f"{name}_count{label_text(label_names, labels)} {value.count}")
+        return "\n".join(out) + "\n"
+    def summary_lines(self):
+        # The admin's /metrics: queues, the handlers and API methods costing the most time, persistence
+        def ms(hist, q):
+            v = hist.quantile(q)
+            return f">{hist.bounds[-1] * 1000:g}" if v == float("inf") else f"≤{v * 1000:g}"
+        up = int(time.time() - self.started)
+        gauges = {name: read() for name, read in self.gauges.items()}
+        lines = [
+            f"📊 Metrics — up {up // 86400}d {up % 86400 // 3600}h {up % 3600 // 60}m",
+            f"Queues: updates {gauges.get('bot_update_backlog', 0)} | outbox {gauges.get('bot_outbox_pending', 0)} | digest {gauges.get('bot_digest_pending', 0)} | expiry {gauges.get('bot_expiry_watched', 0)}",
+        ]
+        updates = self.series["bot_update_seconds"].get(())
+        if updates:
+            lines.append(f"Updates: {updates.count}, p50 {ms(updates, 0.5)} ms, p99 {ms(updates, 0.99)} ms")
+        sections = (
+            ("⏱ Handlers (calls, errors, p50/p99 ms, total s):", "bot_handler_seconds", "bot_handler_errors_total"),
+            ("📡 Bot API (calls, errors, p50/p99 ms, total s):", "bot_api_seconds", "bot_api_errors_total"),
+        )
+        for title, hist_name, error_name in sections:
+            errors = collections.Counter()
+            for labels, n in self.series[error_name].items():
+                errors[labels[0]] += n
+            ranked = sorted(self.series[hist_name].items(), key=lambda item: -item[1].sum)
+            lines.append("")
+            lines.append(title)
+            for (name,), hist in ranked[:METRICS_SUMMARY_TOP]:
+                lines.append(f"{name}: {hist.count}, {errors[name]} err, {ms(hist, 0.5)}/{ms(hist, 0.99)} ms, {hist.sum:.1f}s")
+            if not ranked:
+                lines.append("—")
+        lines.append("")
+        lines.append("💾 Persistence:")
+        for label, name in (("Journal appends", "bot_journal_append"), ("Snapshots", "bot_snapshot")):
+            hist = self.series[f"{name}_seconds"].get(())
+            size = self.series[f"{name}_bytes"].get(())
+            if hist:
+                lines.append(f"{label}: {hist.count}, p50 {ms(hist, 0.5)} ms, p99 {ms(hist, 0.99)} ms, {size.sum / hist.count / 1024:.1f}KB avg")
+        commits = self.series["bot_sqlite_commit_seconds"].get(())
+        if commits:
+            lines.append(f"SQLite commits: {commits.count}, p50 {ms(commits, 0.5)} ms, p99 {ms(commits, 0.99)} ms")
+        return lines
+    async def serve(self, app):
+        # A WebhookServer without a webhook path answers only its GET routes
+        server = WebhookServer(app.update_queue, app.bot, None, "", METRICS_LISTEN, METRICS_PORT)
+        server.routes["/metrics"] = lambda: (200, "text/plain; version=0.0.4; charset=utf-8", self.render().encode())
+        try:
+            await server.start()
+        except OSError as e:
+            logger.error(f"Metrics endpoint not available: {e}")
+            return
+        self.server = server
+        logger.info(f"Serving metrics on {METRICS_LISTEN}:{server.port}/metrics")
+    async def close(self):
+        if self.server is not None:
+            await self.server.close()
+            self.server = None
+metrics = Metrics()
+def timed_callback(callback):
+    # The handler callback, timed into bot_handler_seconds under its function name
+    name = callback.__name__
+    @functools.wraps(callback)
+    async def timed(update, context):
+        start = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except ApplicationHandlerStop:
+            raise
+        except Exception:
+            metrics.inc("bot_handler_errors_total", name)
+            raise
+        finally:
+            metrics.observe("bot_handler_seconds", time.perf_counter() - start, name)
+    timed.timed = True
+    return timed
+def instrument_handler(handler):
+    if isinstance(handler, ConversationHandler):
+        for inner in itertools.chain(handler.entry_points, handler.fallbacks, *handler.states.values()):
+            instrument_handler(inner)
+    elif not getattr(handler.callback, "timed", False):
+        handler.callback = timed_callback(handler.callback)
+class InstrumentedRequest(HTTPXRequest):
+    # Every Bot API call the bot makes (handlers, outbox, broadcasts) goes through here
+    async def do_request(self, url, method, *args, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        start = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+        except Exception:
+            metrics.inc("bot_api_errors_total", api_method, "network")
+            raise
+        finally:
+            metrics.observe("bot_api_seconds", time.perf_counter() - start, api_method)
+        if code >= 300:
+            metrics.inc("bot_api_errors_total", api_method, str(code))
+        return code, payload
+# ========================
 # Persistence helpers
 # ========================
-def load_data():
+# ------------------------
+# Records: users, submissions, withdrawals, reply prompts and link index entries are
+# slotted objects keyed by integer user ids, and every status is a member of a str
+# enum, so one shared object stands for it in every record. JSON dicts only exist at
+# the persistence boundary: snapshot, journal, archive and SQLite rows.
+# ------------------------
+class Label(str, enum.Enum):
+    # Compares, hashes, prints and JSON-encodes as its plain value
+    __str__ = str.__str__
+class GroupStatus(Label):
+    PENDING = "pending"
+    WAITING_COUNT = "approved_waiting_count" # folder approved, admin still has to count its groups
+    WAITING_TARGET = "approved_waiting_target" # approved, waiting for the buyer and the ownership transfer
+    REJECTED = "rejected"
+    SOLD = "sold"
+    CLOSED = "closed" # link index only: listed before the index existed, outcome unknown
+    EXPIRED = "expired" # no decision within the TTL; the links are free again
+class OwnershipStatus(Label):
+    NONE = "none"
+    REQUESTED = "requested"
+    TRANSFERRED = "transferred"
+    FAILED = "failed"
+class WithdrawalStatus(Label):
+    PENDING = "Pending"
+    APPROVED = "Approved"
+    REJECTED = "Rejected"
+    SUPERSEDED = "Superseded" # replaced by a later request before withdrawals had ids
+class Record:
+    __slots__ = ()
+    DEFAULTS = {} # Field -> value when absent (immutable values only)
+    DECODE = {} # Field -> conversion applied to a non-null JSON value
+    FIELDS = () # (name, default, decode) per slot, filled in for each subclass
+    def __init_subclass__(cls):
+        super().__init_subclass__()
+        # Enum fields decode by a plain dict lookup: calling the enum class costs several times more
+        decoders = {name: {m.value: m for m in fn}.__getitem__ if isinstance(fn, enum.EnumMeta) else fn for name, fn in cls.DECODE.items()}
+        cls.FIELDS = tuple((name, cls.DEFAULTS.get(name), decoders.get(name)) for name in cls.__slots__)
+    def __init__(self, **fields):
+        for name, default, _ in self.FIELDS:
+            setattr(self, name, fields.get(name, default))
+    def __repr__(self):
+        return f"{type(self).__name__}({', '.join(f'{name}={getattr(self, name)!r}' for name in self.__slots__)})"
+    def to_json(self):
+        return {name: value for name in self.__slots__ if (value := getattr(self, name)) is not None}
+    @classmethod
+    def from_json(cls, d):
+        # Runs for every record at load, so it fills the slots directly; null counts as absent
+        obj = cls.__new__(cls)
+        for name, default, decode in cls.FIELDS:
+            value = d.get(name)
+            setattr(obj, name, default if value is None else decode(value) if decode else value)
+        return obj
+def json_default(obj):
+    # json.dumps hook: records encode as their JSON dict
+    if isinstance(obj, Record):
+        return obj.to_json()
+    raise TypeError(f"{type(obj).__name__} is not JSON serializable")
+class User(Record):
+    # groups, withdrawals (ids, oldest first) and archived are the JSON store's in-memory
+    # tier of the user's history; SqliteStore keeps those in tables and leaves them None
+    __slots__ = ("balance", "sales", "custom_prices", "start_time", "groups", "withdrawals", "archived")
+    DEFAULTS = {"balance": 0.0, "sales": 0}
+    DECODE = {"custom_prices": lambda prices: prices or None}
+class Submission(Record):
+    # changed: time of the last status or ownership change, None until the first one
+    __slots__ = ("id", "seller_id", "links", "year", "type", "time", "status", "approved_count", "ownership_status", "ownership_target_id", "changed")
+    DEFAULTS = {"type": "single", "status": GroupStatus.PENDING, "ownership_status": OwnershipStatus.NONE}
+    DECODE = {"seller_id": int, "status": GroupStatus, "ownership_status": OwnershipStatus}
+class Withdrawal(Record):
+    __slots__ = ("id", "uid", "method", "address", "amount", "status", "time")
+    DEFAULTS = {"status": WithdrawalStatus.PENDING}
+    DECODE = {"uid": int, "status": WithdrawalStatus}
+class PendingRequest(Record):
+    __slots__ = ("type", "seller_id", "submission_id", "time") # type "count" | "buyer"
+    DECODE = {"seller_id": int}
+class LinkEntry(Record):
+    __slots__ = ("owner", "status")
+    DECODE = {"owner": int, "status": GroupStatus}
+def empty_data():
+    return {
+        "users": {}, # user_id -> User
+        "submissions": {}, # id -> Submission
+        "submission_seq": 0, # Last submission id handed out
+        "withdrawals": {}, # id -> Withdrawal
+        "withdrawal_seq": 0, # Last withdrawal id handed out
+        "pending_requests": {}, # message_id -> PendingRequest
+        "sell_enabled": True, # Global sell toggle
+        "global_prices": dict(DEFAULT_PRICES), # Global prices
+        "journal_seq": 0, # Sequence number of the last journal op folded into this snapshot
+        "stats": empty_stats(), # Running counters for /stats
+        "meta": {}, # Small named records for background jobs (e.g. the broadcast cursor)
+        "outbox": {}, # id -> queued notification not yet delivered
+        "digest": {}, # id -> channel post waiting for the next digest
+        "links": {}, # canonical invite link -> LinkEntry
+        "user_data": {}, # user_id (str) -> context.user_data, for users who have any
+        "conversations": {}, # ConversationHandler name -> {conversation key (JSON) -> [state, time of last change]}
+    }
+def new_user_record(start_time: str):
+    return User(start_time=start_time, groups=[], withdrawals=[]) # start_time: when the user first interacted
+def write_atomic(path: Path, payload: str):
+    # Write to a temp file next to the target, then rename over it so a crash never leaves a torn data.json
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "w", encoding="utf8") as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+# ------------------------
+# Statistics: counters updated at the point of change, with rolling 24h figures
+# kept in a ring of time buckets so /stats never scans users or groups.
+# ------------------------
+def parse_time(timestamp: str):
+    # ISO timestamp as written by now() -> epoch seconds (None if unparseable)
+    try:
+        return datetime.datetime.fromisoformat(timestamp.replace("Z", "+00:00")).replace(tzinfo=datetime.timezone.utc).timestamp()
+    except (AttributeError, ValueError):
+        return None
+def empty_stats():
+    return {
+        "users": 0,
+        "sold": 0,
+        "withdrawals": 0,
+        "withdrawn": 0.0,
+        "joined_24h": [], # ring of [bucket, count]
+        "sold_24h": [],
+        "withdrawals_24h": [],
+    }
+def ring_add(ring: list, timestamp: str, n=1):
+    ts = parse_time(timestamp)
+    if ts is None:
+        return
+    bucket = int(ts // STATS_BUCKET_SECONDS)
+    slot = bucket % STATS_WINDOW_BUCKETS
+    while len(ring) <= slot:
+        ring.append([0, 0])
+    if ring[slot][0] > bucket:
+        return # Older than what the slot already holds, outside the window
+    if ring[slot][0] != bucket:
+        ring[slot] = [bucket, 0]
+    ring[slot][1] += n
+def ring_total(ring: list, now_ts: float):
+    current = int(now_ts // STATS_BUCKET_SECONDS)
+    return sum(count for bucket, count in ring if 0 <= current - bucket < STATS_WINDOW_BUCKETS)
+def stats_user_created(stats, time: str):
+    stats["users"] += 1
+    ring_add(stats["joined_24h"], time)
+def stats_groups_sold(stats, count: int, time: str):
+    stats["sold"] += count
+    ring_add(stats["sold_24h"], time, count)
+def stats_withdrawal_approved(stats, amount: float, time: str):
+    stats["withdrawals"] += 1
+    stats["withdrawn"] += amount
+    ring_add(stats["withdrawals_24h"], time)
+def build_stats(d):
+    # One-off backfill for data written before counters existed
+    stats = empty_stats()
+    for u in d.get("users", {}).values():
+        stats_user_created(stats, u.get("start_time", ""))
+        stats["sold"] += u.get("sales", 0)
+        for rec in u.get("withdraw_history", []):
+            if rec.get("status") == "Approved":
+                stats["withdrawals"] += 1
+                stats["withdrawn"] += float(rec.get("amount", 0))
+    return stats
+# ------------------------
+# Invite links: every group has one canonical spelling, and d["links"] maps it to
+# {"owner": seller id, "status": ...} across the whole marketplace so a duplicate
+# check is one dict lookup instead of a scan of the seller's history.
+# ------------------------
+INVITE_RE = re.compile(
+    r"^(https?://)?(t\.me/joinchat/|t\.me/\+|telegram\.me/joinchat/|telegram\.me/\+|t\.me/|t\.me/addlist/)[A-Za-z0-9_-]+$",
+    flags=re.IGNORECASE,
+)
+CANONICAL_LINK_RE = re.compile(r"^(?:https?://)?(?:www\.)?(?:t|telegram)\.me/(joinchat/|\+|addlist/)?([A-Za-z0-9_-]+)/?$", flags=re.IGNORECASE)
+def canonical_link(link: str):
+    # t.me/+HASH for private invites (joinchat/ and telegram.me spellings included),
+    # t.me/addlist/SLUG for folders and t.me/name for public groups. Invite hashes are
+    # case-sensitive, public usernames are not.
+    link = link.strip()
+    m = CANONICAL_LINK_RE.match(link)
+    if m is None:
+        return link
+    prefix, tail = m.groups()
+    if prefix is None:
+        return f"t.me/{tail.lower()}"
+    if prefix.lower() == "addlist/":
+        return f"t.me/addlist/{tail}"
+    return f"t.me/+{tail}"
+def link_taken(entry, uid: int):
+    # A listed link can't be submitted again; once rejected it stays blocked only for the seller it was rejected from,
+    # once expired it is free for everyone
+    return entry is not None and entry.status != GroupStatus.EXPIRED and (entry.status != GroupStatus.REJECTED or entry.owner == uid)
+def set_link_status(d, link: str, status: GroupStatus):
+    entry = d["links"].get(canonical_link(link))
+    if entry is not None:
+        entry.status = status
+def build_link_index(groups_by_user, submissions):
+    # One-off backfill for data written before the index existed, from (uid, links)
+    # pairs and Submissions. Links in a seller's history whose outcome is unknown
+    # count as "closed" (taken for everyone).
+    links = {}
+    for uid, groups in groups_by_user:
+        for link in groups:
+            links.setdefault(canonical_link(link), LinkEntry(owner=uid, status=GroupStatus.CLOSED))
+    for sub in submissions:
+        for link in sub.links:
+            links[canonical_link(link)] = LinkEntry(owner=sub.seller_id, status=sub.status)
+    return links
+# ------------------------
+# Submissions: the links a seller sent in one go, reviewed, priced and sold as a
+# unit under a compact numeric id that admin buttons carry.
+# ------------------------
+SUBMISSION_STATUSES = (GroupStatus.PENDING, GroupStatus.WAITING_COUNT, GroupStatus.WAITING_TARGET)
+SUBMISSION_DROP_STATUSES = (GroupStatus.REJECTED, GroupStatus.EXPIRED) # Setting one of these removes the submission
+def new_submission(sub_id, uid: int, links, year: str, sell_type: str, time: str):
+    return Submission(id=sub_id, seller_id=uid, links=list(links), year=year, type=sell_type, time=time)
+def build_submissions(pending_groups: dict):
+    # One-off conversion of the old per-link "seller:link" records: links a seller
+    # submitted together (same time, year and type) become one submission, without an id yet
+    subs = {}
+    for info in pending_groups.values():
+        batch = (info["seller_id"], info.get("time"), info.get("year"), info.get("type"))
+        if batch not in subs:
+            sub = subs[batch] = new_submission(None, int(info["seller_id"]), [], info.get("year"), info.get("type") or "single", info.get("time"))
+            sub.status = GroupStatus(info["status"])
+            sub.approved_count = info.get("approved_count")
+            sub.ownership_status = OwnershipStatus(info.get("ownership_status") or "none")
+            sub.ownership_target_id = info.get("ownership_target_id")
+        subs[batch].links.append(info["link"])
+    return list(subs.values())
+def submission_links_status(d, sub, status: GroupStatus):
+    for link in sub.links:
+        set_link_status(d, link, status)
+# ------------------------
+# Withdrawals: one ledger record per request under its own id, listed per user in
+# User.withdrawals. The amount leaves the balance when the request is opened and
+# comes back only if it is rejected, so pending requests can never overdraw.
+# ------------------------
+def new_withdrawal(wid, uid: int, method: str, address: str, amount: float, time: str, status: WithdrawalStatus = WithdrawalStatus.PENDING):
+    return Withdrawal(id=wid, uid=uid, method=method, address=address, amount=amount, status=status, time=time)
+def build_withdrawals(d):
+    # One-off conversion of the per-user withdraw_history lists and the one-per-user
+    # pending_withdrawals map, on the snapshot's user dicts. A pending request is matched
+    # to its history entry and reserved now; "Pending" entries a later request overwrote
+    # are marked "Superseded".
+    pending = d.pop("pending_withdrawals", {})
+    recs = []
+    for s_uid, u in d["users"].items():
+        hist = u.pop("withdraw_history", [])
+        u["withdrawals"] = []
+        wd = pending.get(s_uid)
+        open_rec = None
+        if wd is not None:
+            open_rec = next((h for h in reversed(hist) if h.get("status") == "Pending" and h.get("amount") == wd["amount"] and h.get("method") == wd["method"]), None)
+            if open_rec is None:
+                open_rec = dict(wd, status="Pending")
+                hist.append(open_rec)
+            u["balance"] = u.get("balance", 0.0) - float(wd["amount"])
+        for h in hist:
+            status = WithdrawalStatus(h.get("status") or "Pending")
+            if status == WithdrawalStatus.PENDING and h is not open_rec:
+                status = WithdrawalStatus.SUPERSEDED
+            recs.append((s_uid, new_withdrawal(None, int(s_uid), h.get("method"), h.get("address"), h.get("amount"), h.get("time"), status)))
+    recs.sort(key=lambda rec: rec[1].time or "")
+    withdrawals = {}
+    for seq, (s_uid, wd) in enumerate(recs, 1):
+        wd.id = str(seq)
+        withdrawals[wd.id] = wd
+        d["users"][s_uid]["withdrawals"].append(wd.id)
+    return withdrawals, len(recs)
+def decode_snapshot(d):
+    # data.json dicts -> records, converting layouts written by older versions on the way
+    if "submissions" in d:
+        subs = [Submission.from_json(sub) for sub in d["submissions"].values()]
+    else:
+        subs = build_submissions(d.pop("pending_groups", {}))
+        for n, sub in enumerate(subs, 1):
+            sub.id = str(n)
+        d["submission_seq"] = len(subs)
+    d["submissions"] = {sub.id: sub for sub in subs}
+    if "withdrawals" in d:
+        d["withdrawals"] = {wid: Withdrawal.from_json(wd) for wid, wd in d["withdrawals"].items()}
+    else:
+        d["withdrawals"], d["withdrawal_seq"] = build_withdrawals(d)
+    d["users"] = {int(s_uid): User.from_json(u) for s_uid, u in d["users"].items()}
+    for u in d["users"].values():
+        if u.groups is None:
+            u.groups = []
+    d["pending_requests"] = {msg_id: PendingRequest.from_json(req) for msg_id, req in d["pending_requests"].items()}
+    if "links" in d:
+        d["links"] = {link: LinkEntry.from_json(entry) for link, entry in d["links"].items()}
+    else:
+        d["links"] = build_link_index(((uid, u.groups) for uid, u in d["users"].items()), d["submissions"].values())
+    d.setdefault("meta", {})
+    d.setdefault("outbox", {})
+    d.setdefault("digest", {})
+    d.setdefault("user_data", {})
+    d.setdefault("conversations", {})
+# ------------------------
+# Journal operations: every state change is one typed op, applied to the
+# in-memory data and appended to the journal. Replaying snapshot + journal
+# rebuilds exactly the acknowledged state.
+# ------------------------
+def apply_user_created(d, op):
+    uid = int(op["uid"])
+    if uid not in d["users"]:
+        d["users"][uid] = new_user_record(op["time"])
+        stats_user_created(d["stats"], op["time"])
+def apply_balance_credited(d, op):
+    d["users"][int(op["uid"])].balance += op["amount"]
+def apply_groups_submitted(d, op):
+    uid = int(op["uid"])
+    u = d["users"][uid]
+    sub_id = op.get("id") or str(d["submission_seq"] + 1)
+    d["submission_seq"] = max(d["submission_seq"], int(sub_id))
+    d["submissions"][sub_id] = new_submission(sub_id, uid, op["links"], op["year"], op["type"], op["time"])
+    for link in op["links"]:
+        if link not in u.groups: # Prevent duplicates
+            u.groups.append(link)
+        d["links"][canonical_link(link)] = LinkEntry(owner=uid, status=GroupStatus.PENDING)
+def apply_group_status(d, op):
+    status = GroupStatus(op["status"])
+    sub = d["submissions"].get(op["id"])
+    if sub is None:
+        return
+    submission_links_status(d, sub, status)
+    if status in SUBMISSION_DROP_STATUSES:
+        d["submissions"].pop(op["id"])
+        return
+    sub.status = status
+    if "approved_count" in op:
+        sub.approved_count = op["approved_count"]
+    if "time" in op:
+        sub.changed = op["time"]
+def apply_groups_moderated(d, op):
+    # Bulk approve/reject: many group_status changes plus the sellers' notifications in one op
+    for decision in op["decisions"]:
+        apply_group_status(d, decision)
+    for entry in op["entries"]:
+        d["outbox"][entry["id"]] = entry
+def apply_ownership_changed(d, op):
+    sub = d["submissions"].get(op["id"])
+    if sub is None:
+        return
+    sub.ownership_status = OwnershipStatus(op["ownership_status"])
+    if "target" in op:
+        sub.ownership_target_id = op["target"]
+    if "time" in op:
+        sub.changed = op["time"]
+def apply_groups_sold(d, op):
+    u = d["users"][int(op["uid"])]
+    sub = d["submissions"].pop(op["id"], None)
+    if sub is not None:
+        submission_links_status(d, sub, GroupStatus.SOLD)
+    u.sales += op["count"]
+    u.balance += op["amount"]
+    stats_groups_sold(d["stats"], op["count"], op["time"])
+def apply_withdrawal_opened(d, op):
+    uid = int(op["uid"])
+    u = d["users"][uid]
+    wid = op["id"]
+    d["withdrawal_seq"] = max(d["withdrawal_seq"], int(wid))
+    d["withdrawals"][wid] = new_withdrawal(wid, uid, op["method"], op["address"], op["amount"], op["time"])
+    u.withdrawals.append(wid)
+    u.balance -= float(op["amount"])
+def apply_withdrawal_closed(d, op):
+    wd = d["withdrawals"].get(op["id"])
+    if wd is None or wd.status != WithdrawalStatus.PENDING:
+        return
+    wd.status = WithdrawalStatus(op["status"])
+    if wd.status == WithdrawalStatus.APPROVED:
+        stats_withdrawal_approved(d["stats"], float(wd.amount), op["time"])
+    else:
+        d["users"][wd.uid].balance += float(wd.amount)
+def apply_request_opened(d, op):
+    d["pending_requests"][op["msg_id"]] = PendingRequest(type=op["type"], seller_id=int(op["seller_id"]), submission_id=op.get("submission_id"), time=op["time"])
+def apply_request_closed(d, op):
+    d["pending_requests"].pop(op["msg_id"], None)
+def apply_prices_set(d, op):
+    if op["uid"] is None:
+        d["global_prices"] = op["prices"]
+    else:
+        d["users"][int(op["uid"])].custom_prices = op["prices"] or None
+def apply_sell_toggled(d, op):
+    d["sell_enabled"] = op["enabled"]
+def apply_meta_set(d, op):
+    d["meta"][op["key"]] = op["value"]
+def apply_outbox_added(d, op):
+    d["outbox"][op["entry"]["id"]] = op["entry"]
+def apply_outbox_removed(d, op):
+    d["outbox"].pop(op["id"], None)
+def apply_digest_added(d, op):
+    d["digest"][op["entry"]["id"]] = op["entry"]
+def apply_digest_flushed(d, op):
+    # The collected posts leave the digest and its messages enter the outbox in one op
+    for entry_id in op["ids"]:
+        d["digest"].pop(entry_id, None)
+    for entry in op["entries"]:
+        d["outbox"][entry["id"]] = entry
+def apply_user_data_set(d, op):
+    if op["data"]:
+        d["user_data"][str(op["uid"])] = op["data"]
+    else:
+        d["user_data"].pop(str(op["uid"]), None)
+def apply_conversation_set(d, op):
+    conversations = d["conversations"].setdefault(op["name"], {})
+    key = json.dumps(op["key"])
+    if op["state"] is None:
+        conversations.pop(key, None)
+    else:
+        conversations[key] = [op["state"], op["time"]]
+OP_APPLIERS = {
+    "user_created": apply_user_created,
+    "balance_credited": apply_balance_credited,
+    "groups_submitted": apply_groups_submitted,
+    "group_status": apply_group_status,
+    "groups_moderated": apply_groups_moderated,
+    "ownership_changed": apply_ownership_changed,
+    "groups_sold": apply_groups_sold,
+    "withdrawal_opened": apply_withdrawal_opened,
+    "withdrawal_closed": apply_withdrawal_closed,
+    "request_opened": apply_request_opened,
+    "request_closed": apply_request_closed,
+    "prices_set": apply_prices_set,
+    "sell_toggled": apply_sell_toggled,
+    "meta_set": apply_meta_set,
+    "outbox_added": apply_outbox_added,
+    "outbox_removed": apply_outbox_removed,
+    "digest_added": apply_digest_added,
+    "digest_flushed": apply_digest_flushed,
+    "user_data_set": apply_user_data_set,
+    "conversation_set": apply_conversation_set,
+}
+def submissions_touched(op):
+    # Submission ids whose seller/status an op may change (used to keep indexes in step)
+    if op["op"] in ("groups_submitted", "group_status", "groups_sold"):
+        return [op["id"]]
+    if op["op"] == "groups_moderated":
+        return [decision["id"] for decision in op["decisions"]]
+    return ()
+def records_touched(d, op):
+    # (section, key) of the users, withdrawals and links an op changes in place, see FrozenData
+    kind = op["op"]
+    if kind in ("balance_credited", "withdrawal_opened") or kind == "prices_set" and op["uid"] is not None:
+        return [("users", int(op["uid"]))]
+    if kind == "groups_submitted":
+        return [("users", int(op["uid"]))] + [("links", canonical_link(link)) for link in op["links"]]
+    if kind in ("group_status", "groups_sold", "groups_moderated"):
+        ids = [decision["id"] for decision in op["decisions"]] if kind == "groups_moderated" else [op["id"]]
+        touched = [("links", canonical_link(link)) for sub_id in ids if sub_id in d["submissions"] for link in d["submissions"][sub_id].links]
+        if kind == "groups_sold":
+            touched.append(("users", int(op["uid"])))
+        return touched
+    if kind == "withdrawal_closed":
+        wd = d["withdrawals"].get(op["id"])
+        return [("withdrawals", op["id"]), ("users", wd.uid)] if wd is not None else ()
+    return ()
+def apply_op(d, op):
+    OP_APPLIERS[op["op"]](d, op)
+    d["journal_seq"] = op["seq"]
+def read_json_snapshot(path: Path):
+    d = json.loads(path.read_text(encoding="utf8"))
+    d.setdefault("journal_seq", 0)
+    if "stats" not in d:
+        d["stats"] = build_stats(d)
+    decode_snapshot(d)
+    return d
+# ------------------------
+# Binary snapshot (data.snap): the same data as data.json, but users, withdrawals and links
+# are stored one JSON record per byte range behind an offset index, so a restart reads
+# only the rest of the data and each of those records is decoded when first used.
+#   header: magic, offset and length of the JSON head
+#   records: one section after another, in dict order
+#   offsets: per section, n + 1 little-endian u64s; record i is bytes [offsets[i], offsets[i + 1])
+#   head: {"data": everything else, "hints": see scan_hints, "sections": {name: {"keys": [...], "at": offset of its offsets}}}
+# ------------------------
+SNAPSHOT_MAGIC = b"MKTSNAP1"
+SNAPSHOT_HEADER = struct.Struct("<8sQQ")
+LAZY_SECTIONS = {"users": User, "withdrawals": Withdrawal, "links": LinkEntry}
+def scan_hints(users, withdrawals, hot_items: int):
+    # What JsonStore would otherwise scan every record for at startup, from (id, record) pairs
+    return {
+        "hot_items": hot_items,
+        "sellers": [(uid, u.sales) for uid, u in users if u.sales > 0],
+        "pending_withdrawals": [wid for wid, wd in withdrawals if wd.status == WithdrawalStatus.PENDING],
+        "archive_due": [uid for uid, u in users if max(len(u.groups), len(u.withdrawals)) > hot_items],
+    }
+class SnapshotFile:
+    def __init__(self, path: Path):
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.head_at, self.head_len = SNAPSHOT_HEADER.unpack_from(self.map)
+        if magic != SNAPSHOT_MAGIC:
+            self.map.close()
+            raise ValueError(f"{path.name} is not a binary snapshot")
+    def head(self):
+        return json.loads(self.map[self.head_at:self.head_at + self.head_len])
+    def offsets(self, at: int, count: int):
+        offsets = array.array("Q")
+        offsets.frombytes(self.map[at:at + 8 * (count + 1)])
+        if sys.byteorder != "little":
+            offsets.byteswap()
+        return offsets
+    def close(self):
+        self.map.close()
+# One snapshot section as a dict of records. Every key is known from the start, in the
+# original order; the value is the record's index into the offsets until it is first read.
+class LazyRecords(collections.abc.MutableMapping):
+    def __init__(self, cls, snapshot: SnapshotFile, keys, offsets):
+        self.cls = cls
+        self.snapshot = snapshot
+        self.offsets = offsets
+        self.slots = dict(zip(keys, range(len(keys))))
+    def _decode(self, key, index: int):
+        record = self.slots[key] = self.cls.from_json(json.loads(self.snapshot.map[self.offsets[index]:self.offsets[index + 1]]))
+        return record
+    def __getitem__(self, key):
+        value = self.slots[key]
+        return self._decode(key, value) if type(value) is int else value
+    def get(self, key, default=None):
+        value = self.slots.get(key)
+        if value is None:
+            return default
+        return self._decode(key, value) if type(value) is int else value
+    def __setitem__(self, key, record):
+        self.slots[key] = record
+    def __delitem__(self, key):
+        del self.slots[key]
+    def __contains__(self, key):
+        return key in self.slots
+    def __iter__(self):
+        return iter(self.slots)
+    def __len__(self):
+        return len(self.slots)
+    def decoded(self):
+        return [(key, value) for key, value in self.slots.items() if type(value) is not int]
+    def rebase(self, snapshot: SnapshotFile, offsets, keys, copied):
+        # After a new snapshot was written: records still undecoded now live at their new index
+        for index in copied:
+            if type(self.slots.get(keys[index])) is int:
+                self.slots[keys[index]] = index
+        self.snapshot, self.offsets = snapshot, offsets
+def read_binary_snapshot(path: Path):
+    # -> (data as decode_snapshot leaves it, with LazyRecords sections; hints; the open SnapshotFile)
+    snapshot = SnapshotFile(path)
     try:
-        if not DATA_PATH.exists():
-            return {
-                "users": {}, # user_id -> {"balance": float, "groups": [links], "sales": int, "custom_prices": {}, "start_time": str}
-                "pending_groups": {}, # user_id:link -> {"link":..., "time":..., "year":..., "approved_count": int}
-                "pending_withdrawals": {}, # user_id -> {"method":..., "address":..., "amount":..., "time":...}
-                "pending_requests": {}, # message_id -> {"type": "count"|"buyer", "seller_id": str, "time": str}
-                "sell_enabled": True, # Global sell toggle
-                "global_prices": DEFAULT_PRICES # Global prices
+        head = snapshot.head()
+        d = head["data"]
+        d["submissions"] = {sub_id: Submission.from_json(sub) for sub_id, sub in d["submissions"].items()}
+        d["pending_requests"] = {msg_id: PendingRequest.from_json(req) for msg_id, req in d["pending_requests"].items()}
+        for name, cls in LAZY_SECTIONS.items():
+            section = head["sections"][name]
+            d[name] = LazyRecords(cls, snapshot, section["keys"], snapshot.offsets(section["at"], len(section["keys"])))
+    except Exception:
+        snapshot.close()
+        raise
+    return d, head["hints"], snapshot
+# The data at one journal_seq, for encoding a snapshot in a worker thread while ops keep
+# being applied on the loop. Freezing is cheap: the small sections are encoded at once and
+# the lazy ones are shallow copies of their dicts. Records are changed in place, so before
+# an op changes one, keep() encodes it as it was, and the encoder takes that instead.
+class FrozenData:
+    def __init__(self, d, hints=None):
+        self.data_json = json.dumps({key: value for key, value in d.items() if key not in LAZY_SECTIONS}, ensure_ascii=False, default=json_default)
+        self.hints = hints
+        self.sections = []
+        for name in LAZY_SECTIONS:
+            section = d[name]
+            lazy = isinstance(section, LazyRecords)
+            self.sections.append((name, dict(section.slots if lazy else section), section.offsets if lazy else None, section.snapshot if lazy else None))
+        self.kept = {name: {} for name in LAZY_SECTIONS}
+        self.lock = threading.Lock()
+    def keep(self, d, touched):
+        # On the loop, with (section, key) pairs of the records an op is about to change
+        with self.lock:
+            for name, key in touched:
+                kept = self.kept[name]
+                if key not in kept:
+                    record = d[name].get(key)
+                    kept[key] = None if record is None else json.dumps(record, ensure_ascii=False, default=json_default)
+    def records(self, name, slots, batch: int = 256):
+        # -> (key, JSON text, or the index of a record never decoded), as of journal_seq. The
+        # lock is held per batch, so an op waits for at most one batch to be encoded.
+        kept = self.kept[name]
+        items = iter(slots.items())
+        while True:
+            with self.lock:
+                encoded = [
+                    (key, kept[key] if key in kept else value if type(value) is int else json.dumps(value, ensure_ascii=False, default=json_default))
+                    for key, value in itertools.islice(items, batch)
+                ]
+            if not encoded:
+                return
+            yield from encoded
+def encode_json_snapshot(frozen: FrozenData):
+    # data.json's text; json.dumps would give the same data
+    items = [frozen.data_json[1:-1]] if frozen.data_json != "{}" else []
+    for name, slots, _, _ in frozen.sections:
+        records = ", ".join(f"{json.dumps(str(key), ensure_ascii=False)}: {text}" for key, text in frozen.records(name, slots))
+        items.append(f"{json.dumps(name)}: {{{records}}}")
+    return "{" + ", ".join(items) + "}"
+def encode_binary_snapshot(frozen: FrozenData):
+    # Records read since the snapshot was loaded are encoded; the ones never decoded become
+    # byte ranges of the file they were loaded from, merged where adjacent, which
+    # write_binary_snapshot copies.
+    sections = []
+    pos = SNAPSHOT_HEADER.size
+    for name, slots, offsets, source in frozen.sections:
+        keys, starts, pieces, copied = list(slots), array.array("Q"), [], []
+        for index, (key, value) in enumerate(frozen.records(name, slots)):
+            starts.append(pos)
+            if type(value) is int:
+                start, end = offsets[value], offsets[value + 1]
+                if pieces and type(pieces[-1]) is list and pieces[-1][1] == start:
+                    pieces[-1][1] = end
+                else:
+                    pieces.append([start, end])
+                copied.append(index)
+                pos += end - start
+            else:
+                piece = value.encode("utf8")
+                pieces.append(piece)
+                pos += len(piece)
+        starts.append(pos)
+        sections.append((name, keys, starts, pieces, source, copied))
+    return frozen.data_json, json.dumps(frozen.hints), sections
+def write_binary_snapshot(path: Path, payload):
+    # Temp file and rename, as write_atomic does for data.json; returns the size written
+    data_json, hints_json, sections = payload
+    tmp = path.with_name(path.name + ".tmp")
+    index = {}
+    with open(tmp, "wb") as f:
+        f.write(bytes(SNAPSHOT_HEADER.size))
+        for name, keys, starts, pieces, source, _ in sections:
+            for piece in pieces:
+                if type(piece) is bytes:
+                    f.write(piece)
+                else:
+                    with memoryview(source.map) as view:
+                        f.write(view[piece[0]:piece[1]])
+        for name, keys, starts, pieces, source, _ in sections:
+            index[name] = {"keys": keys, "at": f.tell()}
+            if sys.byteorder != "little":
+                starts = array.array("Q", starts)
+                starts.byteswap()
+            f.write(starts.tobytes())
+        head_at = f.tell()
+        head = f'{{"data": {data_json}, "hints": {hints_json}, "sections": {json.dumps(index, ensure_ascii=False)}}}'.encode("utf8")
+        f.write(head)
+        f.seek(0)
+        f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, head_at, len(head)))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    return head_at + len(head)
+# Owns data.json (the snapshot) and the journal segments (data.journal.N).
+# Ops are appended to the active segment as one JSON line each, so a write costs
+# O(size of the change). A background compactor rotates to a new segment, writes
+# a snapshot from a worker thread and then drops the segments it folded in.
+# With snapshot_format "binary" the snapshot is data.snap instead; writing either
+# one removes the other, and load reads whichever exists.
+class PersistenceManager:
+    def __init__(self, path: Path, compact_ops: int, compact_seconds: float, fsync: bool, snapshot_format: str = "json"):
+        self.path = path
+        self.binary_path = path.with_suffix(".snap")
+        self.snapshot_format = snapshot_format
+        self.snapshot = None # SnapshotFile the data's lazy sections read from
+        self.hints = None # The binary snapshot's hints, for JsonStore's startup
+        self.compact_ops = compact_ops
+        self.compact_seconds = compact_seconds
+        self.fsync = fsync
+        self.data_obj = None
+        self.ops_since_compact = 0
+        self._segment = 0
+        self._journal = None
+        self._task = None
+        self._closing = False
+        self._wake = asyncio.Event()
+        self._compact_lock = asyncio.Lock()
+        self.frozen = None # FrozenData while a snapshot is encoded, see keep()
+        self.prepare_snapshot = None # Optional coroutine function run before each snapshot is encoded
+        self.snapshot_hints = None # Optional function -> hints for a binary snapshot (scanned from the records otherwise)
+    def segments(self):
+        found = []
+        for p in self.path.parent.glob(self.path.stem + ".journal.*"):
+            suffix = p.name.rsplit(".", 1)[-1]
+            if suffix.isdigit():
+                found.append((int(suffix), p))
+        return sorted(found)
+    def segment_path(self, n: int):
+        return self.path.with_name(f"{self.path.stem}.journal.{n}")
+    def read_snapshot(self):
+        paths = (self.binary_path, self.path) if self.snapshot_format == "binary" else (self.path, self.binary_path)
+        path = next((p for p in paths if p.exists()), None)
+        try:
+            if path == self.binary_path:
+                d, self.hints, self.snapshot = read_binary_snapshot(path)
+                return d
+            if path == self.path:
+                return read_json_snapshot(path)
+        except (ValueError, KeyError, struct.error):
+            logger.error(f"Corrupted {path.name}. Initializing new data structure.")
+        d = empty_data()
+        decode_snapshot(d)
+        return d
+    def load(self):
+        d = self.read_snapshot()
+        replayed = 0
+        segments = self.segments()
+        for n, seg in segments:
+            with open(seg, encoding="utf8") as f:
+                for line in f:
+                    try:
+                        op = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Torn tail of a write that was never acknowledged
+                        logger.warning(f"Skipping unreadable journal entry in {seg.name}")
+                        continue
+                    if op["seq"] <= d["journal_seq"]:
+                        continue # Already folded into the snapshot
+                    apply_op(d, op)
+                    replayed += 1
+        # Always append to a fresh segment so a torn tail is never followed by good entries
+        self._segment = segments[-1][0] + 1 if segments else 1
+        self.ops_since_compact = replayed
+        self.data_obj = d
+        if replayed:
+            logger.info(f"Replayed {replayed} journal op(s) on top of {(self.path if self.snapshot is None else self.binary_path).name}")
+        return d
+    def append(self, op):
+        if self._journal is None:
+            self._journal = open(self.segment_path(self._segment), "a", encoding="utf8")
+        start = time.perf_counter()
+        line = json.dumps(op, ensure_ascii=False) + "\n"
+        self._journal.write(line)
+        self._journal.flush()
+        if self.fsync:
+            os.fsync(self._journal.fileno())
+        metrics.observe("bot_journal_append_seconds", time.perf_counter() - start)
+        metrics.observe("bot_journal_append_bytes", len(line))
+        self.ops_since_compact += 1
+        if self.ops_since_compact >= self.compact_ops:
+            self._wake.set()
+    def keep(self, op):
+        # Called before an op is applied: while a snapshot is being encoded, the records the
+        # op changes are kept for it as they were at its journal_seq
+        if self.frozen is not None:
+            self.frozen.keep(self.data_obj, records_touched(self.data_obj, op))
+    def _rotate(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        self._segment += 1
+    async def compact(self):
+        async with self._compact_lock:
+            if self.ops_since_compact == 0:
+                return
+            start = time.perf_counter()
+            if self.prepare_snapshot is not None:
+                await self.prepare_snapshot()
+            folded = [p for n, p in self.segments() if n <= self._segment]
+            self._rotate()
+            # Freeze the data at journal_seq on the loop, then encode and write it from a worker
+            # thread while new ops go to the new segment
+            binary = self.snapshot_format == "binary"
+            if binary:
+                hints = self.snapshot_hints() if self.snapshot_hints else scan_hints(self.data_obj["users"].items(), self.data_obj["withdrawals"].items(), USER_HOT_ITEMS)
+            else:
+                self._decode_all()
+                hints = None
+            self.frozen = FrozenData(self.data_obj, hints)
+            pending = self.ops_since_compact
+            self.ops_since_compact = 0
+            try:
+                size, payload = await asyncio.to_thread(self._write_snapshot, self.frozen, binary, folded)
+            except Exception as e:
+                self.ops_since_compact += pending
+                logger.error(f"Failed to compact journal into {(self.binary_path if binary else self.path).name}: {e}")
+                return
+            finally:
+                self.frozen = None
+            if binary:
+                self._reopen_snapshot(payload)
+            metrics.observe("bot_snapshot_seconds", time.perf_counter() - start)
+            metrics.observe("bot_snapshot_bytes", size)
+    def _write_snapshot(self, frozen: FrozenData, binary: bool, folded):
+        # -> (size written, the binary payload for _reopen_snapshot)
+        if binary:
+            payload = encode_binary_snapshot(frozen)
+            size = write_binary_snapshot(self.binary_path, payload)
+            self.path.unlink(missing_ok=True)
+        else:
+            payload = encode_json_snapshot(frozen)
+            write_atomic(self.path, payload)
+            self.binary_path.unlink(missing_ok=True)
+            size = len(payload)
+        for seg in folded:
+            seg.unlink(missing_ok=True)
+        return size, payload
+    def _decode_all(self):
+        # Writing data.json after loading data.snap (the format was switched back): decode every record once
+        if self.snapshot is None:
+            return
+        for name in LAZY_SECTIONS:
+            if isinstance(self.data_obj[name], LazyRecords):
+                self.data_obj[name] = dict(self.data_obj[name].items())
+        self.snapshot.close()
+        self.snapshot = None
+    def _reopen_snapshot(self, payload):
+        # Point the lazy sections at the file just written, then let the old one go
+        old, self.snapshot = self.snapshot, SnapshotFile(self.binary_path)
+        for name, keys, starts, pieces, source, copied in payload[2]:
+            if isinstance(self.data_obj[name], LazyRecords):
+                self.data_obj[name].rebase(self.snapshot, starts, keys, copied)
+        if old is not None:
+            old.close()
+    async def run(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.compact_seconds)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            await self.compact()
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self.run())
+    async def close(self):
+        # Called on shutdown: stop the compactor and fold everything into data.json for a fast restart
+        self._closing = True
+        self._wake.set()
+        if self._task is not None:
+            await self._task
+        await self.compact()
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        if self.snapshot is not None:
+            self.snapshot.close()
+            self.snapshot = None
+# Append-only file (data.archive) for records moved out of the in-memory data. Each line is
+# one JSON record holding the offset of the previous record of its chain, so an archived
+# history is read newest first by following offsets through a read-only mmap, and only
+# the records actually shown are touched. Records are only ever added: a chain head that
+# no snapshot references (a crash after appending) is simply never reached.
+class Archive:
+    def __init__(self, path: Path, fsync: bool):
+        self.path = path
+        self.fsync = fsync
+        self.size = path.stat().st_size if path.exists() else 0
+        self._map = None
+    def append(self, payload: bytes):
+        # Written at self.size so the bytes of a failed earlier append are overwritten
+        with open(self.path, "r+b" if self.path.exists() else "wb") as f:
+            f.seek(self.size)
+            f.write(payload)
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        self.size += len(payload)
+    def read(self, offset: int):
+        if self._map is None or offset >= len(self._map):
+            self.close()
+            with open(self.path, "rb") as f:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return json.loads(self._map[offset:self._map.find(b"\n", offset)])
+    def chain(self, offset: int):
+        while offset >= 0:
+            rec = self.read(offset)
+            yield rec
+            offset = rec["prev"]
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+# ------------------------
+# Storage backends: handlers talk to `store` only, never to the raw data dict.
+# ------------------------
+class Store:
+    # User ids are ints; get_user, get_submission, get_withdrawal, get_request and
+    # link_entry return User, Submission, Withdrawal, PendingRequest and LinkEntry records
+    def start(self):
+        pass
+    async def close(self):
+        pass
+    # Users
+    def get_user(self, uid: int):
+        raise NotImplementedError
+    def create_user(self, uid: int, time: str):
+        raise NotImplementedError
+    def iter_users(self):
+        raise NotImplementedError
+    def user_ids_page(self, cursor, limit: int):
+        raise NotImplementedError # -> (user ids, next cursor); cursor None starts from the first user
+    def stats(self) -> dict:
+        raise NotImplementedError
+    def top_sellers(self, limit: int):
+        raise NotImplementedError # [(uid, sales)] by sales, descending
+    def credit(self, uid: int, amount: float):
+        raise NotImplementedError
+    def group_count(self, uid: int) -> int:
+        raise NotImplementedError
+    def set_prices(self, uid, prices: dict):
+        raise NotImplementedError # uid None sets the global prices
+    def global_prices(self) -> dict:
+        raise NotImplementedError
+    def sell_enabled(self) -> bool:
+        raise NotImplementedError
+    def set_sell_enabled(self, enabled: bool):
+        raise NotImplementedError
+    def get_meta(self, key: str):
+        raise NotImplementedError
+    def set_meta(self, key: str, value):
+        raise NotImplementedError
+    # Outbound notification queue
+    def outbox_add(self, entry: dict):
+        raise NotImplementedError
+    def outbox_remove(self, entry_id: str):
+        raise NotImplementedError
+    def outbox_entries(self):
+        raise NotImplementedError # In enqueue order
+    # Channel posts waiting for a digest (see ChannelDigest)
+    def digest_add(self, entry: dict):
+        raise NotImplementedError
+    def digest_entries(self):
+        raise NotImplementedError # In add order
+    def digest_flush(self, ids, entries):
+        raise NotImplementedError # drops the posts and adds the digest messages to the outbox, atomically
+    # Conversation state of half-finished flows (see StorePersistence)
+    def all_user_data(self) -> dict:
+        raise NotImplementedError # user_id -> user_data dict
+    def set_user_data(self, uid: int, data: dict):
+        raise NotImplementedError # empty data drops the entry
+    def conversations(self, name: str) -> dict:
+        raise NotImplementedError # conversation key (tuple) -> (state, time of last change)
+    def conversation(self, name: str, key: tuple):
+        raise NotImplementedError # (state, time of last change) or None
+    def set_conversation(self, name: str, key: tuple, state, time: str):
+        raise NotImplementedError # state None ends the conversation
+    # Submissions
+    def link_entry(self, link: str):
+        raise NotImplementedError # canonical link -> LinkEntry or None
+    def submit_groups(self, uid: int, links, year: str, sell_type: str, time: str) -> str:
+        raise NotImplementedError # -> id of the new submission
+    def get_submission(self, sub_id: str):
+        raise NotImplementedError
+    def submissions(self, seller_id=None, statuses=None) -> dict:
+        raise NotImplementedError # id -> Submission
+    def set_submission_status(self, sub_id: str, status: GroupStatus, approved_count=None):
+        raise NotImplementedError # REJECTED and EXPIRED drop the submission
+    def moderate_submissions(self, decisions, entries):
+        raise NotImplementedError # [(id, status, approved_count or None)] like set_submission_status, plus outbox entries, atomically
+    def set_ownership(self, sub_id: str, ownership_status: OwnershipStatus, target=None):
+        raise NotImplementedError
+    def sell_submission(self, sub_id: str, count: int, amount: float, time: str):
+        raise NotImplementedError # credits the seller and drops the submission
+    # Withdrawals
+    def get_withdrawal(self, wid: str):
+        raise NotImplementedError
+    def pending_withdrawals(self, uid=None) -> dict:
+        raise NotImplementedError # id -> Withdrawal, oldest first; uid None lists every user's
+    def open_withdrawal(self, uid: int, method: str, address: str, amount: float, time: str):
+        raise NotImplementedError # reserves the amount -> id of the new withdrawal, None if the balance is short
+    def close_withdrawal(self, wid: str, status: WithdrawalStatus, time: str):
+        raise NotImplementedError # REJECTED returns the reserved amount to the balance
+    def withdrawal_history(self, uid: int, before=None, limit: int = 5):
+        raise NotImplementedError # -> (withdrawals newest first, cursor for the next page or None); before None starts at the newest
+    # Admin reply prompts
+    def get_request(self, msg_id: str):
+        raise NotImplementedError
+    def pending_requests(self) -> dict:
+        raise NotImplementedError # message id -> PendingRequest
+    def open_request(self, msg_id: str, req_type: str, seller_id: int, submission_id: str, time: str):
+        raise NotImplementedError
+    def close_request(self, msg_id: str):
+        raise NotImplementedError
+    # Admin review queues
+    def review_page(self, queue: str, cursor: int, limit: int, backward: bool = False):
+        raise NotImplementedError # queue "groups" (pending submissions) or "withdrawals" -> ([(position, id)], has_prev, has_next, total)
+# (position, id) pairs kept sorted for cursor paging. Positions are opaque, increasing ints;
+# a cursor is a position and a page is the entries just after it (or just before it, backwards).
+class SortedIndex:
+    def __init__(self):
+        self.entries = []
+        self.positions = {}
+    def __len__(self):
+        return len(self.entries)
+    def add(self, item_id, position: int):
+        if self.positions.get(item_id) == position:
+            return
+        self.discard(item_id)
+        self.positions[item_id] = position
+        bisect.insort(self.entries, (position, item_id))
+    def discard(self, item_id):
+        position = self.positions.pop(item_id, None)
+        if position is not None:
+            del self.entries[bisect.bisect_left(self.entries, (position, item_id))]
+    def page(self, cursor: int, limit: int, backward: bool = False):
+        if backward:
+            end = bisect.bisect_left(self.entries, cursor, key=lambda e: e[0])
+            start = max(0, end - limit)
+        else:
+            start = bisect.bisect_right(self.entries, cursor, key=lambda e: e[0])
+            end = min(len(self.entries), start + limit)
+        return self.entries[start:end], start > 0, end < len(self.entries)
+# The original data.json layout, kept in memory as records and persisted through the
+# journal. Each user's record stays small: groups and closed withdrawals beyond the newest
+# `hot_items` are moved to the archive when a snapshot is taken, and the user keeps only
+# archived = {"g"|"w": [offset of the newest archived record, count]}. Withdrawals are
+# archived oldest first, so one still pending holds the later ones in memory until it closes.
+class JsonStore(Store):
+    def __init__(self, persistence: PersistenceManager, hot_items: int = USER_HOT_ITEMS):
+        self.persistence = persistence
+        self.data = persistence.load()
+        self.hot_items = hot_items
+        self.archive = Archive(persistence.path.with_name(persistence.path.stem + ".archive"), persistence.fsync)
+        users, withdrawals = self.data["users"], self.data["withdrawals"]
+        hints = persistence.hints
+        if hints is None:
+            hints = scan_hints(users.items(), withdrawals.items(), hot_items)
+        else:
+            # From a binary snapshot, so no record has to be decoded; the ones the journal
+            # replay touched (and so decoded) may have changed since and are scanned on top
+            recent = scan_hints(users.decoded(), withdrawals.decoded(), hot_items)
+            hints = {
+                "hot_items": hot_items,
+                "sellers": hints["sellers"] + recent["sellers"],
+                "pending_withdrawals": sorted({*hints["pending_withdrawals"], *recent["pending_withdrawals"]}, key=int),
+                "archive_due": hints["archive_due"] + recent["archive_due"],
             }
-        return json.loads(DATA_PATH.read_text(encoding="utf8"))
-    except json.JSONDecodeError:
-        logger.error("Corrupted data.json. Initializing new data structure.")
+            if hints["hot_items"] != persistence.hints["hot_items"]:
+                hints["archive_due"] = scan_hints(users.items(), (), hot_items)["archive_due"] # USER_HOT_ITEMS changed
+        self._archive_due = set(hints["archive_due"])
+        persistence.prepare_snapshot = self._archive_cold
+        persistence.snapshot_hints = self._snapshot_hints
+        # Review queues: pending submissions and pending withdrawals, both ordered by id
+        self.review = {"groups": SortedIndex(), "withdrawals": SortedIndex()}
+        self.pending_by_user = {} # uid -> {withdrawal id: None}
+        for wid in hints["pending_withdrawals"]:
+            wd = withdrawals[wid]
+            if wd.status == WithdrawalStatus.PENDING:
+                self._index_withdrawal(wd)
+        # Secondary indexes over submissions: (seller_id, status) -> ids and status -> ids.
+        # Dicts with None values keep submission order and give O(1) add/remove.
+        self.by_seller_status = {}
+        self.by_status = {}
+        for sub_id in self.data["submissions"]:
+            self._index_submission(sub_id)
+        self.seller_sales = dict(hints["sellers"]) # Later pairs win: sales only grow
+        self.user_order = list(users) # Creation order, for cursor paging
+    def _snapshot_hints(self):
         return {
-            "users": {},
-            "pending_groups": {},
-            "pending_withdrawals": {},
-            "pending_requests": {},
-            "sell_enabled": True,
-            "global_prices": DEFAULT_PRICES
+            "hot_items": self.hot_items,
+            "sellers": list(self.seller_sales.items()),
+            "pending_withdrawals": [wid for _, wid in self.review["withdrawals"].entries],
+            "archive_due": list(self._archive_due),
         }
-def save_data(data_obj):
-    try:
-        DATA_PATH.write_text(json.dumps(data_obj, indent=2, ensure_ascii=False), encoding="utf8")
-    except Exception as e:
-        logger.error(f"Failed to save data.json: {e}")
-data = load_data()
+    def _index_withdrawal(self, wd):
+        self.review["withdrawals"].add(wd.id, int(wd.id))
+        self.pending_by_user.setdefault(wd.uid, {})[wd.id] = None
+    def _unindex_withdrawal(self, wd):
+        self.review["withdrawals"].discard(wd.id)
+        bucket = self.pending_by_user.get(wd.uid, {})
+        bucket.pop(wd.id, None)
+        if not bucket:
+            self.pending_by_user.pop(wd.uid, None)
+    def _index_submission(self, sub_id):
+        sub = self.data["submissions"].get(sub_id)
+        if sub is None:
+            return
+        self.by_seller_status.setdefault((sub.seller_id, sub.status), {})[sub_id] = None
+        self.by_status.setdefault(sub.status, {})[sub_id] = None
+        if sub.status == GroupStatus.PENDING:
+            self.review["groups"].add(sub_id, int(sub_id))
+    def _unindex_submission(self, sub_id):
+        sub = self.data["submissions"].get(sub_id)
+        if sub is None:
+            return
+        for index, ikey in ((self.by_seller_status, (sub.seller_id, sub.status)), (self.by_status, sub.status)):
+            bucket = index.get(ikey)
+            if bucket is not None:
+                bucket.pop(sub_id, None)
+                if not bucket:
+                    del index[ikey]
+        self.review["groups"].discard(sub_id)
+    def record(self, op_type: str, **fields):
+        op = {"op": op_type, "seq": self.data["journal_seq"] + 1, **fields}
+        self.persistence.keep(op)
+        touched = submissions_touched(op)
+        for sub_id in touched:
+            self._unindex_submission(sub_id)
+        apply_op(self.data, op)
+        for sub_id in touched:
+            self._index_submission(sub_id)
+        if op_type == "withdrawal_opened":
+            self._index_withdrawal(self.data["withdrawals"][op["id"]])
+        elif op_type == "withdrawal_closed":
+            self._unindex_withdrawal(self.data["withdrawals"][op["id"]])
+        if op_type in ("groups_submitted", "withdrawal_closed"):
+            self._archive_due.add(op["uid"])
+        if op_type == "groups_sold":
+            self.seller_sales[op["uid"]] = self.data["users"][op["uid"]].sales
+        elif op_type == "user_created" and len(self.user_order) < len(self.data["users"]):
+            self.user_order.append(op["uid"])
+        self.persistence.append(op)
+    async def _archive_cold(self):
+        # Run by the compactor before each snapshot. The moved records are never changed
+        # again (closed withdrawals, old links) and the lists only grow at the end, so
+        # they can be encoded, written off the loop and then cut from the front.
+        due, self._archive_due = self._archive_due, set()
+        users, withdrawals = self.data["users"], self.data["withdrawals"]
+        lines, moves = [], []
+        offset = self.archive.size
+        for uid in due:
+            u = users[uid]
+            ids = u.withdrawals
+            n_w = 0
+            while n_w < len(ids) - self.hot_items and withdrawals[ids[n_w]].status != WithdrawalStatus.PENDING:
+                n_w += 1
+            n_g = max(0, len(u.groups) - self.hot_items)
+            if not n_w and not n_g:
+                continue
+            tails = {kind: list(tail) for kind, tail in (u.archived or {}).items()}
+            for kind, items in (("w", [withdrawals[wid] for wid in ids[:n_w]]), ("g", u.groups[:n_g])):
+                tail = tails.setdefault(kind, [-1, 0])
+                for item in items:
+                    line = (json.dumps({"uid": uid, "kind": kind, "prev": tail[0], "item": item}, ensure_ascii=False, default=json_default) + "\n").encode("utf8")
+                    lines.append(line)
+                    tail[0] = offset
+                    tail[1] += 1
+                    offset += len(line)
+            moves.append((uid, n_w, n_g, tails))
+        if not moves:
+            return
+        try:
+            await asyncio.to_thread(self.archive.append, b"".join(lines))
+        except Exception as e:
+            self._archive_due |= due
+            logger.error(f"Failed to append to {self.archive.path.name}: {e}")
+            return
+        for uid, n_w, n_g, tails in moves:
+            u = users[uid]
+            for wid in u.withdrawals[:n_w]:
+                del withdrawals[wid]
+            u.withdrawals = u.withdrawals[n_w:]
+            u.groups = u.groups[n_g:]
+            u.archived = tails
+        logger.info(f"Archived {len(lines)} record(s) of {len(moves)} user(s)")
+    def _archived(self, u, kind):
+        # The user's archived items of one kind, oldest first
+        return [rec["item"] for rec in self.archive.chain((u.archived or {}).get(kind, [-1])[0])][::-1]
+    def full_data(self):
+        # The data with archived groups and withdrawals folded back in, for exporting
+        d = dict(self.data, users={}, withdrawals=dict(self.data["withdrawals"]))
+        for uid, u in self.data["users"].items():
+            old_w = [Withdrawal.from_json(wd) for wd in self._archived(u, "w")]
+            d["withdrawals"].update((wd.id, wd) for wd in old_w)
+            d["users"][uid] = User.from_json(dict(u.to_json(), groups=self._archived(u, "g") + u.groups, withdrawals=[wd.id for wd in old_w] + u.withdrawals, archived=None))
+        return d
+    def start(self):
+        self.persistence.start()
+    async def close(self):
+        await self.persistence.close()
+        self.archive.close()
+    def get_user(self, uid):
+        return self.data["users"].get(uid)
+    def create_user(self, uid, time):
+        if uid not in self.data["users"]:
+            self.record("user_created", uid=uid, time=time)
+    def iter_users(self):
+        return iter(self.data["users"].items())
+    def user_ids_page(self, cursor, limit):
+        start = cursor or 0
+        ids = self.user_order[start:start + limit]
+        return ids, start + len(ids)
+    def stats(self):
+        return self.data["stats"]
+    def top_sellers(self, limit):
+        return heapq.nlargest(limit, self.seller_sales.items(), key=lambda item: item[1])
+    def credit(self, uid, amount):
+        self.record("balance_credited", uid=uid, amount=amount)
+    def group_count(self, uid):
+        u = self.data["users"][uid]
+        return len(u.groups) + (u.archived or {}).get("g", [-1, 0])[1]
+    def set_prices(self, uid, prices):
+        self.record("prices_set", uid=uid, prices=prices)
+    def global_prices(self):
+        return self.data.get("global_prices", DEFAULT_PRICES)
+    def sell_enabled(self):
+        return self.data.get("sell_enabled", True)
+    def set_sell_enabled(self, enabled):
+        self.record("sell_toggled", enabled=enabled)
+    def get_meta(self, key):
+        return self.data["meta"].get(key)
+    def set_meta(self, key, value):
+        self.record("meta_set", key=key, value=value)
+    def outbox_add(self, entry):
+        self.record("outbox_added", entry=entry)
+    def outbox_remove(self, entry_id):
+        self.record("outbox_removed", id=entry_id)
+    def outbox_entries(self):
+        return list(self.data["outbox"].values())
+    def digest_add(self, entry):
+        self.record("digest_added", entry=entry)
+    def digest_entries(self):
+        return list(self.data["digest"].values())
+    def digest_flush(self, ids, entries):
+        self.record("digest_flushed", ids=ids, entries=entries)
+    def all_user_data(self):
+        return {int(uid): copy.deepcopy(data) for uid, data in self.data["user_data"].items()}
+    def set_user_data(self, uid, data):
+        self.record("user_data_set", uid=uid, data=data)
+    def conversations(self, name):
+        return {tuple(json.loads(key)): tuple(entry) for key, entry in self.data["conversations"].get(name, {}).items()}
+    def conversation(self, name, key):
+        entry = self.data["conversations"].get(name, {}).get(json.dumps(list(key)))
+        return tuple(entry) if entry is not None else None
+    def set_conversation(self, name, key, state, time):
+        self.record("conversation_set", name=name, key=list(key), state=state, time=time)
+    def link_entry(self, link):
+        return self.data["links"].get(link)
+    def submit_groups(self, uid, links, year, sell_type, time):
+        sub_id = str(self.data["submission_seq"] + 1)
+        self.record("groups_submitted", id=sub_id, uid=uid, links=list(links), year=year, type=sell_type, time=time)
+        return sub_id
+    def get_submission(self, sub_id):
+        return self.data["submissions"].get(sub_id)
+    def submissions(self, seller_id=None, statuses=None):
+        subs = self.data["submissions"]
+        if seller_id is None and statuses is None:
+            return dict(subs)
+        result = {}
+        for status in statuses or SUBMISSION_STATUSES:
+            bucket = self.by_status.get(status, {}) if seller_id is None else self.by_seller_status.get((seller_id, status), {})
+            for sub_id in bucket:
+                result[sub_id] = subs[sub_id]
+        return result
+    def set_submission_status(self, sub_id, status, approved_count=None):
+        if approved_count is None:
+            self.record("group_status", id=sub_id, status=status, time=now())
+        else:
+            self.record("group_status", id=sub_id, status=status, approved_count=approved_count, time=now())
+    def moderate_submissions(self, decisions, entries):
+        ops = []
+        for sub_id, status, approved_count in decisions:
+            decision = {"id": sub_id, "status": status, "time": now()}
+            if approved_count is not None:
+                decision["approved_count"] = approved_count
+            ops.append(decision)
+        self.record("groups_moderated", decisions=ops, entries=entries)
+    def set_ownership(self, sub_id, ownership_status, target=None):
+        if target is None:
+            self.record("ownership_changed", id=sub_id, ownership_status=ownership_status, time=now())
+        else:
+            self.record("ownership_changed", id=sub_id, ownership_status=ownership_status, target=target, time=now())
+    def sell_submission(self, sub_id, count, amount, time):
+        sub = self.data["submissions"].get(sub_id)
+        if sub is not None:
+            self.record("groups_sold", id=sub_id, uid=sub.seller_id, count=count, amount=amount, time=time)
+    def get_withdrawal(self, wid):
+        return self.data["withdrawals"].get(wid)
+    def pending_withdrawals(self, uid=None):
+        ids = (wid for _, wid in self.review["withdrawals"].entries) if uid is None else self.pending_by_user.get(uid, ())
+        return {wid: self.data["withdrawals"][wid] for wid in ids}
+    def open_withdrawal(self, uid, method, address, amount, time):
+        if amount > self.data["users"][uid].balance:
+            return None
+        wid = str(self.data["withdrawal_seq"] + 1)
+        self.record("withdrawal_opened", id=wid, uid=uid, method=method, address=address, amount=amount, time=time)
+        return wid
+    def close_withdrawal(self, wid, status, time):
+        wd = self.data["withdrawals"].get(wid)
+        if wd is not None and wd.status == WithdrawalStatus.PENDING:
+            self.record("withdrawal_closed", id=wid, uid=wd.uid, status=status, time=time)
+    def withdrawal_history(self, uid, before=None, limit=5):
+        # Newest first from the in-memory ids, then along the archive chain; a cursor is
+        # the id of the last withdrawal shown, or "@<offset>" once inside the archive
+        u = self.data["users"][uid]
+        ids = u.withdrawals
+        if before is not None and before.startswith("@"):
+            wds, offset, below = [], int(before[1:]), None
+        else:
+            end = len(ids) if before is None else bisect.bisect_left(ids, int(before), key=int)
+            start = max(0, end - limit)
+            wds = [self.data["withdrawals"][wid] for wid in reversed(ids[start:end])]
+            if start > 0:
+                return wds, wds[-1].id
+            offset, below = (u.archived or {}).get("w", [-1])[0], before
+        while len(wds) < limit and offset >= 0:
+            rec = self.archive.read(offset)
+            offset = rec["prev"]
+            if below is None or int(rec["item"]["id"]) < int(below): # Archived since the cursor was handed out
+                wds.append(Withdrawal.from_json(rec["item"]))
+        return wds, f"@{offset}" if offset >= 0 else None
+    def get_request(self, msg_id):
+        return self.data["pending_requests"].get(msg_id)
+    def pending_requests(self):
+        return dict(self.data["pending_requests"])
+    def open_request(self, msg_id, req_type, seller_id, submission_id, time):
+        self.record("request_opened", msg_id=msg_id, type=req_type, seller_id=seller_id, submission_id=submission_id, time=time)
+    def close_request(self, msg_id):
+        self.record("request_closed", msg_id=msg_id)
+    def review_page(self, queue, cursor, limit, backward=False):
+        index = self.review[queue]
+        entries, has_prev, has_next = index.page(cursor, limit, backward)
+        return entries, has_prev, has_next, len(index)
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    uid TEXT PRIMARY KEY,
+    balance REAL NOT NULL DEFAULT 0,
+    sales INTEGER NOT NULL DEFAULT 0,
+    custom_prices TEXT NOT NULL DEFAULT '{}',
+    start_time TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_users_start_time ON users(start_time);
+CREATE INDEX IF NOT EXISTS idx_users_sales ON users(sales);
+CREATE TABLE IF NOT EXISTS user_groups (
+    uid TEXT NOT NULL,
+    link TEXT NOT NULL,
+    PRIMARY KEY (uid, link)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS links (
+    link TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    status TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS submissions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    seller_id TEXT NOT NULL,
+    links TEXT NOT NULL,
+    year TEXT,
+    type TEXT,
+    time TEXT,
+    status TEXT NOT NULL,
+    approved_count INTEGER,
+    ownership_status TEXT NOT NULL DEFAULT 'none',
+    ownership_target_id TEXT,
+    changed TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_submissions_seller_status ON submissions(seller_id, status);
+CREATE INDEX IF NOT EXISTS idx_submissions_status ON submissions(status);
+CREATE TABLE IF NOT EXISTS withdrawals (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    uid TEXT NOT NULL,
+    method TEXT,
+    address TEXT,
+    amount REAL,
+    status TEXT NOT NULL,
+    time TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_withdrawals_uid ON withdrawals(uid, id);
+CREATE INDEX IF NOT EXISTS idx_withdrawals_status ON withdrawals(status);
+CREATE TABLE IF NOT EXISTS pending_requests (
+    msg_id TEXT PRIMARY KEY,
+    type TEXT,
+    seller_id TEXT,
+    submission_id TEXT,
+    time TEXT
+);
+CREATE TABLE IF NOT EXISTS outbox (
+    id TEXT PRIMARY KEY,
+    entry TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS digest (
+    id TEXT PRIMARY KEY,
+    entry TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS settings (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS user_data (
+    uid TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS conversations (
+    name TEXT NOT NULL,
+    key TEXT NOT NULL,
+    state TEXT NOT NULL,
+    time TEXT NOT NULL,
+    PRIMARY KEY (name, key)
+) WITHOUT ROWID;
+"""
+SUBMISSION_COLUMNS = ("id", "seller_id", "links", "year", "type", "time", "status", "approved_count", "ownership_status", "ownership_target_id", "changed")
+# Row-level storage in an embedded SQLite database (WAL mode); only the rows a handler touches are read or written
+class SqliteStore(Store):
+    def __init__(self, path: Path, fsync: bool = True):
+        self.path = path
+        self.conn = sqlite3.connect(str(path), isolation_level=None)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(f"PRAGMA synchronous={'FULL' if fsync else 'NORMAL'}")
+        self.conn.executescript(SQLITE_SCHEMA)
+        if "changed" not in {row["name"] for row in self.conn.execute("PRAGMA table_info(submissions)")}:
+            self.conn.execute("ALTER TABLE submissions ADD COLUMN changed TEXT") # Created before status changes were timed
+    def _insert_submissions(self, subs):
+        self.conn.executemany(
+            f"INSERT INTO submissions({', '.join(SUBMISSION_COLUMNS)}) VALUES ({', '.join('?' * len(SUBMISSION_COLUMNS))})",
+            [tuple(json.dumps(sub.links, ensure_ascii=False) if c == "links" else getattr(sub, c) for c in SUBMISSION_COLUMNS) for sub in subs],
+        )
+    def _put_links(self, links):
+        with self.tx():
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO links(link, owner, status) VALUES (?, ?, ?)",
+                [(link, entry.owner, entry.status) for link, entry in links.items()],
+            )
+    def _set_links_status(self, sub, status):
+        self.conn.executemany("UPDATE links SET status = ? WHERE link = ?", [(status, canonical_link(link)) for link in sub.links])
+    def tx(self):
+        # BEGIN IMMEDIATE ... COMMIT around one logical change
+        return SqliteTransaction(self.conn)
+    async def close(self):
+        self.conn.close()
+    def _setting(self, key, default):
+        row = self.conn.execute("SELECT value FROM settings WHERE key = ?", (key,)).fetchone()
+        return json.loads(row["value"]) if row else default
+    def _put_setting(self, key, value):
+        self.conn.execute("INSERT OR REPLACE INTO settings(key, value) VALUES (?, ?)", (key, json.dumps(value, ensure_ascii=False)))
+    def _user_row(self, row):
+        return User(balance=row["balance"], sales=row["sales"], custom_prices=json.loads(row["custom_prices"]) or None, start_time=row["start_time"])
+    def get_user(self, uid):
+        row = self.conn.execute("SELECT * FROM users WHERE uid = ?", (uid,)).fetchone()
+        return self._user_row(row) if row else None
+    def create_user(self, uid, time):
+        if self.conn.execute("SELECT 1 FROM users WHERE uid = ?", (uid,)).fetchone() is None:
+            with self.tx():
+                self.conn.execute("INSERT INTO users(uid, start_time) VALUES (?, ?)", (uid, time))
+                self._update_stats(stats_user_created, time)
+    def iter_users(self):
+        for row in self.conn.execute("SELECT * FROM users"):
+            yield int(row["uid"]), self._user_row(row)
+    def user_ids_page(self, cursor, limit):
+        rows = self.conn.execute("SELECT rowid, uid FROM users WHERE rowid > ? ORDER BY rowid LIMIT ?", (cursor or 0, limit)).fetchall()
+        return [int(row["uid"]) for row in rows], rows[-1]["rowid"] if rows else cursor
+    def stats(self):
+        return self._setting("stats", None) or empty_stats()
+    def _update_stats(self, fn, *args):
+        # Read-modify-write of the small counters row, inside the caller's transaction
+        stats = self.stats()
+        fn(stats, *args)
+        self._put_setting("stats", stats)
+    def top_sellers(self, limit):
+        rows = self.conn.execute("SELECT uid, sales FROM users WHERE sales > 0 ORDER BY sales DESC LIMIT ?", (limit,))
+        return [(int(row["uid"]), row["sales"]) for row in rows]
+    def credit(self, uid, amount):
+        self.conn.execute("UPDATE users SET balance = balance + ? WHERE uid = ?", (amount, uid))
+    def group_count(self, uid):
+        return self.conn.execute("SELECT COUNT(*) FROM user_groups WHERE uid = ?", (uid,)).fetchone()[0]
+    def set_prices(self, uid, prices):
+        if uid is None:
+            self._put_setting("global_prices", prices)
+        else:
+            self.conn.execute("UPDATE users SET custom_prices = ? WHERE uid = ?", (json.dumps(prices or {}, ensure_ascii=False), uid))
+    def global_prices(self):
+        return self._setting("global_prices", DEFAULT_PRICES)
+    def sell_enabled(self):
+        return self._setting("sell_enabled", True)
+    def set_sell_enabled(self, enabled):
+        self._put_setting("sell_enabled", enabled)
+    def get_meta(self, key):
+        return self._setting(f"meta:{key}", None)
+    def set_meta(self, key, value):
+        self._put_setting(f"meta:{key}", value)
+    def outbox_add(self, entry):
+        self.conn.execute("INSERT OR REPLACE INTO outbox(id, entry) VALUES (?, ?)", (entry["id"], json.dumps(entry, ensure_ascii=False)))
+    def outbox_remove(self, entry_id):
+        self.conn.execute("DELETE FROM outbox WHERE id = ?", (entry_id,))
+    def outbox_entries(self):
+        return [json.loads(row["entry"]) for row in self.conn.execute("SELECT entry FROM outbox ORDER BY rowid")]
+    def digest_add(self, entry):
+        self.conn.execute("INSERT OR REPLACE INTO digest(id, entry) VALUES (?, ?)", (entry["id"], json.dumps(entry, ensure_ascii=False)))
+    def digest_entries(self):
+        return [json.loads(row["entry"]) for row in self.conn.execute("SELECT entry FROM digest ORDER BY rowid")]
+    def digest_flush(self, ids, entries):
+        with self.tx():
+            self.conn.executemany("DELETE FROM digest WHERE id = ?", [(entry_id,) for entry_id in ids])
+            for entry in entries:
+                self.outbox_add(entry)
+    def all_user_data(self):
+        return {int(row["uid"]): json.loads(row["data"]) for row in self.conn.execute("SELECT uid, data FROM user_data")}
+    def set_user_data(self, uid, data):
+        if data:
+            self.conn.execute("INSERT OR REPLACE INTO user_data(uid, data) VALUES (?, ?)", (uid, json.dumps(data, ensure_ascii=False)))
+        else:
+            self.conn.execute("DELETE FROM user_data WHERE uid = ?", (uid,))
+    def conversations(self, name):
+        rows = self.conn.execute("SELECT key, state, time FROM conversations WHERE name = ?", (name,))
+        return {tuple(json.loads(row["key"])): (json.loads(row["state"]), row["time"]) for row in rows}
+    def conversation(self, name, key):
+        row = self.conn.execute("SELECT state, time FROM conversations WHERE name = ? AND key = ?", (name, json.dumps(list(key)))).fetchone()
+        return (json.loads(row["state"]), row["time"]) if row else None
+    def set_conversation(self, name, key, state, time):
+        if state is None:
+            self.conn.execute("DELETE FROM conversations WHERE name = ? AND key = ?", (name, json.dumps(list(key))))
+        else:
+            self.conn.execute("INSERT OR REPLACE INTO conversations(name, key, state, time) VALUES (?, ?, ?, ?)", (name, json.dumps(list(key)), json.dumps(state), time))
+    def submit_groups(self, uid, links, year, sell_type, time):
+        with self.tx():
+            cur = self.conn.execute(
+                "INSERT INTO submissions(seller_id, links, year, type, time, status) VALUES (?, ?, ?, ?, ?, 'pending')",
+                (uid, json.dumps(list(links), ensure_ascii=False), year, sell_type, time),
+            )
+            for link in links:
+                self.conn.execute("INSERT OR IGNORE INTO user_groups(uid, link) VALUES (?, ?)", (uid, link))
+                self.conn.execute("INSERT OR REPLACE INTO links(link, owner, status) VALUES (?, ?, 'pending')", (canonical_link(link), uid))
+        return str(cur.lastrowid)
+    def link_entry(self, link):
+        row = self.conn.execute("SELECT owner, status FROM links WHERE link = ?", (link,)).fetchone()
+        return LinkEntry.from_json(dict(row)) if row else None
+    def _submission_row(self, row):
+        sub = Submission.from_json({c: row[c] for c in SUBMISSION_COLUMNS})
+        sub.id = str(sub.id)
+        sub.links = json.loads(sub.links)
+        return sub
+    def get_submission(self, sub_id):
+        row = self.conn.execute("SELECT * FROM submissions WHERE id = ?", (int(sub_id),)).fetchone()
+        return self._submission_row(row) if row else None
+    def submissions(self, seller_id=None, statuses=None):
+        sql = "SELECT * FROM submissions"
+        where, args = [], []
+        if seller_id is not None:
+            where.append("seller_id = ?")
+            args.append(seller_id)
+        if statuses is not None:
+            where.append(f"status IN ({', '.join('?' * len(statuses))})")
+            args.extend(statuses)
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        return {str(row["id"]): self._submission_row(row) for row in self.conn.execute(sql + " ORDER BY id", args)}
+    def set_submission_status(self, sub_id, status, approved_count=None):
+        with self.tx():
+            sub = self.get_submission(sub_id)
+            if sub is None:
+                return
+            self._set_links_status(sub, status)
+            if status in SUBMISSION_DROP_STATUSES:
+                self.conn.execute("DELETE FROM submissions WHERE id = ?", (int(sub_id),))
+            elif approved_count is None:
+                self.conn.execute("UPDATE submissions SET status = ?, changed = ? WHERE id = ?", (status, now(), int(sub_id)))
+            else:
+                self.conn.execute("UPDATE submissions SET status = ?, approved_count = ?, changed = ? WHERE id = ?", (status, approved_count, now(), int(sub_id)))
+    def moderate_submissions(self, decisions, entries):
+        with self.tx():
+            for sub_id, status, approved_count in decisions:
+                self.set_submission_status(sub_id, status, approved_count)
+            for entry in entries:
+                self.outbox_add(entry)
+    def set_ownership(self, sub_id, ownership_status, target=None):
+        if target is None:
+            self.conn.execute("UPDATE submissions SET ownership_status = ?, changed = ? WHERE id = ?", (ownership_status, now(), int(sub_id)))
+        else:
+            self.conn.execute("UPDATE submissions SET ownership_status = ?, ownership_target_id = ?, changed = ? WHERE id = ?", (ownership_status, target, now(), int(sub_id)))
+    def sell_submission(self, sub_id, count, amount, time):
+        with self.tx():
+            sub = self.get_submission(sub_id)
+            if sub is None:
+                return
+            self._set_links_status(sub, GroupStatus.SOLD)
+            self.conn.execute("DELETE FROM submissions WHERE id = ?", (int(sub_id),))
+            self.conn.execute("UPDATE users SET sales = sales + ?, balance = balance + ? WHERE uid = ?", (count, amount, sub.seller_id))
+            self._update_stats(stats_groups_sold, count, time)
+    def _withdrawal_row(self, row):
+        wd = Withdrawal.from_json(dict(row))
+        wd.id = str(wd.id)
+        return wd
+    def get_withdrawal(self, wid):
+        row = self.conn.execute("SELECT * FROM withdrawals WHERE id = ?", (int(wid),)).fetchone()
+        return self._withdrawal_row(row) if row else None
+    def pending_withdrawals(self, uid=None):
+        if uid is None:
+            rows = self.conn.execute("SELECT * FROM withdrawals WHERE status = 'Pending' ORDER BY id")
+        else:
+            rows = self.conn.execute("SELECT * FROM withdrawals WHERE uid = ? AND status = 'Pending' ORDER BY id", (uid,))
+        return {str(row["id"]): self._withdrawal_row(row) for row in rows}
+    def open_withdrawal(self, uid, method, address, amount, time):
+        with self.tx():
+            if self.conn.execute("UPDATE users SET balance = balance - ? WHERE uid = ? AND balance >= ?", (amount, uid, amount)).rowcount == 0:
+                return None
+            cur = self.conn.execute(
+                "INSERT INTO withdrawals(uid, method, address, amount, status, time) VALUES (?, ?, ?, ?, 'Pending', ?)",
+                (uid, method, address, amount, time),
+            )
+        return str(cur.lastrowid)
+    def close_withdrawal(self, wid, status, time):
+        with self.tx():
+            wd = self.get_withdrawal(wid)
+            if wd is None or wd.status != WithdrawalStatus.PENDING:
+                return
+            self.conn.execute("UPDATE withdrawals SET status = ? WHERE id = ?", (status, int(wid)))
+            if status == WithdrawalStatus.APPROVED:
+                self._update_stats(stats_withdrawal_approved, float(wd.amount), time)
+            else:
+                self.conn.execute("UPDATE users SET balance = balance + ? WHERE uid = ?", (float(wd.amount), wd.uid))
+    def withdrawal_history(self, uid, before=None, limit=5):
+        rows = self.conn.execute(
+            "SELECT * FROM withdrawals WHERE uid = ? AND id < ? ORDER BY id DESC LIMIT ?",
+            (uid, int(before) if before is not None else 2 ** 63 - 1, limit + 1),
+        ).fetchall()
+        return [self._withdrawal_row(row) for row in rows[:limit]], str(rows[limit - 1]["id"]) if len(rows) > limit else None
+    def get_request(self, msg_id):
+        row = self.conn.execute("SELECT type, seller_id, submission_id, time FROM pending_requests WHERE msg_id = ?", (msg_id,)).fetchone()
+        return PendingRequest.from_json(dict(row)) if row else None
+    def pending_requests(self):
+        return {row["msg_id"]: PendingRequest.from_json(dict(row)) for row in self.conn.execute("SELECT * FROM pending_requests ORDER BY rowid")}
+    def open_request(self, msg_id, req_type, seller_id, submission_id, time):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO pending_requests(msg_id, type, seller_id, submission_id, time) VALUES (?, ?, ?, ?, ?)",
+            (msg_id, req_type, seller_id, submission_id, time),
+        )
+    def close_request(self, msg_id):
+        self.conn.execute("DELETE FROM pending_requests WHERE msg_id = ?", (msg_id,))
+    # id order is arrival order: AUTOINCREMENT gives a new row an id above every existing one
+    REVIEW_QUERIES = {
+        "groups": "SELECT id, id AS pos FROM submissions WHERE status = 'pending'",
+        "withdrawals": "SELECT id, id AS pos FROM withdrawals WHERE status = 'Pending'",
+    }
+    def review_page(self, queue, cursor, limit, backward=False):
+        base = self.REVIEW_QUERIES[queue]
+        def window(op, order, n, bound):
+            return self.conn.execute(f"SELECT id, pos FROM ({base}) WHERE pos {op} ? ORDER BY pos {order} LIMIT ?", (bound, n)).fetchall()
+        if backward:
+            rows = window("<", "DESC", limit + 1, cursor)
+            has_prev = len(rows) > limit
+            rows = rows[:limit][::-1]
+            has_next = bool(rows) and bool(window(">", "ASC", 1, rows[-1]["pos"]))
+        else:
+            rows = window(">", "ASC", limit + 1, cursor)
+            has_next = len(rows) > limit
+            rows = rows[:limit]
+            has_prev = bool(rows) and bool(window("<", "DESC", 1, rows[0]["pos"]))
+        total = self.conn.execute(f"SELECT COUNT(*) FROM ({base})").fetchone()[0]
+        return [(row["pos"], str(row["id"])) for row in rows], has_prev, has_next, total
+    def import_data(self, d):
+        # One-shot bulk load of JsonStore data (records, as decode_snapshot leaves them), in a single transaction
+        with self.tx():
+            for uid, u in d["users"].items():
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO users(uid, balance, sales, custom_prices, start_time) VALUES (?, ?, ?, ?, ?)",
+                    (uid, u.balance, u.sales, json.dumps(u.custom_prices or {}, ensure_ascii=False), u.start_time or now()),
+                )
+                self.conn.executemany("INSERT OR IGNORE INTO user_groups(uid, link) VALUES (?, ?)", [(uid, link) for link in u.groups])
+            self._insert_submissions(d["submissions"].values())
+            self.conn.executemany(
+                "INSERT INTO withdrawals(id, uid, method, address, amount, status, time) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(int(w.id), w.uid, w.method, w.address, w.amount, w.status, w.time) for w in d["withdrawals"].values()],
+            )
+            for msg_id, req in d["pending_requests"].items():
+                self.open_request(msg_id, req.type, req.seller_id, req.submission_id, req.time)
+            self._put_setting("sell_enabled", d.get("sell_enabled", True))
+            self._put_setting("global_prices", d.get("global_prices", DEFAULT_PRICES))
+            self._put_setting("stats", d["stats"])
+            self._put_links(d["links"])
+            for key, value in d["meta"].items():
+                self.set_meta(key, value)
+            for entry in d["outbox"].values():
+                self.outbox_add(entry)
+            for entry in d["digest"].values():
+                self.digest_add(entry)
+            for uid, data in d["user_data"].items():
+                self.set_user_data(uid, data)
+            for name, conversations in d["conversations"].items():
+                for key, (state, changed) in conversations.items():
+                    self.set_conversation(name, json.loads(key), state, changed)
+class SqliteTransaction:
+    def __init__(self, conn):
+        self.conn = conn
+        self.depth = 0
+    def __enter__(self):
+        if not self.conn.in_transaction:
+            self.conn.execute("BEGIN IMMEDIATE")
+            self.depth = 1
+        return self
+    def __exit__(self, exc_type, exc, tb):
+        if self.depth:
+            if exc_type:
+                self.conn.execute("ROLLBACK")
+            else:
+                start = time.perf_counter()
+                self.conn.execute("COMMIT")
+                metrics.observe("bot_sqlite_commit_seconds", time.perf_counter() - start)
+        return False
+def open_store():
+    if STORAGE_BACKEND == "sqlite":
+        return SqliteStore(SQLITE_PATH, JOURNAL_FSYNC)
+    return JsonStore(PersistenceManager(DATA_PATH, JOURNAL_COMPACT_OPS, JOURNAL_COMPACT_SECONDS, JOURNAL_FSYNC, SNAPSHOT_FORMAT))
+def migrate_json_to_sqlite(json_path: Path, sqlite_path: Path):
+    # python bot.py migrate-sqlite [data.json] [data.sqlite3]
+    source = JsonStore(PersistenceManager(json_path, JOURNAL_COMPACT_OPS, JOURNAL_COMPACT_SECONDS, JOURNAL_FSYNC))
+    target = SqliteStore(sqlite_path)
+    target.import_data(source.full_data())
+    logger.info(f"Migrated {len(source.data['users'])} users and {len(source.data['submissions'])} submissions from {json_path} to {sqlite_path}")
+    target.conn.close()
+def convert_snapshot(source: Path, target: Path):
+    # python bot.py convert-snapshot [data.json] [data.snap], or the other way round: the source
+    # format is read from its first bytes, the target is binary if it ends in .snap. journal_seq
+    # is kept, so the journal segments next to it still replay on top of the result.
+    with open(source, "rb") as f:
+        binary = f.read(len(SNAPSHOT_MAGIC)) == SNAPSHOT_MAGIC
+    d, hints, snapshot = read_binary_snapshot(source) if binary else (read_json_snapshot(source), None, None)
+    if target.suffix == ".snap":
+        if hints is None:
+            hints = scan_hints(d["users"].items(), d["withdrawals"].items(), USER_HOT_ITEMS)
+        size = write_binary_snapshot(target, encode_binary_snapshot(FrozenData(d, hints)))
+    else:
+        d.update((name, dict(d[name].items())) for name in LAZY_SECTIONS)
+        payload = json.dumps(d, ensure_ascii=False, default=json_default)
+        write_atomic(target, payload)
+        size = len(payload)
+    if snapshot is not None:
+        snapshot.close()
+    logger.info(f"Converted {source} ({len(d['users'])} users) to {target} ({size} bytes)")
+store = None # The live store, opened by use_store(open_store()) in main(); importing bot.py or
+             # running a CLI subcommand leaves it closed, those open their own files.
+def use_store(s):
+    # Bind the live store to the module and to the singletons built on top of it
+    global store
+    store = s
+    for service in (pricebook, outbox, channel_digest, broadcaster, sweeper):
+        service.store = s
+    return s
 def ensure_user(uid: int):
-    s = str(uid)
-    if s not in data["users"]:
-        data["users"][s] = {
-            "balance": 0.0,
-            "groups": [],
-            "sales": 0,
-            "withdraw_history": [],
-            "custom_prices": {},
-            "start_time": now() # Record when user first interacts
-        }
-        save_data(data)
+    store.create_user(uid, now())
+def taken_links(uid: int, links):
+    # Links already on the marketplace under any spelling, or repeated within `links`
+    seen = set()
+    taken = []
+    for link in links:
+        canon = canonical_link(link)
+        if canon in seen or link_taken(store.link_entry(canon), uid):
+            taken.append(link)
+        seen.add(canon)
+    return taken
 # ========================
 # Regex / utilities
 # ========================
-INVITE_RE = re.compile(
-    r"^(https?://)?(t\.me/joinchat/|t\.me/\+|telegram\.me/joinchat/|telegram\.me/\+|t\.me/|t\.me/addlist/)[A-Za-z0-9_-]+$",
-    flags=re.IGNORECASE,
-)
 # Basic address validation regex
 ADDRESS_VALIDATORS = {
     "upi": r"^[a-zA-Z0-9.\-_]{2,256}@[a-zA-Z]{2,64}$", # Example UPI format
@@ -105,13 +2059,105 @@ def validate_address(method, address):
     return True
 def now():
     return datetime.datetime.utcnow().isoformat() + "Z"
-def is_within_24_hours(timestamp: str) -> bool:
-    try:
-        dt = datetime.datetime.fromisoformat(timestamp.replace("Z", "+00:00"))
-        now_dt = datetime.datetime.utcnow()
-        return (now_dt - dt).total_seconds() <= 24 * 60 * 60
-    except:
-        return False
+def split_message(lines, limit: int = TELEGRAM_MESSAGE_LIMIT):
+    # Joins lines into as few messages as fit Telegram's length limit
+    chunks, current = [], ""
+    for line in lines:
+        line = line[:limit]
+        if current and len(current) + 1 + len(line) > limit:
+            chunks.append(current)
+            current = line
+        else:
+            current = f"{current}\n{line}" if current else line
+    if current:
+        chunks.append(current)
+    return chunks
+# ========================
+# Pricing
+# ========================
+# Prices are validated and converted to integer cents once, when an admin sets them, and
+# persisted in the normalized "11$" / "10.50$" form. PriceBook keeps the parsed global
+# table plus an LRU of per-user effective tables (custom prices over the global ones) and
+# their rendered /price text. A custom change drops that user's entry; a global change bumps
+# a version so every cached entry is rebuilt lazily on next use.
+PRICE_RE = re.compile(r"^\$?\s*(\d+)(?:\.(\d{1,2}))?\s*\$?$")
+def parse_price(value) -> int:
+    m = PRICE_RE.match(str(value).strip())
+    if m is None:
+        raise ValueError(f"invalid price: {value!r}")
+    return int(m.group(1)) * 100 + int((m.group(2) or "0").ljust(2, "0"))
+def format_price(cents: int) -> str:
+    return f"{cents // 100}$" if cents % 100 == 0 else f"{cents // 100}.{cents % 100:02d}$"
+def parse_price_table(text: str) -> dict:
+    # "2016-22: 10$, 2023: 5.5" -> {"2016-22": 1000, "2023": 550}; any bad part rejects the whole input
+    table = {}
+    for part in text.split(","):
+        if not part.strip():
+            continue
+        year, sep, value = part.partition(":")
+        if not sep or not year.strip():
+            raise ValueError(f"expected `year: price`, got {part.strip()!r}")
+        table[year.strip()] = parse_price(value)
+    if not table:
+        raise ValueError("no prices given")
+    return table
+def format_price_table(table: dict) -> dict:
+    return {year: format_price(cents) for year, cents in table.items()}
+class PriceBook:
+    def __init__(self, store, cache_size: int):
+        self.store = store
+        self.cache_size = cache_size
+        self.version = 0
+        self._global = None
+        self._users = collections.OrderedDict() # uid -> (version, custom, effective, text)
+    def _parse_stored(self, raw: dict, owner: str):
+        # Stored tables were validated when set; anything unparseable predates that and is skipped
+        table = {}
+        for year, value in raw.items():
+            try:
+                table[year] = parse_price(value)
+            except ValueError:
+                logger.warning(f"Ignoring invalid stored price {value!r} for {year} ({owner})")
+        return table
+    def global_table(self) -> dict:
+        if self._global is None:
+            self._global = self._parse_stored(self.store.global_prices(), "global")
+        return self._global
+    def _entry(self, uid: int):
+        entry = self._users.get(uid)
+        if entry is not None and entry[0] == self.version:
+            self._users.move_to_end(uid)
+            return entry
+        user = self.store.get_user(uid)
+        custom = self._parse_stored((user and user.custom_prices) or {}, f"user {uid}")
+        effective = {**self.global_table(), **custom}
+        text = "📊 *Current Group Prices*\n\n"
+        if custom:
+            text += "✨ *Your Custom Prices:*\n"
+            text += "".join(f"📅 {year}: {format_price(cents)}\n" for year, cents in custom.items())
+            text += "\n"
+        text += "🌍 *Standard Prices:*\n"
+        text += "".join(f"📅 {year}: {format_price(cents)}\n" for year, cents in self.global_table().items())
+        entry = (self.version, custom, effective, text)
+        self._users[uid] = entry
+        self._users.move_to_end(uid)
+        while len(self._users) > self.cache_size:
+            self._users.popitem(last=False)
+        return entry
+    def custom(self, uid: int) -> dict:
+        return self._entry(uid)[1]
+    def price(self, uid: int, year: str):
+        return self._entry(uid)[2].get(year) # cents, or None if the year has no price for this user
+    def text(self, uid: int) -> str:
+        return self._entry(uid)[3]
+    def set_custom(self, uid: int, table: dict):
+        self.store.set_prices(uid, format_price_table(table))
+        self._users.pop(uid, None)
+    def set_global(self, table: dict):
+        self.store.set_prices(None, format_price_table(table))
+        self._global = None
+        self.version += 1
+pricebook = PriceBook(None, PRICE_CACHE_SIZE)
 # ========================
 # Conversation states
 # ========================
@@ -127,6 +2173,8 @@ COMMANDS = [
     BotCommand("sell", "Sell group"),
     BotCommand("withdraw", "Request withdrawal"),
     BotCommand("stats", "Show bot statistics (admin only)"),
+    BotCommand("metrics", "Show runtime metrics (admin only)"),
+    BotCommand("bulk", "Approve or reject pending submissions in bulk (admin only)"),
     BotCommand("cancel", "Cancel current action"),
     BotCommand("admin", "Open admin panel (admin only)"),
 ]
@@ -148,6 +2196,861 @@ def get_keyboard(is_admin=False):
         ]
     return ReplyKeyboardMarkup(kb, resize_keyboard=True)
 # ========================
+# Outbound rate limiting & broadcast
+# ========================
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+    def _refill(self, now_m: float):
+        self.tokens = min(self.capacity, self.tokens + (now_m - self.updated) * self.rate)
+        self.updated = now_m
+    def is_full(self) -> bool:
+        self._refill(time.monotonic())
+        return self.tokens >= self.capacity
+    def block(self, seconds: float):
+        # Telegram told us to back off (RetryAfter): nobody gets a token until then
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+    async def acquire(self):
+        while True:
+            now_m = time.monotonic()
+            if now_m < self.blocked_until:
+                await asyncio.sleep(self.blocked_until - now_m)
+                continue
+            self._refill(now_m)
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+# Global bucket plus one small bucket per chat; idle per-chat buckets are dropped
+class RateLimiter:
+    MAX_CHAT_BUCKETS = 10000
+    def __init__(self, global_rate: float, per_chat_rate: float):
+        self.global_bucket = TokenBucket(global_rate, max(1.0, global_rate))
+        self.per_chat_rate = per_chat_rate
+        self.chats = {}
+    async def acquire(self, chat_id):
+        bucket = self.chats.get(chat_id)
+        if bucket is None:
+            if len(self.chats) >= self.MAX_CHAT_BUCKETS:
+                self.chats = {cid: b for cid, b in self.chats.items() if not b.is_full()}
+            bucket = self.chats[chat_id] = TokenBucket(self.per_chat_rate, 1)
+        await bucket.acquire()
+        await self.global_bucket.acquire()
+    def retry_after(self, seconds: float):
+        self.global_bucket.block(seconds)
+send_limiter = RateLimiter(GLOBAL_SEND_RATE, PER_CHAT_SEND_RATE)
+async def send_limited(bot, chat_id, text: str, attempts: int = 3, **kwargs):
+    for attempt in range(attempts):
+        await send_limiter.acquire(chat_id)
+        try:
+            return await bot.send_message(chat_id, text, **kwargs)
+        except RetryAfter as e:
+            logger.warning(f"Flood control hit sending to {chat_id}, retrying in {e.retry_after}s")
+            send_limiter.retry_after(e.retry_after)
+            if attempt == attempts - 1:
+                raise
+# Durable queue for notifications that nobody waits on. Handlers enqueue and move on;
+# workers deliver in parallel across chats but strictly in order within a chat.
+# Entries stay in the store until delivered, so a restart re-sends what was left.
+class Outbox:
+    def __init__(self, store: Store, workers: int):
+        self.store = store
+        self.workers = workers
+        self.bot = None
+        self.chats = {} # chat_id -> deque of entries, head is next to send
+        self.ready = asyncio.Queue() # chat ids with a sendable head entry
+        self._tasks = []
+    @staticmethod
+    def entry(chat_id, text: str, reply_markup=None, parse_mode=None) -> dict:
+        return {
+            "id": uuid.uuid4().hex,
+            "chat_id": chat_id,
+            "text": text,
+            "reply_markup": reply_markup.to_dict() if reply_markup else None,
+            "parse_mode": parse_mode,
+            "time": now(),
+        }
+    def enqueue(self, chat_id, text: str, reply_markup=None, parse_mode=None):
+        entry = self.entry(chat_id, text, reply_markup, parse_mode)
+        self.store.outbox_add(entry)
+        self._push(entry)
+    def push(self, entries):
+        # Entries the store already holds (a flushed digest)
+        for entry in entries:
+            self._push(entry)
+    def _push(self, entry):
+        chat_id = entry["chat_id"]
+        queue = self.chats.get(chat_id)
+        if queue is None:
+            queue = self.chats[chat_id] = collections.deque()
+            self.ready.put_nowait(chat_id)
+        queue.append(entry)
+    def pending(self) -> int:
+        return sum(len(q) for q in self.chats.values())
+    def start(self, bot):
+        self.bot = bot
+        # The store is the source of truth: rebuild the in-memory queues from it
+        self.chats = {}
+        self.ready = asyncio.Queue()
+        for entry in self.store.outbox_entries():
+            self._push(entry)
+        if self.chats:
+            logger.info(f"Outbox: {self.pending()} undelivered notification(s) loaded from the store")
+        loop = asyncio.get_running_loop()
+        self._tasks = [loop.create_task(self._worker()) for _ in range(self.workers)]
+    async def _send(self, entry):
+        markup = InlineKeyboardMarkup.de_json(entry["reply_markup"], self.bot) if entry["reply_markup"] else None
+        await send_limiter.acquire(entry["chat_id"])
+        await self.bot.send_message(entry["chat_id"], entry["text"], reply_markup=markup, parse_mode=entry["parse_mode"])
+    def _done(self, chat_id, queue):
+        entry = queue.popleft()
+        self.store.outbox_remove(entry["id"])
+        if queue:
+            self.ready.put_nowait(chat_id)
+        else:
+            del self.chats[chat_id]
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            chat_id = await self.ready.get()
+            queue = self.chats[chat_id]
+            entry = queue[0]
+            try:
+                await self._send(entry)
+            except RetryAfter as e:
+                send_limiter.retry_after(e.retry_after)
+                loop.call_later(e.retry_after, self.ready.put_nowait, chat_id)
+                continue
+            except (BadRequest, Forbidden) as e:
+                # Permanent for this message (blocked bot, bad chat id): drop it and move on
+                logger.warning(f"Outbox: dropping message to {chat_id}: {e}")
+            except (NetworkError, TelegramError) as e:
+                attempts = entry.get("attempts", 0) + 1
+                entry["attempts"] = attempts
+                if attempts < OUTBOX_MAX_ATTEMPTS:
+                    delay = min(OUTBOX_BACKOFF_MAX, 2 ** attempts)
+                    logger.warning(f"Outbox: send to {chat_id} failed ({e}), retry {attempts} in {delay}s")
+                    loop.call_later(delay, self.ready.put_nowait, chat_id)
+                    continue
+                logger.error(f"Outbox: giving up on message to {chat_id} after {attempts} attempts: {e}")
+            except Exception as e:
+                logger.error(f"Outbox: unexpected error sending to {chat_id}: {e}")
+            self._done(chat_id, queue)
+    async def close(self):
+        # Give in-flight notifications a moment to go out; the rest stay queued in the store
+        deadline = time.monotonic() + OUTBOX_DRAIN_SECONDS
+        while self.chats and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+outbox = Outbox(None, OUTBOX_WORKERS)
+# Posts to the links and withdrawals channels are informational: instead of one message per
+# event, they are collected per channel and go out as one digest, split at Telegram's
+# length limit, DIGEST_SECONDS after the first one or once DIGEST_MAX_EVENTS are waiting.
+# Collected posts are kept in the store, and a flush moves them into the outbox in one
+# store operation, so a restart neither loses nor repeats them. Messages for the admin,
+# with their buttons, still go straight to the outbox.
+class ChannelDigest:
+    def __init__(self, store: Store, outbox: Outbox, seconds: float, max_events: int):
+        self.store = store
+        self.outbox = outbox
+        self.seconds = seconds
+        self.max_events = max_events
+        self.chats = {} # chat_id -> collected entries, oldest first
+        self._timers = {} # chat_id -> asyncio.TimerHandle of the timed flush
+    def post(self, chat_id, text: str):
+        if self.seconds <= 0:
+            self.outbox.enqueue(chat_id, text)
+            return
+        entry = {"id": uuid.uuid4().hex, "chat_id": chat_id, "text": text, "time": now()}
+        self.store.digest_add(entry)
+        self._add(entry)
+    def _add(self, entry):
+        chat_id = entry["chat_id"]
+        events = self.chats.setdefault(chat_id, [])
+        events.append(entry)
+        if len(events) >= self.max_events:
+            self.flush(chat_id)
+        elif chat_id not in self._timers:
+            self._timers[chat_id] = asyncio.get_running_loop().call_later(self.seconds, self.flush, chat_id)
+    def pending(self) -> int:
+        return sum(len(events) for events in self.chats.values())
+    def start(self):
+        self.chats = {}
+        for entry in self.store.digest_entries():
+            self._add(entry)
+        if self.chats:
+            logger.info(f"Digest: {self.pending()} channel post(s) loaded from the store")
+    def flush(self, chat_id):
+        timer = self._timers.pop(chat_id, None)
+        if timer is not None:
+            timer.cancel()
+        events = self.chats.pop(chat_id, None)
+        if not events:
+            return
+        lines = [f"🗂 Digest: {len(events)} new event(s)"] if len(events) > 1 else []
+        for entry in events:
+            if lines:
+                lines.append("")
+            lines += entry["text"].split("\n")
+        entries = [self.outbox.entry(chat_id, text) for text in split_message(lines)]
+        try:
+            self.store.digest_flush([entry["id"] for entry in events], entries)
+        except Exception as e:
+            logger.error(f"Digest: failed to flush {len(events)} post(s) to {chat_id}: {e}")
+            for entry in events:
+                self._add(entry)
+            return
+        self.outbox.push(entries)
+    def close(self):
+        # Called on stop, while the outbox can still deliver
+        for chat_id in list(self.chats):
+            self.flush(chat_id)
+channel_digest = ChannelDigest(None, outbox, DIGEST_SECONDS, DIGEST_MAX_EVENTS)
+def broadcast_controls(status: str):
+    if status == "running":
+        buttons = [InlineKeyboardButton("⏸ Pause", callback_data="broadcast:pause")]
+    elif status == "paused":
+        buttons = [InlineKeyboardButton("▶️ Resume", callback_data="broadcast:resume")]
+    else:
+        return None
+    return InlineKeyboardMarkup([buttons + [InlineKeyboardButton("⛔ Cancel", callback_data="broadcast:cancel")]])
+# Sends one broadcast at a time as a JobQueue job. The cursor and counters are saved in
+# the store after every page, so a restart resumes from the last finished page.
+class BroadcastEngine:
+    META_KEY = "broadcast"
+    def __init__(self, store: Store):
+        self.store = store
+        self.state = None
+        self.running = False
+        self._last_report = 0.0
+    def current(self):
+        if self.state is None:
+            self.state = self.store.get_meta(self.META_KEY)
+        return self.state
+    def is_active(self) -> bool:
+        st = self.current()
+        return st is not None and st["status"] in ("running", "paused")
+    def save(self):
+        self.store.set_meta(self.META_KEY, dict(self.state))
+    def start(self, job_queue, text: str, admin_chat: int, progress_msg_id: int):
+        self.state = {
+            "text": text,
+            "cursor": None,
+            "sent": 0,
+            "failed": 0,
+            "total": self.store.stats()["users"],
+            "status": "running",
+            "admin_chat": admin_chat,
+            "progress_msg_id": progress_msg_id,
+            "started": now(),
+        }
+        self.save()
+        self.schedule(job_queue)
+    def schedule(self, job_queue):
+        if not self.running:
+            job_queue.run_once(self._job, 0, name="broadcast")
+    async def _job(self, context: ContextTypes.DEFAULT_TYPE):
+        await self.run(context.bot)
+    async def run(self, bot):
+        if self.running:
+            return
+        self.running = True
+        st = self.state
+        sem = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+        async def deliver(uid):
+            async with sem:
+                try:
+                    await send_limited(bot, uid, f"📢 Broadcast from admin:\n\n{st['text']}")
+                    return True
+                except TelegramError as e:
+                    logger.warning(f"Failed to send broadcast to user {uid}: {e}")
+                    return False
+        try:
+            while st["status"] == "running":
+                ids, next_cursor = self.store.user_ids_page(st["cursor"], BROADCAST_PAGE_SIZE)
+                if not ids:
+                    st["status"] = "done"
+                    break
+                results = await asyncio.gather(*(deliver(uid) for uid in ids))
+                st["sent"] += sum(1 for ok in results if ok)
+                st["failed"] += sum(1 for ok in results if not ok)
+                st["cursor"] = next_cursor
+                self.save()
+                await self.report(bot)
+        finally:
+            self.running = False
+            self.save()
+        await self.report(bot, force=True)
+    def progress_text(self):
+        st = self.state
+        labels = {"running": "⏳ Running", "paused": "⏸ Paused", "cancelled": "⛔ Cancelled", "done": "✅ Finished"}
+        return (
+            f"📢 Broadcast — {labels.get(st['status'], st['status'])}\n"
+            f"Sent: {st['sent']} | Failed: {st['failed']} | Users: {max(st['total'], st['sent'] + st['failed'])}"
+        )
+    async def report(self, bot, force: bool = False):
+        if not force and time.monotonic() - self._last_report < BROADCAST_PROGRESS_SECONDS:
+            return
+        self._last_report = time.monotonic()
+        try:
+            await bot.edit_message_text(
+                self.progress_text(),
+                chat_id=self.state["admin_chat"],
+                message_id=self.state["progress_msg_id"],
+                reply_markup=broadcast_controls(self.state["status"]),
+            )
+        except BadRequest as e:
+            if "not modified" not in str(e).lower():
+                logger.warning(f"Failed to update broadcast progress: {e}")
+        except TelegramError as e:
+            logger.warning(f"Failed to update broadcast progress: {e}")
+broadcaster = BroadcastEngine(None)
+# ========================
+# Inbound throttling
+# ========================
+# Checked by MarketplaceApplication.process_update() as soon as an update arrives, before it
+# can wait behind the sender's earlier updates: one over its sender's limit is dropped there,
+# without a reply and before ensure_user(), the store or any Bot API call. Each action class
+# has its own limit, so a user who floods the chat still gets through to /sell once, but can
+# only start so many sales or withdrawals in a row. "sell" and "withdraw" are charged once
+# per flow, on the command or keyboard button that starts it; the flow's later steps (the
+# type or method button, links, year, address, amount) count as "other".
+def parse_limit(spec: str):
+    # "burst/seconds" -> (burst, seconds); "0" or "" -> None (unlimited)
+    if spec.strip() in ("", "0"):
+        return None
+    burst, _, seconds = spec.partition("/")
+    burst, seconds = int(burst), float(seconds)
+    if burst < 1 or seconds <= 0:
+        raise ValueError(f"Bad inbound limit {spec!r}: expected burst/seconds")
+    return burst, seconds
+# Token buckets of `burst` tokens refilled over `seconds`, one per user. A bucket is kept as
+# a single float, the moment it will be full again: taking a token pushes it one interval
+# further, and it may not get more than `window` (= seconds) ahead of now. A bucket left
+# alone for a whole window is full again and carries no state, so buckets live in two
+# generations that rotate every window: touching a bucket moves it into the current one, and
+# the older one is dropped whole, which keeps only the recently active users in memory.
+class InboundLimit:
+    def __init__(self, burst: int, seconds: float):
+        self.interval = seconds / burst
+        self.window = seconds
+        self.current = {} # uid -> monotonic time the bucket is full again
+        self.previous = {}
+        self.rotate_at = time.monotonic() + self.window
+    def __len__(self):
+        return len(self.current) + len(self.previous)
+    def allow(self, uid: int, now_m: float) -> bool:
+        if now_m >= self.rotate_at:
+            # Buckets not touched during the last window are full: let them go
+            self.previous = self.current if now_m < self.rotate_at + self.window else {}
+            self.current = {}
+            self.rotate_at = now_m + self.window
+        full_at = self.current.get(uid)
+        if full_at is None:
+            full_at = self.previous.pop(uid, now_m)
+        self.current[uid] = full_at
+        full_at = max(full_at, now_m) + self.interval
+        if full_at - now_m > self.window:
+            return False
+        self.current[uid] = full_at
+        return True
+class InboundThrottle:
+    def __init__(self, limits: dict):
+        self.limits = {action: InboundLimit(*limit) for action, limit in limits.items() if limit}
+    @staticmethod
+    def action(update: Update) -> str:
+        text = update.message.text if update.message is not None else None
+        if text:
+            if text.startswith("/sell") or text.endswith("🛍 Sell"):
+                return "sell"
+            if text.startswith("/withdraw") or text.endswith("💸 Withdraw"):
+                return "withdraw"
+        return "other"
+    def allow(self, update) -> bool:
+        if not isinstance(update, Update):
+            return True
+        user = update.effective_user
+        if user is None or user.id == ADMIN_ID:
+            return True
+        action = self.action(update)
+        limit = self.limits.get(action)
+        if limit is None or limit.allow(user.id, time.monotonic()):
+            return True
+        metrics.inc("bot_updates_shed_total", action)
+        return False
+inbound_throttle = InboundThrottle({
+    "sell": parse_limit(INBOUND_LIMIT_SELL),
+    "withdraw": parse_limit(INBOUND_LIMIT_WITHDRAW),
+    "other": parse_limit(INBOUND_LIMIT_OTHER),
+})
+# ========================
+# Concurrency: per-user and per-resource locks
+# ========================
+# asyncio locks created on demand per key and dropped once nobody holds or waits for them.
+# Keys are tuples such as ("balance", 123) or ("submission", "7"). hold() takes several keys
+# in one global order so that two multi-key holders can never deadlock.
+class KeyedLocks:
+    def __init__(self):
+        self._locks = {} # key -> [asyncio.Lock, holders + waiters]
+    @contextlib.asynccontextmanager
+    async def hold(self, *keys):
+        entries = []
+        for key in sorted(set(keys), key=repr):
+            entry = self._locks.get(key)
+            if entry is None:
+                entry = self._locks[key] = [asyncio.Lock(), 0]
+            entry[1] += 1
+            entries.append((key, entry))
+        acquired = 0
+        try:
+            for key, entry in entries:
+                await entry[0].acquire()
+                acquired += 1
+            yield
+        finally:
+            for i, (key, entry) in enumerate(entries):
+                if i < acquired:
+                    entry[0].release()
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._locks[key]
+locks = KeyedLocks()
+def update_key(update):
+    if isinstance(update, Update):
+        if update.effective_user is not None:
+            return ("user", update.effective_user.id)
+        if update.effective_chat is not None:
+            return ("chat", update.effective_chat.id)
+    return None
+# Updates run concurrently (ApplicationBuilder.concurrent_updates), but the updates of one
+# user are processed one at a time so ConversationHandler state and user_data stay consistent.
+# The first update of a user runs in its concurrency slot and then drains whatever that user
+# sent meanwhile; those later updates are parked in the user's deque and give their slot
+# back at once, so a busy user holds one slot and never stalls everybody else.
+class MarketplaceApplication(Application):
+    polling = False # Updates come from getUpdates (see on_stop)
+    last_update_id = None # Highest update_id processed
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.pending = {} # update_key() -> deque of (update, arrival) waiting behind the one running
+    def add_handler(self, handler, group: int = 0):
+        instrument_handler(handler)
+        super().add_handler(handler, group)
+    async def stop(self):
+        # PTB's stop() processes every update already received before it returns
+        if self.update_queue.backlog:
+            logger.info(f"Draining {self.update_queue.backlog} in-flight update(s)")
+        await super().stop()
+    async def process_update(self, update):
+        start = time.perf_counter()
+        if isinstance(update, Update) and (self.last_update_id is None or update.update_id > self.last_update_id):
+            self.last_update_id = update.update_id
+        if not inbound_throttle.allow(update):
+            return
+        key = update_key(update)
+        queue = self.pending.get(key) if key is not None else None
+        if queue is not None:
+            # The update running for this user takes it next; it stays in the backlog until then
+            queue.append((update, start))
+            self.update_queue.hold()
+            return
+        if key is not None:
+            queue = self.pending[key] = collections.deque()
+        try:
+            await self._process_timed(update, start)
+            while queue:
+                update, start = queue.popleft()
+                try:
+                    await self._process_timed(update, start)
+                finally:
+                    self.update_queue.release()
+        finally:
+            if key is not None:
+                del self.pending[key]
+    async def _process_timed(self, update, start: float):
+        try:
+            await super().process_update(update)
+        except Exception as e:
+            logger.error(f"Failed to process update: {e}")
+        finally:
+            metrics.observe("bot_update_seconds", time.perf_counter() - start)
+# The application's update_queue. PTB moves updates off the queue into tasks as soon as they
+# arrive (concurrent_updates), so a plain maxsize would bound nothing. This queue counts an
+# update until the application calls task_done() after processing it, and put() waits / put_nowait()
+# raises QueueFull while that backlog is at the limit. Polling then simply stops fetching and
+# the webhook server answers 503.
+class UpdateQueue(asyncio.Queue):
+    def __init__(self, limit):
+        super().__init__()
+        self.limit = limit
+        self.backlog = 0
+        self._room = asyncio.Event()
+    def full(self):
+        return self.backlog >= self.limit
+    def put_nowait(self, item):
+        if self.full():
+            raise asyncio.QueueFull
+        super().put_nowait(item)
+        self.backlog += 1
+    async def put(self, item):
+        while self.full():
+            self._room.clear()
+            await self._room.wait()
+        self.put_nowait(item)
+    def task_done(self):
+        super().task_done()
+        self.release()
+    def hold(self):
+        # An update parked behind its user's running one (see MarketplaceApplication) counts
+        # until release(), although the application already called task_done() for it
+        self.backlog += 1
+    def release(self):
+        self.backlog -= 1
+        self._room.set()
+# ========================
+# Conversation persistence
+# ========================
+# PTB persistence on top of the store, so half-finished flows (ConversationHandler state and
+# context.user_data) survive a restart. Every CONVERSATION_FLUSH_SECONDS, and once more when
+# the application stops, PTB hands over the users and conversations touched since the last
+# run; user_data equal to what is already stored is skipped, so users who only pressed a
+# button cost nothing.
+class StorePersistence(BasePersistence):
+    def __init__(self, update_interval: float):
+        super().__init__(PersistenceInput(bot_data=False, chat_data=False, callback_data=False), update_interval)
+        self.saved = {} # user_id -> user_data as last stored
+    async def get_user_data(self):
+        self.saved = store.all_user_data()
+        return copy.deepcopy(self.saved)
+    async def update_user_data(self, user_id, data):
+        if data != self.saved.get(user_id, {}):
+            store.set_user_data(user_id, data)
+            if data:
+                self.saved[user_id] = data
+            else:
+                self.saved.pop(user_id, None)
+    async def drop_user_data(self, user_id):
+        await self.update_user_data(user_id, {})
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+    async def get_conversations(self, name):
+        return {key: state for key, (state, _) in store.conversations(name).items()}
+    async def update_conversation(self, name, key, new_state):
+        store.set_conversation(name, key, new_state, now())
+    async def flush(self):
+        pass # Each update above is already in the store
+    # Chat data, bot data and callback data are not used (see store_data)
+    async def get_chat_data(self):
+        return {}
+    async def get_bot_data(self):
+        return {}
+    async def get_callback_data(self):
+        return None
+    async def update_chat_data(self, chat_id, data):
+        pass
+    async def update_bot_data(self, data):
+        pass
+    async def update_callback_data(self, data):
+        pass
+    async def drop_chat_data(self, chat_id):
+        pass
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+    async def refresh_bot_data(self, bot_data):
+        pass
+expired_conversations = set() # (name, key) of restored conversations that ran out; ended on the user's next update
+def restore_conversation_timeouts(app):
+    # PTB restores conversations but not their timeouts, and its timeout jobs are internal. Each
+    # restored conversation gets a job of ours for what was left of conversation_timeout when it
+    # last changed, plus one flush interval so a step taken just before is already stored. If
+    # the conversation has not moved on by then (once it does, PTB runs its own timeout), the
+    # job ends it in the store and ConversationExpiry ends it in the handler.
+    restored = 0
+    for handlers in app.handlers.values():
+        for conv in handlers:
+            if not (isinstance(conv, ConversationHandler) and conv.persistent and conv.conversation_timeout):
+                continue
+            for key, (state, changed) in store.conversations(conv.name).items():
+                remaining = (parse_time(changed) or time.time()) + conv.conversation_timeout - time.time()
+                app.job_queue.run_once(expire_conversation, max(0, remaining + CONVERSATION_FLUSH_SECONDS), data=(conv.name, key, changed))
+                restored += 1
+    if restored:
+        logger.info(f"Restored {restored} conversation(s) in progress")
+async def expire_conversation(context: ContextTypes.DEFAULT_TYPE):
+    name, key, changed = context.job.data
+    entry = store.conversation(name, key)
+    if entry is None or entry[1] != changed:
+        return # Ended or moved on since the restart
+    store.set_conversation(name, key, None, now())
+    expired_conversations.add((name, key))
+class ConversationExpiry(BaseHandler):
+    # First handler of every state of a persistent conversation (see with_expiry): the next
+    # update of a user whose restored conversation expired ends it instead of continuing it
+    def __init__(self, name: str):
+        super().__init__(self.end)
+        self.name = name
+    def check_update(self, update):
+        if not (isinstance(update, Update) and update.effective_chat and update.effective_user):
+            return False
+        return (self.name, (update.effective_chat.id, update.effective_user.id)) in expired_conversations
+    async def end(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        expired_conversations.discard((self.name, (update.effective_chat.id, update.effective_user.id)))
+        if update.callback_query:
+            await update.callback_query.answer()
+        await update.effective_message.reply_text("⌛ This step timed out. Please start again.")
+        return ConversationHandler.END
+def with_expiry(name: str, states: dict):
+    return {state: [ConversationExpiry(name), *handlers] for state, handlers in states.items()}
+# ========================
+# Expiry of stale pending items
+# ========================
+# Submissions nobody decided on expire, unanswered admin reply prompts are sent again and
+# withdrawals left pending are brought back to the admin. A deal whose ownership transfer
+# was requested or done never expires (the seller may have handed the groups over already):
+# it is brought back to the admin too. Every watched item has one
+# deadline in a min-heap, so a tick pops only what is due: O(k log n) for k due items.
+# The store stays the source of truth: a popped item is read again, and one that moved on
+# (decided, answered, approved onto the longer TTL) is dropped or re-armed.
+class ExpirySweeper:
+    def __init__(self, store: Store):
+        self.store = store
+        self.heap = [] # (deadline, kind, id); kind "submission" | "request" | "withdrawal"
+        self.deadlines = {} # (kind, id) -> deadline of the item's live heap entry; other entries are stale
+    def _due(self, kind, item):
+        # Deadline in epoch seconds, None if items of this kind/status never expire
+        since = item.time
+        if kind == "submission":
+            if item.status == GroupStatus.PENDING:
+                hours = SUBMISSION_REVIEW_TTL_HOURS
+            else:
+                hours = SUBMISSION_DEAL_TTL_HOURS
+                since = item.changed or item.time
+        elif kind == "request":
+            hours = REQUEST_TTL_HOURS
+        else:
+            hours = WITHDRAWAL_REMIND_HOURS
+        start = parse_time(since)
+        return start + hours * 3600 if hours > 0 and start is not None else None
+    def _arm(self, kind, item_id, deadline):
+        key = (kind, item_id)
+        if deadline is None:
+            self.deadlines.pop(key, None)
+        elif self.deadlines.get(key) != deadline:
+            self.deadlines[key] = deadline
+            heapq.heappush(self.heap, (deadline, kind, item_id))
+    def watch(self, kind: str, item_id: str, item):
+        self._arm(kind, item_id, self._due(kind, item))
+    def load(self):
+        # One pass over the pending items at startup, then heapify: O(n)
+        items = [("submission", sub_id, sub) for sub_id, sub in self.store.submissions(statuses=SUBMISSION_STATUSES).items()]
+        items += [("request", msg_id, req) for msg_id, req in self.store.pending_requests().items()]
+        items += [("withdrawal", wid, wd) for wid, wd in self.store.pending_withdrawals().items()]
+        self.deadlines = {}
+        for kind, item_id, item in items:
+            deadline = self._due(kind, item)
+            if deadline is not None:
+                self.deadlines[(kind, item_id)] = deadline
+        self.heap = [(deadline, kind, item_id) for (kind, item_id), deadline in self.deadlines.items()]
+        heapq.heapify(self.heap)
+    def start(self, job_queue):
+        self.load()
+        logger.info(f"Expiry sweeper: watching {len(self.deadlines)} pending item(s)")
+        job_queue.run_repeating(self._job, SWEEP_INTERVAL_SECONDS, first=SWEEP_INTERVAL_SECONDS, name="expiry")
+    async def _job(self, context: ContextTypes.DEFAULT_TYPE):
+        await self.sweep(context.bot)
+    async def _expire_submission(self, sub_id, now_ts):
+        async with locks.hold(("submission", sub_id)):
+            sub = self.store.get_submission(sub_id)
+            if sub is None:
+                return None
+            deadline = self._due("submission", sub)
+            if deadline is None or deadline > now_ts:
+                self._arm("submission", sub_id, deadline)
+                return None
+            if sub.ownership_status in (OwnershipStatus.REQUESTED, OwnershipStatus.TRANSFERRED):
+                self._arm("submission", sub_id, now_ts + SUBMISSION_DEAL_TTL_HOURS * 3600)
+                return "escalated", sub
+            self.store.set_submission_status(sub_id, GroupStatus.EXPIRED)
+            return "expired", sub
+    async def _reask(self, bot, msg_id):
+        req = self.store.get_request(msg_id)
+        if req is None:
+            return None
+        sub_id = request_submission_id(req)
+        async with locks.hold(("submission", sub_id)):
+            if self.store.get_request(msg_id) is None:
+                return None # Answered meanwhile
+            sub = self.store.get_submission(sub_id) if sub_id else None
+            expected = GroupStatus.WAITING_COUNT if req.type == "count" else GroupStatus.WAITING_TARGET
+            if sub is not None and sub.status == expected:
+                await open_prompt(bot, req.type, sub_id, sub, reminder=True)
+            else:
+                sub_id = None # The submission moved on or expired: the prompt is just dropped
+            self.store.close_request(msg_id)
+            return sub_id
+    def _remind_withdrawal(self, wid, now_ts):
+        wd = self.store.get_withdrawal(wid)
+        if wd is None or wd.status != WithdrawalStatus.PENDING:
+            return None
+        self._arm("withdrawal", wid, now_ts + WITHDRAWAL_REMIND_HOURS * 3600)
+        return wd
+    async def sweep(self, bot):
+        now_ts = time.time()
+        due = []
+        while self.heap and self.heap[0][0] <= now_ts:
+            deadline, kind, item_id = heapq.heappop(self.heap)
+            if self.deadlines.get((kind, item_id)) == deadline:
+                del self.deadlines[(kind, item_id)]
+                due.append((kind, item_id))
+        expired, escalated, reasked, reminded = [], [], [], []
+        for kind, item_id in due:
+            try:
+                if kind == "submission":
+                    outcome = await self._expire_submission(item_id, now_ts)
+                    if outcome is not None:
+                        (expired if outcome[0] == "expired" else escalated).append(outcome[1])
+                elif kind == "request":
+                    sub_id = await self._reask(bot, item_id)
+                    if sub_id is not None:
+                        reasked.append(sub_id)
+                else:
+                    wd = self._remind_withdrawal(item_id, now_ts)
+                    if wd is not None:
+                        reminded.append(wd)
+            except Exception as e:
+                logger.error(f"Expiry sweeper: failed on {kind} {item_id}: {e}")
+                self._arm(kind, item_id, now_ts + SWEEP_INTERVAL_SECONDS)
+        if not (expired or escalated or reasked or reminded):
+            return
+        # One message per seller and one digest for the admin, however many items were due
+        by_seller = {}
+        for sub in expired:
+            by_seller.setdefault(sub.seller_id, []).append(sub)
+        for seller_id, subs in by_seller.items():
+            lines = ["⌛ No decision was made in time on these submissions, so they expired. You can submit the links again:"]
+            lines += [f"#{sub.id}: {', '.join(sub.links)}" for sub in subs]
+            for text in split_message(lines):
+                outbox.enqueue(seller_id, text)
+        lines = ["🧹 Stale pending items"]
+        if expired:
+            lines.append(f"⌛ Expired submissions: {', '.join(f'#{sub.id} (👤 {sub.seller_id})' for sub in expired)}")
+        if escalated:
+            lines.append(f"🤝 Deals with an ownership transfer open for over {SUBMISSION_DEAL_TTL_HOURS:g}h, not expired:")
+            lines += [f"#{sub.id} 👤 {sub.seller_id} ➝ 👤 {sub.ownership_target_id}, transfer {sub.ownership_status}" for sub in escalated]
+        if reasked:
+            lines.append(f"⏰ Reply prompts sent again for submissions: {', '.join(f'#{sub_id}' for sub_id in reasked)}")
+        if reminded:
+            lines.append(f"💸 Withdrawals pending over {WITHDRAWAL_REMIND_HOURS:g}h:")
+            lines += [f"#{wd.id} 👤 {wd.uid} ➝ {wd.amount}$ via {wd.method}, since {wd.time}" for wd in reminded]
+        for text in split_message(lines):
+            outbox.enqueue(ADMIN_ID, text)
+        logger.info(f"Expiry sweep: {len(expired)} expired, {len(escalated)} escalated, {len(reasked)} prompt(s) sent again, {len(reminded)} withdrawal reminder(s)")
+sweeper = ExpirySweeper(None)
+# ========================
+# Webhook server
+# ========================
+# A small asyncio HTTP/1.1 server (no extra dependencies) for Telegram's webhook deliveries.
+# Each POST is decoded into an Update and put on the application's UpdateQueue without
+# waiting: when the backlog is full the request gets 503 + Retry-After and Telegram
+# redelivers it later, so a burst is absorbed by Telegram instead of by our memory.
+class WebhookServer:
+    def __init__(self, update_queue, bot, path, secret, listen, port):
+        self.update_queue = update_queue
+        self.bot = bot
+        self.path = path
+        self.secret = secret
+        self.listen = listen
+        self.port = port
+        self.routes = {"/healthz": self.healthz} # GET path -> () -> (status, content type, body)
+        self.accepted = 0
+        self.rejected = 0
+        self._server = None
+        self._writers = set()
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve, self.listen, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+    async def close(self):
+        if self._server is None:
+            return
+        self._server.close()
+        for writer in list(self._writers):
+            writer.close()
+        await self._server.wait_closed()
+        self._server = None
+    def healthz(self):
+        body = json.dumps({"backlog": self.update_queue.backlog, "accepted": self.accepted, "rejected": self.rejected})
+        return 200, "application/json", body.encode()
+    def handle(self, method, path, headers, body):
+        # Returns (status, extra headers, content type, body).
+        path = path.split("?", 1)[0]
+        if method == "GET" and path in self.routes:
+            status, content_type, payload = self.routes[path]()
+            return status, {}, content_type, payload
+        if path != self.path:
+            return 404, {}, "text/plain", b"not found"
+        if method != "POST":
+            return 405, {"Allow": "POST"}, "text/plain", b"method not allowed"
+        if not self.secret or not hmac.compare_digest(headers.get("x-telegram-bot-api-secret-token", "").encode(), self.secret.encode()):
+            return 403, {}, "text/plain", b"forbidden"
+        try:
+            update = Update.de_json(json.loads(body), self.bot)
+        except Exception as e:
+            logger.warning(f"Rejected malformed webhook payload: {e}")
+            return 400, {}, "text/plain", b"bad update"
+        if update is None:
+            return 400, {}, "text/plain", b"bad update"
+        try:
+            self.update_queue.put_nowait(update)
+        except asyncio.QueueFull:
+            self.rejected += 1
+            return 503, {"Retry-After": "1"}, "text/plain", b"busy"
+        self.accepted += 1
+        return 200, {}, "text/plain", b"ok"
+    async def _serve(self, reader, writer):
+        self._writers.add(writer)
+        try:
+            while True:
+                line = await asyncio.wait_for(reader.readline(), WEBHOOK_IDLE_TIMEOUT)
+                if not line:
+                    break
+                method, path, version = line.decode("latin-1").split(None, 2)
+                headers = {}
+                while True:
+                    line = await asyncio.wait_for(reader.readline(), WEBHOOK_IDLE_TIMEOUT)
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length", "0"))
+                if length > WEBHOOK_MAX_BODY:
+                    await self._respond(writer, 413, {"Connection": "close"}, "text/plain", b"too large")
+                    break
+                body = await asyncio.wait_for(reader.readexactly(length), WEBHOOK_IDLE_TIMEOUT)
+                status, extra, content_type, payload = self.handle(method.upper(), path, headers, body)
+                keep_alive = headers.get("connection", "").lower() != "close" and not version.strip().upper().endswith("1.0")
+                if not keep_alive:
+                    extra["Connection"] = "close"
+                await self._respond(writer, status, extra, content_type, payload)
+                if not keep_alive:
+                    break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+    async def _respond(self, writer, status, extra, content_type, payload):
+        head = [f"HTTP/1.1 {status} {HTTPStatus(status).phrase}", f"Content-Type: {content_type}", f"Content-Length: {len(payload)}"]
+        head += [f"{name}: {value}" for name, value in extra.items()]
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + payload)
+        await writer.drain()
+# ========================
 # Handlers
 # ========================
 async def on_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -161,59 +3064,44 @@ async def on_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def cmd_price(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
     ensure_user(uid)
-    text = "📊 *Current Group Prices*\n\n"
-    user_custom = data["users"][str(uid)].get("custom_prices", {})
-    if user_custom:
-        text += "✨ *Your Custom Prices:*\n"
-        for k, v in user_custom.items():
-            text += f"📅 {k}: {v}\n"
-        text += "\n"
-    global_prices = data.get("global_prices", DEFAULT_PRICES)
-    text += "🌍 *Standard Prices:*\n"
-    for k, v in global_prices.items():
-        text += f"📅 {k}: {v}\n"
-    await update.message.reply_text(text, parse_mode="Markdown")
+    await update.message.reply_text(pricebook.text(uid), parse_mode="Markdown")
 async def cmd_balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
     ensure_user(uid)
-    bal = data["users"][str(uid)]["balance"]
+    bal = store.get_user(uid).balance
     await update.message.reply_text(f"💰 Your balance: ${bal:.2f}")
 async def cmd_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
     if uid != ADMIN_ID:
         await update.message.reply_text("❌ This command is for admin only.")
         return
-    # Calculate stats
-    total_users = len(data["users"])
-    users_last_24h = sum(1 for u in data["users"].values() if is_within_24_hours(u.get("start_time", "")))
-    total_groups_sold = sum(u.get("sales", 0) for u in data["users"].values())
-    groups_sold_last_24h = 0
-    for user_id, user_data in data["users"].items():
-        for group_key, group_info in data.get("pending_groups", {}).items():
-            if (
-                group_info["seller_id"] == user_id
-                and group_info.get("status") == "approved_waiting_target"
-                and is_within_24_hours(group_info.get("time", ""))
-            ):
-                groups_sold_last_24h += group_info.get("approved_count", 1)
+    # Counters are maintained by the store as changes happen
+    stats = store.stats()
+    now_ts = datetime.datetime.now(datetime.timezone.utc).timestamp()
     text = "📈 *Bot Statistics*\n\n"
-    text += f"👥 *Total Users*: {total_users}\n"
-    text += f"👥 *Users Joined (Last 24h)*: {users_last_24h}\n"
-    text += f"🛒 *Total Groups Sold*: {total_groups_sold}\n"
-    text += f"🛒 *Groups Sold (Last 24h)*: {groups_sold_last_24h}\n"
-    text += "\n*Detailed Breakdown*:\n"
-    for user_id, user_data in data["users"].items():
-        user_sales = user_data.get("sales", 0)
-        if user_sales > 0:
-            text += f"- User {user_id}: {user_sales} groups sold\n"
+    text += f"👥 *Total Users*: {stats['users']}\n"
+    text += f"👥 *Users Joined (Last 24h)*: {ring_total(stats['joined_24h'], now_ts)}\n"
+    text += f"🛒 *Total Groups Sold*: {stats['sold']}\n"
+    text += f"🛒 *Groups Sold (Last 24h)*: {ring_total(stats['sold_24h'], now_ts)}\n"
+    text += f"💸 *Withdrawals Approved*: {stats['withdrawals']} (${stats['withdrawn']:.2f})\n"
+    text += f"💸 *Withdrawals Approved (Last 24h)*: {ring_total(stats['withdrawals_24h'], now_ts)}\n"
+    text += f"\n*Top {STATS_TOP_SELLERS} Sellers*:\n"
+    for user_id, user_sales in store.top_sellers(STATS_TOP_SELLERS):
+        text += f"- User {user_id}: {user_sales} groups sold\n"
     await update.message.reply_text(text, parse_mode="Markdown")
+async def cmd_metrics(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("❌ This command is for admin only.")
+        return
+    for chunk in split_message(metrics.summary_lines()):
+        await update.message.reply_text(chunk)
 # ------------------------
 # SELL flow (Conversation)
 # ------------------------
 async def cmd_sell_entry(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
     ensure_user(uid)
-    if not data.get("sell_enabled", True):
+    if not store.sell_enabled():
         await update.message.reply_text("❌ Selling is currently disabled by admin.")
         return ConversationHandler.END
     keyboard = [
@@ -268,10 +3156,8 @@ async def sell_receive_link(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return SELL_LINK
     # Check for duplicates
-    s_uid = str(uid)
     ensure_user(uid)
-    existing_groups = data["users"][s_uid].get("groups", [])
-    duplicates = [link for link in valid_links if link in existing_groups]
+    duplicates = taken_links(uid, valid_links)
     if duplicates:
         await update.message.reply_text(
             f"❌ The following links were already submitted:\n{', '.join(duplicates)}\nPlease send new links or /cancel."
@@ -294,36 +3180,30 @@ async def sell_receive_year(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not year:
         await update.message.reply_text("❌ Year range cannot be empty. Please send a valid year (e.g., `2023`, `2016-22`).")
         return SELL_YEAR
-    global_prices = data.get("global_prices", DEFAULT_PRICES)
+    ensure_user(uid)
     # Validate year against global or custom prices
-    if year not in global_prices and year not in data["users"][str(uid)].get("custom_prices", {}):
+    if pricebook.price(uid, year) is None:
         await update.message.reply_text(
-            f"❌ Invalid year range. Please use one of: {', '.join(global_prices.keys())} or your custom price ranges."
+            f"❌ Invalid year range. Please use one of: {', '.join(pricebook.global_table())} or your custom price ranges."
         )
         return SELL_YEAR
-    s_uid = str(uid)
     links = context.user_data.get("sell_links", [])
     if not links:
         await update.message.reply_text("❌ No links found. Please start over with /sell.")
         return ConversationHandler.END
-    # Store each link as a pending group/folder
+    # Another seller may have listed one of these links since they were checked
+    taken = taken_links(uid, links)
+    if taken:
+        context.user_data.pop("sell_links", None)
+        await update.message.reply_text(
+            f"❌ The following links were already submitted:\n{', '.join(taken)}\nPlease send new links or /cancel."
+        )
+        return SELL_LINK
+    # Store the links as one pending submission
     try:
-        for link in links:
-            data["pending_groups"][f"{s_uid}:{link}"] = {
-                "link": link,
-                "year": year,
-                "time": now(),
-                "seller_id": s_uid,
-                "ownership_status": "none",
-                "ownership_target_id": None,
-                "status": "pending",
-                "type": context.user_data.get("sell_type", "single")
-            }
-            data["users"].setdefault(s_uid, {"balance": 0.0, "groups": [], "sales": 0, "withdraw_history": [], "custom_prices": {}, "start_time": now()})
-            if link not in data["users"][s_uid]["groups"]: # Prevent duplicates
-                data["users"][s_uid]["groups"].append(link)
-        save_data(data)
-        logger.info(f"User {uid} submitted year {year} for links: {links}")
+        sub_id = store.submit_groups(uid, links, year, context.user_data.get("sell_type", "single"), now())
+        sweeper.watch("submission", sub_id, store.get_submission(sub_id))
+        logger.info(f"User {uid} submitted #{sub_id} with year {year} for links: {links}")
     except Exception as e:
         logger.error(f"Failed to save pending groups for user {uid}: {e}")
         await update.message.reply_text("❌ An error occurred while processing your submission. Please try again or contact admin.")
@@ -333,27 +3213,19 @@ async def sell_receive_year(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Notify admin with all links
     kb = [
         [
-            InlineKeyboardButton("✅ Approve", callback_data=f"approve_group:{s_uid}"),
-            InlineKeyboardButton("❌ Reject", callback_data=f"reject_group:{s_uid}"),
+            InlineKeyboardButton("✅ Approve", callback_data=f"approve_group:{sub_id}"),
+            InlineKeyboardButton("❌ Reject", callback_data=f"reject_group:{sub_id}"),
         ]
     ]
     links_text = "\n".join(links)
-    text = f"🆕 New submission\nUser: @{update.effective_user.username or update.effective_user.first_name} (ID: {uid})\nLinks:\n{links_text}\nYear: {year}\nTime: {now()}"
-    try:
-        await context.bot.send_message(
-            ADMIN_ID,
-            text,
-            reply_markup=InlineKeyboardMarkup(kb),
-        )
-        # Forward to links channel without buttons
-        await context.bot.send_message(
-            LINKS_CHANNEL,
-            text,
-        )
-    except Exception as e:
-        logger.error(f"Failed to notify admin or forward to links channel for user {uid}: {e}")
-        await update.message.reply_text("❌ Failed to notify admin. Please try again later or contact support.")
-        return ConversationHandler.END
+    text = f"🆕 New submission #{sub_id}\nUser: @{update.effective_user.username or update.effective_user.first_name} (ID: {uid})\nLinks:\n{links_text}\nYear: {year}\nTime: {now()}"
+    outbox.enqueue(
+        ADMIN_ID,
+        text,
+        reply_markup=InlineKeyboardMarkup(kb),
+    )
+    # Forward to the links channel's next digest, without buttons
+    channel_digest.post(LINKS_CHANNEL, text)
     context.user_data.pop("sell_type", None)
     await update.message.reply_text(f"✅ {len(links)} link(s) submitted to admin for review. You will be notified on approval/rejection.")
     return ConversationHandler.END
@@ -372,16 +3244,36 @@ async def universal_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # ------------------------
 # WITHDRAW flow (Conversation)
 # ------------------------
+def withdrawal_line(wd):
+    return f"#{wd.id} {wd.time}: {wd.amount}$ via {wd.method} — {wd.status}"
+def withdrawal_history_page(uid: int, before=None):
+    # One page of the user's history, newest first; the Older button carries whist:<cursor of the next page>
+    hist, cursor = store.withdrawal_history(uid, before, WITHDRAW_HISTORY_PAGE_SIZE)
+    if not hist:
+        return "", None
+    nav = []
+    if before is not None:
+        nav.append(InlineKeyboardButton("⏮ Latest", callback_data="whist:"))
+    if cursor is not None:
+        nav.append(InlineKeyboardButton("⬅️ Older", callback_data=f"whist:{cursor}"))
+    text = "🧾 Your withdraws:\n" + "\n".join(withdrawal_line(wd) for wd in hist)
+    return text, InlineKeyboardMarkup([nav]) if nav else None
+async def withdraw_history_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
+    await q.answer()
+    before = q.data.split(":", 1)[1] or None
+    text, markup = withdrawal_history_page(q.from_user.id, before)
+    if text:
+        await q.edit_message_text(text, reply_markup=markup)
 async def cmd_withdraw_entry(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
     if uid == ADMIN_ID:
         await update.message.reply_text("❌ This command is not available for admin.")
         return ConversationHandler.END
     ensure_user(uid)
-    hist = data["users"][str(uid)].get("withdraw_history", [])[-5:]
-    if hist:
-        lines = [f"{h['time']}: {h['amount']}$ via {h['method']} — {h['status']}" for h in hist]
-        await update.message.reply_text("🧾 Your recent withdraws:\n" + "\n".join(lines))
+    text, markup = withdrawal_history_page(uid)
+    if text:
+        await update.message.reply_text(text, reply_markup=markup)
     keyboard = [
         [InlineKeyboardButton("🏦 UPI", callback_data="method_upi")],
         [InlineKeyboardButton("🏦 Binance UID", callback_data="method_binance")],
@@ -416,237 +3308,435 @@ async def withdraw_get_amount(update: Update, context: ContextTypes.DEFAULT_TYPE
         await update.message.reply_text("❌ Invalid amount. Send numeric value.")
         return WITHDRAW_AMOUNT
     ensure_user(uid)
-    bal = data["users"][str(uid)]["balance"]
-    if amount > bal:
-        await update.message.reply_text(f"⚠️ Insufficient balance. Your balance: ${bal:.2f}")
-        return ConversationHandler.END
-    data["pending_withdrawals"][str(uid)] = {
-        "method": context.user_data["withdraw_method"],
-        "address": context.user_data["withdraw_address"],
-        "amount": amount,
-        "time": now(),
-    }
     rec = {
         "method": context.user_data["withdraw_method"],
         "address": context.user_data["withdraw_address"],
         "amount": amount,
-        "status": "Pending",
         "time": now()
     }
-    data["users"][str(uid)]["withdraw_history"].append(rec)
-    save_data(data)
+    # The store reserves the amount only if the balance covers it; the lock keeps other balance changes out meanwhile
+    async with locks.hold(("balance", uid)):
+        wid = store.open_withdrawal(uid, rec["method"], rec["address"], amount, rec["time"])
+        bal = store.get_user(uid).balance
+    if wid is None:
+        await update.message.reply_text(f"⚠️ Insufficient balance. Your balance: ${bal:.2f}")
+        return ConversationHandler.END
+    sweeper.watch("withdrawal", wid, store.get_withdrawal(wid))
     kb = [
         [
-            InlineKeyboardButton("✅ Approve", callback_data=f"approve_withdraw:{uid}"),
-            InlineKeyboardButton("❌ Reject", callback_data=f"reject_withdraw:{uid}"),
+            InlineKeyboardButton("✅ Approve", callback_data=f"approve_withdraw:{wid}"),
+            InlineKeyboardButton("❌ Reject", callback_data=f"reject_withdraw:{wid}"),
         ]
     ]
-    text = f"💸 Withdrawal request\nUser: {uid}\n{amount}$ via {rec['method']}\nAddress: {rec['address']}\nTime: {rec['time']}"
-    await context.bot.send_message(
+    text = f"💸 Withdrawal request #{wid}\nUser: {uid}\n{amount}$ via {rec['method']}\nAddress: {rec['address']}\nTime: {rec['time']}"
+    outbox.enqueue(
         ADMIN_ID,
         text,
         reply_markup=InlineKeyboardMarkup(kb)
     )
-    # Forward to withdrawals channel without buttons
-    try:
-        await context.bot.send_message(
-            WITHDRAW_CHANNEL,
-            text,
-        )
-    except Exception as e:
-        logger.error(f"Failed to forward to withdrawals channel: {e}")
+    # Forward to the withdrawals channel's next digest, without buttons
+    channel_digest.post(WITHDRAW_CHANNEL, text)
     await update.message.reply_text(
-        f"✅ Withdrawal request sent to admin.\n\nDetails:\nAmount: ${amount}\nMethod: {rec['method']}\nAddress: {rec['address']}\nTime: {rec['time']}\n\nYou can check status with /withdraw."
+        f"✅ Withdrawal request #{wid} sent to admin.\n\nDetails:\nAmount: ${amount}\nMethod: {rec['method']}\nAddress: {rec['address']}\nTime: {rec['time']}\n\nThe amount is held from your balance until admin decides. You can check status with /withdraw."
     )
     return ConversationHandler.END
 # ------------------------
 # ADMIN callbacks: groups & withdraws & panel actions
 # ------------------------
+def callback_resource_keys(data_payload: str):
+    # Resources a review callback reads and changes: one submission, a withdrawal and/or a balance
+    action, item_id = data_payload.split(":", 1)
+    if action in ("approve_withdraw", "reject_withdraw"):
+        wd = callback_withdrawal(item_id)
+        return [("withdrawal", wd.id), ("balance", wd.uid)] if wd else [("withdrawal", item_id)]
+    if action in ("approve_group", "reject_group"):
+        sub = callback_submission(item_id)
+        item_id = sub.id if sub else item_id
+    keys = [("submission", item_id)]
+    if action == "verify_ownership":
+        sub = store.get_submission(item_id)
+        if sub is not None:
+            keys.append(("balance", sub.seller_id))
+    return keys
+def callback_withdrawal(item_id: str):
+    # Buttons sent before withdrawals had ids carry the user id instead
+    wd = store.get_withdrawal(item_id)
+    if wd is None and item_id.isdigit():
+        wd = next(iter(store.pending_withdrawals(int(item_id)).values()), None)
+    return wd
+def callback_submission(item_id: str):
+    # Approve/reject buttons sent before submissions had ids carry the seller's user id
+    # instead; they stand for that seller's pending submission when there is just one
+    sub = store.get_submission(item_id)
+    if sub is None and item_id.isdigit():
+        pending = store.submissions(seller_id=int(item_id), statuses=[GroupStatus.PENDING])
+        if len(pending) == 1:
+            sub = next(iter(pending.values()))
+    return sub
+def request_submission_id(req):
+    # Reply prompts opened before submissions existed only name the seller
+    if req.submission_id:
+        return req.submission_id
+    status = GroupStatus.WAITING_COUNT if req.type == "count" else GroupStatus.WAITING_TARGET
+    return next(iter(store.submissions(seller_id=req.seller_id, statuses=[status])), None)
+async def open_prompt(bot, req_type: str, sub_id: str, sub, reminder: bool = False):
+    # Ask the admin for a submission's group count ("count") or buyer ("buyer"); the reply is matched by message id
+    links_text = "\n".join(sub.links)
+    if req_type == "count":
+        text = f"Since this includes folder(s), please reply to this message with the total number of approved groups (counting folders' contents) for submission #{sub_id} of user {sub.seller_id}:\n{links_text}"
+    else:
+        text = f"Please reply to this message with the Telegram @username or numeric ID of the buyer for submission #{sub_id} of user {sub.seller_id}:\n{links_text}"
+    if reminder:
+        text = "⏰ Still waiting for your reply.\n" + text
+    sent_msg = await bot.send_message(ADMIN_ID, text)
+    msg_id = str(sent_msg.message_id)
+    store.open_request(msg_id, req_type, sub.seller_id, sub_id, now())
+    sweeper.watch("request", msg_id, store.get_request(msg_id))
+    return msg_id
+async def open_prompts(bot, subs):
+    # Reply prompts for bulk-approved submissions, paced like every other send to the admin chat
+    for sub in subs:
+        req_type = "count" if sub.type == "folder" else "buyer"
+        for attempt in range(3):
+            await send_limiter.acquire(ADMIN_ID)
+            try:
+                await open_prompt(bot, req_type, sub.id, sub)
+                break
+            except RetryAfter as e:
+                send_limiter.retry_after(e.retry_after)
+            except TelegramError as e:
+                logger.error(f"Failed to ask for the {req_type} of submission #{sub.id}: {e}")
+                break
+prompt_tasks = set() # Running ask_in_background() tasks; cancelled on stop, what is left is asked at the next start
+def ask_in_background(bot, subs):
+    task = asyncio.get_running_loop().create_task(open_prompts(bot, subs))
+    prompt_tasks.add(task)
+    task.add_done_callback(prompt_tasks.discard)
+def unprompted_submissions():
+    # Approved submissions still waiting for a count or buyer that no open reply prompt asks for
+    prompted = {request_submission_id(req) for req in store.pending_requests().values()}
+    subs = store.submissions(statuses=[GroupStatus.WAITING_COUNT, GroupStatus.WAITING_TARGET])
+    return [sub for sub_id, sub in subs.items() if sub_id not in prompted and (sub.status == GroupStatus.WAITING_COUNT or sub.ownership_target_id is None)]
 async def admin_callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     await q.answer()
-    data_payload = q.data
+    data_payload, _, review = q.data.partition("|") # review: "<queue>.<cursor>" when pressed on a review page
+    async with locks.hold(*callback_resource_keys(data_payload)):
+        await process_admin_callback(update, context, data_payload)
+        if review:
+            queue, cursor = review.split(".")
+            action, item_id = data_payload.split(":", 1)
+            if queue == "g" and item_id in review_selection(context):
+                review_selection(context).remove(item_id)
+            await show_review_page(q, queue, int(cursor, 36), notice=f"{REVIEW_NOTICES.get(action, '✔️ Done')}: {item_id}", selected=review_selection(context))
+async def process_admin_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, data_payload: str):
+    q = update.callback_query
     # Group approvals
     if data_payload.startswith("approve_group:") or data_payload.startswith("reject_group:"):
-        action, uid_s = data_payload.split(":")
-        s_uid = str(uid_s)
-        # Find all pending groups/folders for this user
-        user_pending = {k: v for k, v in data["pending_groups"].items() if v["seller_id"] == s_uid and v["status"] == "pending"}
-        if not user_pending:
-            await q.edit_message_text("⚠️ No pending submissions found for this user.")
+        action, item_id = data_payload.split(":")
+        sub = callback_submission(item_id)
+        if sub is None:
+            # Processed and gone, or an old per-seller button that matches several submissions
+            await q.edit_message_text("⌛ This button has expired. Open the pending groups from the admin panel to review what is left.")
+            return
+        if sub.status != GroupStatus.PENDING:
+            await q.edit_message_text("⚠️ This submission was already processed.")
             return
+        sub_id, seller_id = sub.id, sub.seller_id
+        links_text = "\n".join(sub.links)
         if action == "reject_group":
-            rejected_links = [info["link"] for info in user_pending.values()]
-            for key in list(user_pending.keys()):
-                data["pending_groups"].pop(key, None)
-            save_data(data)
-            try:
-                await context.bot.send_message(
-                    int(s_uid),
-                    f"❌ Your submission(s) were rejected by admin:\n" + "\n".join(rejected_links)
-                )
-            except:
-                logger.warning(f"Failed to notify user {s_uid} of group rejection.")
-            await q.edit_message_text(f"❌ {len(user_pending)} submission(s) rejected.")
+            store.set_submission_status(sub_id, GroupStatus.REJECTED)
+            outbox.enqueue(
+                seller_id,
+                f"❌ Your submission #{sub_id} was rejected by admin:\n{links_text}"
+            )
+            await q.edit_message_text(f"❌ Submission #{sub_id} ({len(sub.links)} link(s)) rejected.")
             return
-        # action == approve_group:
-        for key, info in user_pending.items():
-            info["status"] = "approved_waiting_count"
-            info["seller_id"] = info.get("seller_id", s_uid)
-            info["ownership_status"] = info.get("ownership_status", "none")
-            info["ownership_target_id"] = info.get("ownership_target_id", None)
-            data["pending_groups"][key] = info
-        save_data(data)
-        # Check if submission includes folders
-        is_folder_submission = any(info["type"] == "folder" for info in user_pending.values())
-        await q.edit_message_text(f"✅ {len(user_pending)} submission(s) approved.")
-        links_text = "\n".join([info["link"] for info in user_pending.values()])
+        # action == approve_group: folders need the admin to count the groups inside
+        is_folder_submission = sub.type == "folder"
         if is_folder_submission:
-            sent_msg = await context.bot.send_message(
-                ADMIN_ID,
-                f"Since this includes folder(s), please reply to this message with the total number of approved groups (counting folders' contents) for user {s_uid}:\n{links_text}"
-            )
-            data["pending_requests"][str(sent_msg.message_id)] = {"type": "count", "seller_id": s_uid, "time": now()}
+            store.set_submission_status(sub_id, GroupStatus.WAITING_COUNT)
         else:
-            for key, info in user_pending.items():
-                info["approved_count"] = 1
-                info["status"] = "approved_waiting_target"
-            save_data(data)
-            sent_msg = await context.bot.send_message(
-                ADMIN_ID,
-                f"Please reply to this message with the Telegram @username or numeric ID of the buyer for these links of user {s_uid}:\n{links_text}"
+            store.set_submission_status(sub_id, GroupStatus.WAITING_TARGET, approved_count=len(sub.links))
+        await q.edit_message_text(f"✅ Submission #{sub_id} ({len(sub.links)} link(s)) approved.")
+        if is_folder_submission:
+            await open_prompt(context.bot, "count", sub_id, sub)
+        else:
+            await open_prompt(context.bot, "buyer", sub_id, sub)
+            outbox.enqueue(
+                seller_id,
+                f"✅ Your submission #{sub_id} was approved by admin:\n{links_text}\nAdmin will send buyer ID for transfer shortly."
             )
-            data["pending_requests"][str(sent_msg.message_id)] = {"type": "buyer", "seller_id": s_uid, "time": now()}
-            try:
-                await context.bot.send_message(
-                    int(s_uid),
-                    f"✅ Your submission(s) were approved by admin:\n{links_text}\nAdmin will send buyer ID for transfer shortly."
-                )
-            except:
-                logger.warning(f"Failed to notify user {s_uid} of group approval.")
-        save_data(data)
         return
     # Withdraw approvals
     if data_payload.startswith("approve_withdraw:") or data_payload.startswith("reject_withdraw:"):
-        action, uid_s = data_payload.split(":")
-        s_uid = str(uid_s)
-        if s_uid not in data["pending_withdrawals"]:
+        action, item_id = data_payload.split(":")
+        wd = callback_withdrawal(item_id)
+        if wd is None or wd.status != WithdrawalStatus.PENDING:
             await q.edit_message_text("⚠️ This withdrawal was processed or not found.")
             return
-        wd = data["pending_withdrawals"].pop(s_uid)
-        hist = data["users"].get(s_uid, {}).get("withdraw_history", [])
-        for rec in reversed(hist):
-            if rec["status"] == "Pending" and rec["amount"] == wd["amount"] and rec["method"] == wd["method"]:
-                rec["status"] = "Approved" if action == "approve_withdraw" else "Rejected"
-                break
+        store.close_withdrawal(wd.id, WithdrawalStatus.APPROVED if action == "approve_withdraw" else WithdrawalStatus.REJECTED, now())
         if action == "approve_withdraw":
-            data["users"].setdefault(s_uid, {"balance": 0.0, "groups": [], "sales": 0, "withdraw_history": [], "custom_prices": {}, "start_time": now()})
-            data["users"][s_uid]["balance"] = max(0.0, data["users"][s_uid]["balance"] - float(wd["amount"]))
-            try:
-                await context.bot.send_message(int(s_uid), f"✅ Your withdrawal of ${wd['amount']} has been approved and processed.")
-            except:
-                logger.warning(f"Failed to notify user {s_uid} of withdrawal approval.")
-            await q.edit_message_text("✅ Withdrawal approved and processed.")
+            outbox.enqueue(wd.uid, f"✅ Your withdrawal #{wd.id} of ${wd.amount} has been approved and processed.")
+            await q.edit_message_text(f"✅ Withdrawal #{wd.id} approved and processed.")
         else:
-            try:
-                await context.bot.send_message(int(s_uid), f"❌ Your withdrawal of ${wd['amount']} has been rejected.")
-            except:
-                logger.warning(f"Failed to notify user {s_uid} of withdrawal rejection.")
-            await q.edit_message_text("❌ Withdrawal rejected.")
-        save_data(data)
+            outbox.enqueue(wd.uid, f"❌ Your withdrawal #{wd.id} of ${wd.amount} has been rejected. The amount is back in your balance.")
+            await q.edit_message_text(f"❌ Withdrawal #{wd.id} rejected.")
         return
     # Seller pressed ownership-submitted button
     if data_payload.startswith("submit_ownership:"):
-        action, s_uid = data_payload.split(":")
-        s_uid = str(s_uid)
-        user_pending = {k: v for k, v in data["pending_groups"].items() if v["seller_id"] == s_uid and v["status"] == "approved_waiting_target"}
-        if not user_pending:
-            await q.edit_message_text("⚠️ No pending submissions found for this user.")
+        action, sub_id = data_payload.split(":")
+        sub = store.get_submission(sub_id)
+        if sub is None or sub.status != GroupStatus.WAITING_TARGET:
+            await q.edit_message_text("⚠️ No pending submission found.")
             return
-        if str(q.from_user.id) != str(s_uid):
+        seller_id = sub.seller_id
+        if q.from_user.id != seller_id:
             await q.answer("❌ Only the seller can press this.")
             return
-        for key, info in user_pending.items():
-            info["ownership_status"] = "transferred"
-            data["pending_groups"][key] = info
-        save_data(data)
+        store.set_ownership(sub_id, OwnershipStatus.TRANSFERRED)
         kb = [
             [
-                InlineKeyboardButton("✅ Ownership Verified", callback_data=f"verify_ownership:{s_uid}"),
-                InlineKeyboardButton("❌ Ownership Failed", callback_data=f"reject_ownership:{s_uid}"),
+                InlineKeyboardButton("✅ Ownership Verified", callback_data=f"verify_ownership:{sub_id}"),
+                InlineKeyboardButton("❌ Ownership Failed", callback_data=f"reject_ownership:{sub_id}"),
             ]
         ]
-        links_text = "\n".join([info["link"] for info in user_pending.values()])
-        text = f"👤 Seller submitted ownership transfer for:\n{links_text}\nTarget: {list(user_pending.values())[0].get('ownership_target_id')}\nPlease verify."
-        try:
-            await context.bot.send_message(
-                ADMIN_ID,
-                text,
-                reply_markup=InlineKeyboardMarkup(kb)
-            )
-            # Forward to links channel without buttons
-            await context.bot.send_message(
-                LINKS_CHANNEL,
-                text,
-            )
-        except Exception as e:
-            logger.warning(f"Failed to notify admin or forward to channel of ownership submission for user {s_uid}: {e}")
-        await q.edit_message_text(f"✅ Ownership submitted for {len(user_pending)} link(s). Admin will verify shortly.")
+        links_text = "\n".join(sub.links)
+        text = f"👤 Seller {seller_id} submitted ownership transfer for submission #{sub_id}:\n{links_text}\nTarget: {sub.ownership_target_id}\nPlease verify."
+        outbox.enqueue(
+            ADMIN_ID,
+            text,
+            reply_markup=InlineKeyboardMarkup(kb)
+        )
+        # Forward to the links channel's next digest, without buttons
+        channel_digest.post(LINKS_CHANNEL, text)
+        await q.edit_message_text(f"✅ Ownership submitted for {len(sub.links)} link(s). Admin will verify shortly.")
         return
     # Ownership verification callbacks
     if data_payload.startswith("verify_ownership:") or data_payload.startswith("reject_ownership:"):
-        action, s_uid = data_payload.split(":")
-        s_uid = str(s_uid)
-        user_pending = {k: v for k, v in data["pending_groups"].items() if v["seller_id"] == s_uid and v["status"] == "approved_waiting_target"}
-        if not user_pending:
+        action, sub_id = data_payload.split(":")
+        sub = store.get_submission(sub_id)
+        if sub is None or sub.status != GroupStatus.WAITING_TARGET:
             await q.edit_message_text("⚠️ No pending ownership records found.")
             return
+        seller_id = sub.seller_id
+        links_text = "\n".join(sub.links)
         if action == "verify_ownership":
-            data["users"].setdefault(s_uid, {"balance": 0.0, "groups": [], "sales": 0, "withdraw_history": [], "custom_prices": {}, "start_time": now()})
-            custom_prices = data["users"][s_uid].get("custom_prices", {})
-            global_prices = data.get("global_prices", DEFAULT_PRICES)
-            total_credited = 0.0
-            # Get approved_count from the first entry (assuming same for all in submission)
-            approved_count = list(user_pending.values())[0].get("approved_count", len(user_pending))
-            year = list(user_pending.values())[0].get("year")
-            price_str = custom_prices.get(year, global_prices.get(year, "1$"))
-            try:
-                price = float(price_str.replace("$", ""))
-            except ValueError:
-                price = 1.0
-            total_credited = price * approved_count
-            data["users"][s_uid]["sales"] = data["users"][s_uid].get("sales", 0) + approved_count
-            for key in list(user_pending.keys()):
-                data["pending_groups"].pop(key)
-            data["users"][s_uid]["balance"] += total_credited
-            save_data(data)
-            links_text = "\n".join([info["link"] for info in user_pending.values()])
-            try:
-                await context.bot.send_message(
-                    int(s_uid),
-                    f"✅ Ownership verified for {len(user_pending)} link(s) ({approved_count} groups):\n{links_text}\n${total_credited:.2f} credited to your balance."
-                )
-            except:
-                logger.warning(f"Failed to notify user {s_uid} of ownership verification.")
-            await q.edit_message_text(f"✅ Ownership verified for {len(user_pending)} link(s) ({approved_count} groups). ${total_credited:.2f} credited to seller.")
+            ensure_user(seller_id)
+            approved_count = sub.approved_count or len(sub.links)
+            price = pricebook.price(seller_id, sub.year)
+            if price is None:
+                await q.edit_message_text(f"⚠️ No price is set for year {sub.year} (seller {seller_id}). Set one, then verify again.")
+                return
+            total_credited = price * approved_count / 100
+            store.sell_submission(sub_id, approved_count, total_credited, now())
+            outbox.enqueue(
+                seller_id,
+                f"✅ Ownership verified for {len(sub.links)} link(s) ({approved_count} groups):\n{links_text}\n${total_credited:.2f} credited to your balance."
+            )
+            await q.edit_message_text(f"✅ Ownership verified for submission #{sub_id} ({approved_count} groups). ${total_credited:.2f} credited to seller.")
         else:
-            for key, info in user_pending.items():
-                info["ownership_status"] = "failed"
-                data["pending_groups"][key] = info
-            save_data(data)
-            links_text = "\n".join([info["link"] for info in user_pending.values()])
-            try:
-                await context.bot.send_message(
-                    int(s_uid),
-                    f"❌ Ownership verification FAILED for:\n{links_text}\nPlease re-transfer and press the Ownership Submitted button again."
-                )
-            except:
-                logger.warning(f"Failed to notify user {s_uid} of ownership verification failure.")
-            await q.edit_message_text(f"❌ Ownership verification marked as failed for {len(user_pending)} link(s) and seller notified.")
+            store.set_ownership(sub_id, OwnershipStatus.FAILED)
+            outbox.enqueue(
+                seller_id,
+                f"❌ Ownership verification FAILED for:\n{links_text}\nPlease re-transfer and press the Ownership Submitted button again."
+            )
+            await q.edit_message_text(f"❌ Ownership verification marked as failed for submission #{sub_id} and seller notified.")
         return
 # ------------------------
 # Admin panel (Conversation)
 # ------------------------
+# Review queues: one admin message per queue, edited in place on every page turn. Buttons
+# carry review:<queue>:<n|p>:<cursor>, where the cursor is the store's position (base 36) of
+# the page boundary. Approve/reject buttons on a page append "|<queue>.<cursor>" so the page
+# is redrawn after the action instead of being replaced by its result.
+REVIEW_QUEUES = {"g": "groups", "w": "withdrawals"}
+REVIEW_NOTICES = {"approve_group": "✅ Approved", "reject_group": "❌ Rejected", "approve_withdraw": "✅ Approved", "reject_withdraw": "❌ Rejected"}
+def to_b36(n: int) -> str:
+    digits = ""
+    while True:
+        n, r = divmod(n, 36)
+        digits = "0123456789abcdefghijklmnopqrstuvwxyz"[r] + digits
+        if n == 0:
+            return digits
+def review_entry_text(queue: str, n: int, item_id: str):
+    if queue == "w":
+        w = store.get_withdrawal(item_id)
+        return f"{n}. #{item_id} 👤 {w.uid} ➝ {w.amount}$ via {w.method} ({w.address})"
+    sub = store.get_submission(item_id)
+    text = f"{n}. #{item_id} 👤 Seller {sub.seller_id} — Year: {sub.year or 'N/A'}, Type: {sub.type}, submitted {sub.time}\n"
+    return text + "\n".join(f"   - {link}" for link in sub.links)
+async def show_review_page(q, queue: str, cursor: int = 0, backward: bool = False, notice: str = "", selected=()):
+    entries, has_prev, has_next, total = store.review_page(REVIEW_QUEUES[queue], cursor, REVIEW_PAGE_SIZE, backward)
+    if not entries and total:
+        # The page emptied under us (its entries were handled); show the neighbouring one
+        entries, has_prev, has_next, total = store.review_page(REVIEW_QUEUES[queue], cursor, REVIEW_PAGE_SIZE, not backward)
+    title = "👥 Pending groups/folders" if queue == "g" else "💸 Pending withdrawals"
+    head = f"{notice}\n\n" if notice else ""
+    if not entries:
+        await q.edit_message_text(head + ("📭 No pending groups or folders." if queue == "g" else "📭 No pending withdrawals."))
+        return
+    start = entries[0][0] - 1
+    back = f"|{queue}.{to_b36(start)}"
+    action = "group" if queue == "g" else "withdraw"
+    lines, kb = [], []
+    for n, (_, item_id) in enumerate(entries, 1):
+        lines.append(review_entry_text(queue, n, item_id))
+        row = [
+            InlineKeyboardButton(f"✅ Approve {n}", callback_data=f"approve_{action}:{item_id}{back}"),
+            InlineKeyboardButton(f"❌ Reject {n}", callback_data=f"reject_{action}:{item_id}{back}"),
+        ]
+        if queue == "g":
+            row.append(InlineKeyboardButton(f"{'☑️' if item_id in selected else '⬜'} {n}", callback_data=f"review_pick:{item_id}{back}"))
+        kb.append(row)
+    if queue == "g":
+        picks = [InlineKeyboardButton("☑️ Select page", callback_data=f"review_pick:page{back}")]
+        if selected:
+            picks.append(InlineKeyboardButton("✖️ Clear selection", callback_data=f"review_pick:clear{back}"))
+            kb.append(picks)
+            kb.append([
+                InlineKeyboardButton(f"✅ Approve selected ({len(selected)})", callback_data=f"review_bulk:approve{back}"),
+                InlineKeyboardButton(f"❌ Reject selected ({len(selected)})", callback_data=f"review_bulk:reject{back}"),
+            ])
+        else:
+            kb.append(picks)
+    nav = []
+    if has_prev:
+        nav.append(InlineKeyboardButton("⬅️ Prev", callback_data=f"review:{queue}:p:{to_b36(entries[0][0])}"))
+    nav.append(InlineKeyboardButton("🔄 Refresh", callback_data=f"review:{queue}:n:{to_b36(start)}"))
+    if has_next:
+        nav.append(InlineKeyboardButton("Next ➡️", callback_data=f"review:{queue}:n:{to_b36(entries[-1][0])}"))
+    kb.append(nav)
+    await q.edit_message_text(f"{head}{title} — {total} in queue\n\n" + "\n\n".join(lines), reply_markup=InlineKeyboardMarkup(kb))
+async def review_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
+    if q.from_user.id != ADMIN_ID:
+        await q.answer("❌ Only admin.")
+        return
+    await q.answer()
+    _, queue, direction, cursor = q.data.split(":")
+    try:
+        await show_review_page(q, queue, int(cursor, 36), backward=direction == "p", selected=review_selection(context))
+    except BadRequest as e:
+        if "not modified" not in str(e).lower(): # Refresh of an unchanged page
+            raise
+# ------------------------
+# Bulk moderation
+# ------------------------
+# Many pending submissions approved or rejected at once, either picked on the review pages
+# (the picks live in the admin's user_data) or matched by /bulk. The status changes and the
+# sellers' notifications, one message per seller, are a single store change; the outbox
+# then delivers the notifications in parallel and the reply prompts for the approved ones
+# follow in the background.
+def review_selection(context) -> list:
+    return context.user_data.setdefault("review_selected", [])
+async def bulk_moderate(context, sub_ids, approve: bool):
+    # -> the submissions decided; ids no longer pending are skipped
+    async with locks.hold(*(("submission", sub_id) for sub_id in sub_ids)):
+        subs = [sub for sub in map(store.get_submission, sub_ids) if sub is not None and sub.status == GroupStatus.PENDING]
+        decisions, by_seller = [], {}
+        for sub in subs:
+            links_text = "\n".join(sub.links)
+            if not approve:
+                decisions.append((sub.id, GroupStatus.REJECTED, None))
+                by_seller.setdefault(sub.seller_id, []).append(f"❌ Your submission #{sub.id} was rejected by admin:\n{links_text}")
+            elif sub.type == "folder":
+                decisions.append((sub.id, GroupStatus.WAITING_COUNT, None))
+            else:
+                decisions.append((sub.id, GroupStatus.WAITING_TARGET, len(sub.links)))
+                by_seller.setdefault(sub.seller_id, []).append(f"✅ Your submission #{sub.id} was approved by admin:\n{links_text}\nAdmin will send buyer ID for transfer shortly.")
+        entries = [outbox.entry(seller_id, text) for seller_id, texts in by_seller.items() for text in split_message("\n\n".join(texts).split("\n"))]
+        if decisions:
+            store.moderate_submissions(decisions, entries)
+            outbox.push(entries)
+    if approve and subs:
+        ask_in_background(context.bot, subs)
+    logger.info(f"Bulk {'approval' if approve else 'rejection'} of {len(subs)} submission(s), {len(sub_ids) - len(subs)} skipped")
+    return subs
+def bulk_notice(approve: bool, done: int, asked: int) -> str:
+    text = f"{'✅ Approved' if approve else '❌ Rejected'} {done} submission(s)"
+    if asked > done:
+        text += f", {asked - done} already handled"
+    return text
+async def cmd_bulk(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("❌ This command is for admin only.")
+        return
+    args = context.args or []
+    if not args or args[0].lower() not in ("approve", "reject"):
+        await update.message.reply_text("Usage: /bulk approve|reject [year] [single|folder]\nExample: /bulk approve 2023 single")
+        return
+    action = args[0].lower()
+    sub_type, year_words = None, []
+    for word in args[1:]:
+        if word.lower() in ("single", "folder"):
+            sub_type = word.lower()
+        else:
+            year_words.append(word)
+    year = " ".join(year_words) or None
+    ids = [
+        sub_id for sub_id, sub in store.submissions(statuses=[GroupStatus.PENDING]).items()
+        if (year is None or sub.year == year) and (sub_type is None or sub.type == sub_type)
+    ]
+    if not ids:
+        await update.message.reply_text("📭 No pending submissions match.")
+        return
+    context.user_data["bulk"] = {"action": action, "ids": ids}
+    scope = ", ".join(part for part in (f"year {year}" if year else "", sub_type or "") if part)
+    kb = [[
+        InlineKeyboardButton("✅ Confirm", callback_data="bulk:confirm"),
+        InlineKeyboardButton("✖️ Cancel", callback_data="bulk:cancel"),
+    ]]
+    await update.message.reply_text(
+        f"{'✅ Approve' if action == 'approve' else '❌ Reject'} {len(ids)} pending submission(s){f' ({scope})' if scope else ''}?",
+        reply_markup=InlineKeyboardMarkup(kb),
+    )
+async def bulk_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
+    if q.from_user.id != ADMIN_ID:
+        await q.answer("❌ Only admin.")
+        return
+    await q.answer()
+    payload, _, review = q.data.partition("|") # review: "<queue>.<cursor>" of the page pressed on
+    kind, _, arg = payload.partition(":")
+    if kind == "bulk":
+        pending = context.user_data.pop("bulk", None)
+        if pending is None:
+            await q.edit_message_text("⚠️ Nothing to confirm.")
+            return
+        if arg != "confirm":
+            await q.edit_message_text("✖️ Bulk action cancelled.")
+            return
+        approve = pending["action"] == "approve"
+        subs = await bulk_moderate(context, pending["ids"], approve)
+        await q.edit_message_text(bulk_notice(approve, len(subs), len(pending["ids"])))
+        return
+    queue, cursor = review.split(".")
+    cursor = int(cursor, 36)
+    selected = review_selection(context)
+    notice = ""
+    if kind == "review_pick":
+        if arg == "clear":
+            selected.clear()
+        elif arg == "page":
+            page = [item_id for _, item_id in store.review_page(REVIEW_QUEUES[queue], cursor, REVIEW_PAGE_SIZE)[0]]
+            if all(item_id in selected for item_id in page):
+                selected[:] = [item_id for item_id in selected if item_id not in page]
+            else:
+                selected.extend(item_id for item_id in page if item_id not in selected)
+        elif arg in selected:
+            selected.remove(arg)
+        else:
+            selected.append(arg)
+    else:
+        approve = arg == "approve"
+        ids = list(selected)
+        selected.clear()
+        subs = await bulk_moderate(context, ids, approve)
+        notice = bulk_notice(approve, len(subs), len(ids))
+    # Picks that left the queue meanwhile (handled one by one, expired) are dropped
+    selected[:] = [item_id for item_id in selected if (sub := store.get_submission(item_id)) is not None and sub.status == GroupStatus.PENDING]
+    await show_review_page(q, queue, cursor, notice=notice, selected=selected)
 async def admin_panel_entry(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     if user.id != ADMIN_ID:
@@ -680,47 +3770,10 @@ async def admin_panel_callback(update: Update, context: ContextTypes.DEFAULT_TYP
         await q.edit_message_text("💰 Custom Price — choose:", reply_markup=InlineKeyboardMarkup(kb))
         return ADMIN_PANEL
     if key == "admin_pending_groups":
-        if not data["pending_groups"]:
-            await q.edit_message_text("📭 No pending groups or folders.")
-            return ADMIN_PANEL
-        # Group pending submissions by seller_id
-        grouped_pending = {}
-        for key, info in data["pending_groups"].items():
-            if info["status"] == "pending":
-                seller_id = info["seller_id"]
-                grouped_pending.setdefault(seller_id, []).append(info)
-        for seller_id, infos in grouped_pending.items():
-            kb = [
-                [
-                    InlineKeyboardButton("✅ Approve", callback_data=f"approve_group:{seller_id}"),
-                    InlineKeyboardButton("❌ Reject", callback_data=f"reject_group:{seller_id}"),
-                ],
-            ]
-            links_text = "\n".join([f"- {info['link']} (Year: {info.get('year', 'N/A')}, Type: {info.get('type', 'single')})" for info in infos])
-            await context.bot.send_message(
-                ADMIN_ID,
-                f"👤 Seller ID: {seller_id}\nLinks:\n{links_text}\nSubmitted: {infos[0]['time']}",
-                reply_markup=InlineKeyboardMarkup(kb)
-            )
-        await q.edit_message_text("📋 Pending groups/folders shown above.")
+        await show_review_page(q, "g", selected=review_selection(context))
         return ADMIN_PANEL
     if key == "admin_pending_withdrawals":
-        if not data["pending_withdrawals"]:
-            await q.edit_message_text("📭 No pending withdrawals.")
-            return ADMIN_PANEL
-        for s_uid, w in list(data["pending_withdrawals"].items()):
-            kb = [
-                [
-                    InlineKeyboardButton("✅ Approve", callback_data=f"approve_withdraw:{s_uid}"),
-                    InlineKeyboardButton("❌ Reject", callback_data=f"reject_withdraw:{s_uid}"),
-                ],
-            ]
-            await context.bot.send_message(
-                ADMIN_ID,
-                f"👤 {s_uid} ➝ {w['amount']}$ via {w['method']} ({w['address']})",
-                reply_markup=InlineKeyboardMarkup(kb)
-            )
-        await q.edit_message_text("💸 Pending withdrawals shown above.")
+        await show_review_page(q, "w")
         return ADMIN_PANEL
     if key == "admin_add_balance":
         context.user_data["admin_mode"] = "add_balance"
@@ -731,9 +3784,9 @@ async def admin_panel_callback(update: Update, context: ContextTypes.DEFAULT_TYP
         await q.edit_message_text("🔍️ Send user ID to inspect:")
         return ADMIN_INSPECT_USER
     if key == "admin_toggle_sell":
-        data["sell_enabled"] = not data.get("sell_enabled", True)
-        save_data(data)
-        await q.edit_message_text(f"⚙️ Selling is now {'ENABLED' if data['sell_enabled'] else 'DISABLED'}.")
+        enabled = not store.sell_enabled()
+        store.set_sell_enabled(enabled)
+        await q.edit_message_text(f"⚙️ Selling is now {'ENABLED' if enabled else 'DISABLED'}.")
         return ADMIN_PANEL
     if key == "admin_broadcast":
         context.user_data["admin_mode"] = "broadcast"
@@ -785,16 +3838,14 @@ async def admin_add_amount_handler(update: Update, context: ContextTypes.DEFAULT
         await update.message.reply_text("❌ No target user set. Start again.")
         return ConversationHandler.END
     ensure_user(uid)
-    data["users"][str(uid)]["balance"] = data["users"][str(uid)].get("balance", 0.0) + amt
-    save_data(data)
-    await update.message.reply_text(f"✅ Added ${amt:.2f} to {uid}. New balance: ${data['users'][str(uid)]['balance']:.2f}")
-    try:
-        await context.bot.send_message(
-            uid,
-            f"💵 Admin added ${amt:.2f} to your balance. New balance: ${data['users'][str(uid)]['balance']:.2f}"
-        )
-    except:
-        logger.warning(f"Failed to notify user {uid} of balance addition.")
+    async with locks.hold(("balance", uid)):
+        store.credit(uid, amt)
+        new_balance = store.get_user(uid).balance
+    await update.message.reply_text(f"✅ Added ${amt:.2f} to {uid}. New balance: ${new_balance:.2f}")
+    outbox.enqueue(
+        uid,
+        f"💵 Admin added ${amt:.2f} to your balance. New balance: ${new_balance:.2f}"
+    )
     return ADMIN_PANEL
 async def admin_inspect_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != ADMIN_ID:
@@ -805,23 +3856,23 @@ async def admin_inspect_handler(update: Update, context: ContextTypes.DEFAULT_TY
         await update.message.reply_text("❌ Invalid user ID.")
         return ADMIN_INSPECT_USER
     ensure_user(uid)
-    u = data["users"][str(uid)]
-    pending_g = [info["link"] for key, info in data["pending_groups"].items() if info["seller_id"] == str(uid)]
-    pending_w = data["pending_withdrawals"].get(str(uid))
+    u = store.get_user(uid)
+    pending_g = [link for sub in store.submissions(seller_id=uid).values() for link in sub.links]
+    pending_w = [f"#{wid} {wd.amount}$" for wid, wd in store.pending_withdrawals(uid).items()]
     text = (
         f"🔎 User: {uid}\n"
-        f"💰 Balance: ${u['balance']:.2f}\n"
-        f"🛒 Total groups submitted: {len(u.get('groups', []))}\n"
-        f"✅ Sales (approved): {u.get('sales', 0)}\n"
+        f"💰 Balance: ${u.balance:.2f}\n"
+        f"🛒 Total groups submitted: {store.group_count(uid)}\n"
+        f"✅ Sales (approved): {u.sales}\n"
         f"⏳ Pending groups/folders: {', '.join(pending_g) if pending_g else 'None'}\n"
-        f"⏳ Pending withdraw: {pending_w['amount'] if pending_w else 'None'}\n"
-        f"📝 Withdraw history (last 5):\n"
+        f"⏳ Pending withdraws: {', '.join(pending_w) if pending_w else 'None'}\n"
+        f"📝 Withdraw history (last {WITHDRAW_HISTORY_PAGE_SIZE}):\n"
     )
-    for rec in u.get("withdraw_history", [])[-5:]:
-        text += f"- {rec['time']}: {rec['amount']}$ via {rec['method']} — {rec['status']}\n"
-    if u.get("custom_prices"):
+    for wd in store.withdrawal_history(uid, None, WITHDRAW_HISTORY_PAGE_SIZE)[0]:
+        text += f"- {withdrawal_line(wd)}\n"
+    if u.custom_prices:
         text += "\n💠 Custom Prices:\n"
-        for y, p in u["custom_prices"].items():
+        for y, p in u.custom_prices.items():
             text += f"- {y}: {p}\n"
     await update.message.reply_text(text)
     return ADMIN_PANEL
@@ -832,15 +3883,76 @@ async def admin_broadcast_handler(update: Update, context: ContextTypes.DEFAULT_
     if not text:
         await update.message.reply_text("❌ Broadcast message cannot be empty.")
         return ADMIN_BROADCAST
-    count = 0
-    for s_uid in list(data["users"].keys()):
+    if broadcaster.is_active():
+        await update.message.reply_text("⚠️ A broadcast is already in progress. Cancel it from its progress message first.")
+        return ADMIN_PANEL
+    progress = await update.message.reply_text("📢 Broadcast queued...", reply_markup=broadcast_controls("running"))
+    broadcaster.start(context.job_queue, text, update.effective_chat.id, progress.message_id)
+    return ADMIN_PANEL
+async def broadcast_control_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
+    if q.from_user.id != ADMIN_ID:
+        await q.answer("❌ Only admin.")
+        return
+    action = q.data.split(":", 1)[1]
+    st = broadcaster.current()
+    if st is None or not broadcaster.is_active():
+        await q.answer("⚠️ No broadcast in progress.")
+        return
+    if action == "pause" and st["status"] == "running":
+        st["status"] = "paused"
+    elif action == "resume" and st["status"] == "paused":
+        st["status"] = "running"
+        broadcaster.schedule(context.job_queue)
+    elif action == "cancel":
+        st["status"] = "cancelled"
+    broadcaster.save()
+    await q.answer()
+    await broadcaster.report(context.bot, force=True)
+async def handle_request_reply(update: Update, context: ContextTypes.DEFAULT_TYPE, reply_id: str):
+    req = store.get_request(reply_id)
+    if req is None:
+        return # Answered by a concurrent reply
+    store.close_request(reply_id)
+    seller_id = req.seller_id
+    txt = update.message.text.strip()
+    sub_id = request_submission_id(req)
+    sub = store.get_submission(sub_id) if sub_id else None
+    expected = GroupStatus.WAITING_COUNT if req.type == "count" else GroupStatus.WAITING_TARGET
+    if sub is None or sub.status != expected:
+        await update.message.reply_text("⚠️ Pending submission not found.")
+        return
+    links_text = "\n".join(sub.links)
+    if req.type == "count":
         try:
-            await context.bot.send_message(int(s_uid), f"📢 Broadcast from admin:\n\n{text}")
-            count += 1
+            count = int(txt)
+            if count <= 0:
+                raise ValueError
         except:
-            logger.warning(f"Failed to send broadcast to user {s_uid}.")
-    await update.message.reply_text(f"✅ Broadcast sent to {count} users.")
-    return ADMIN_PANEL
+            await update.message.reply_text("❌ Invalid count. Please reply again with a positive integer.")
+            return
+        store.set_submission_status(sub_id, GroupStatus.WAITING_TARGET, approved_count=count)
+        await update.message.reply_text(f"✅ Count set to {count} for submission #{sub_id} of user {seller_id}.")
+        # Notify seller
+        outbox.enqueue(
+            seller_id,
+            f"✅ Your submission #{sub_id} was approved by admin ({count} groups):\n{links_text}\nAdmin will send buyer ID for transfer shortly."
+        )
+        # Ask for buyer ID
+        await open_prompt(context.bot, "buyer", sub_id, sub)
+        return
+    elif req.type == "buyer":
+        target_id = txt
+        store.set_ownership(sub_id, OwnershipStatus.REQUESTED, target=target_id)
+        outbox.enqueue(
+            seller_id,
+            f"📢 Please transfer the group/folder ownership for:\n{links_text}\nTo: {target_id}\n\nAfter you transfer ownership, press the button below to notify admin.",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("✅ Ownership Submitted", callback_data=f"submit_ownership:{sub_id}")]
+            ])
+        )
+        await update.message.reply_text(f"✅ Ownership target set to {target_id} for submission #{sub_id} ({len(sub.links)} link(s)) and seller notified.")
+        return
 # ------------------------
 # Router for reply-keyboard (only when not in a conversation)
 # and also handles admin custom-price text flow
@@ -856,7 +3968,7 @@ async def button_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await update.message.reply_text("❌ Invalid user ID. Send numeric ID.")
                 return
             ensure_user(tid)
-            context.user_data["target_user"] = str(tid)
+            context.user_data["target_user"] = tid
             context.user_data["admin_mode"] = "custom_set_value"
             await update.message.reply_text(
                 "✍️ Send price like: `2016-22: 10$` or multiple separated by comma\nExample: `2016-22: 10$, 2023: 5$`"
@@ -865,33 +3977,22 @@ async def button_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if mode == "custom_set_value":
             target_uid = context.user_data.get("target_user")
             txt = (update.message.text or "").strip()
-            parts = [p.strip() for p in txt.split(",")]
-            new_prices = {}
             try:
-                for p in parts:
-                    if ":" in p:
-                        yr, val = p.split(":", 1)
-                        val = val.strip()
-                        if not val.endswith("$"):
-                            val += "$"
-                        new_prices[yr.strip()] = val
-                data["users"][target_uid]["custom_prices"] = new_prices
-                save_data(data)
-                await update.message.reply_text(f"✅ Custom prices set for user {target_uid}: {new_prices}")
-                try:
-                    await context.bot.send_message(
-                        int(target_uid),
-                        f"💰 Your custom group prices have been updated: {new_prices}"
-                    )
-                except:
-                    logger.warning(f"Failed to notify user {target_uid} of custom price update.")
-                context.user_data.pop("admin_mode", None)
-                context.user_data.pop("target_user", None)
-            except:
+                table = parse_price_table(txt)
+            except ValueError as e:
                 await update.message.reply_text(
-                    "❌ Invalid format. Use `year1:price1,year2:price2` (e.g., `2016-22:10$,2023:5$`)."
+                    f"❌ Invalid format ({e}). Use `year1:price1,year2:price2` (e.g., `2016-22:10$,2023:5$`)."
                 )
                 return
+            pricebook.set_custom(target_uid, table)
+            new_prices = format_price_table(table)
+            await update.message.reply_text(f"✅ Custom prices set for user {target_uid}: {new_prices}")
+            outbox.enqueue(
+                target_uid,
+                f"💰 Your custom group prices have been updated: {new_prices}"
+            )
+            context.user_data.pop("admin_mode", None)
+            context.user_data.pop("target_user", None)
             return
         if mode == "custom_remove_user":
             target_uid = (update.message.text or "").strip()
@@ -901,13 +4002,14 @@ async def button_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await update.message.reply_text("❌ Invalid user ID. Send numeric ID.")
                 return
             ensure_user(tid)
-            if not data["users"][str(tid)].get("custom_prices"):
+            user_prices = pricebook.custom(tid)
+            if not user_prices:
                 await update.message.reply_text("⚠️ No custom prices found for this user.")
                 context.user_data.pop("admin_mode", None)
                 return
-            context.user_data["target_user"] = str(tid)
+            context.user_data["target_user"] = tid
             context.user_data["admin_mode"] = "custom_remove_action"
-            years = "\n".join(data["users"][str(tid)]["custom_prices"].keys())
+            years = "\n".join(user_prices.keys())
             await update.message.reply_text(
                 f"🧼 Custom prices for user {tid}:\n{years}\n\n"
                 "Type specific year to remove (e.g., `2023`) or type `all` to remove all custom prices."
@@ -917,13 +4019,13 @@ async def button_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
             target_uid = context.user_data.get("target_user")
             year = (update.message.text or "").strip()
             if year.lower() == "all":
-                data["users"][target_uid]["custom_prices"] = {}
-                save_data(data)
+                pricebook.set_custom(target_uid, {})
                 await update.message.reply_text(f"✅ All custom prices removed for user {target_uid}")
             else:
-                if year in data["users"][target_uid]["custom_prices"]:
-                    del data["users"][target_uid]["custom_prices"][year]
-                    save_data(data)
+                user_prices = pricebook.custom(target_uid)
+                if year in user_prices:
+                    remaining = {k: v for k, v in user_prices.items() if k != year}
+                    pricebook.set_custom(target_uid, remaining)
                     await update.message.reply_text(f"✅ Removed custom price for year {year} from user {target_uid}")
                 else:
                     await update.message.reply_text(f"⚠️ No custom price found for year {year}.")
@@ -938,11 +4040,11 @@ async def button_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await update.message.reply_text("❌ Invalid user ID. Send numeric ID.")
                 return
             ensure_user(tid)
-            user_prices = data["users"][str(tid)].get("custom_prices", {})
+            user_prices = pricebook.custom(tid)
             if user_prices:
                 text = "🕵️ *Custom Prices for this User:*\n"
                 for k, v in user_prices.items():
-                    text += f"📅 {k}: {v}\n"
+                    text += f"📅 {k}: {format_price(v)}\n"
                 await update.message.reply_text(text, parse_mode="Markdown")
             else:
                 await update.message.reply_text("⚠️ No custom prices set for this user.")
@@ -950,89 +4052,26 @@ async def button_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
         if mode == "global_prices_set_value":
             txt = (update.message.text or "").strip()
-            parts = [p.strip() for p in txt.split(",")]
-            new_prices = {}
             try:
-                for p in parts:
-                    if ":" in p:
-                        yr, val = p.split(":", 1)
-                        val = val.strip()
-                        if not val.endswith("$"):
-                            val += "$"
-                        new_prices[yr.strip()] = val
-                data["global_prices"] = new_prices
-                save_data(data)
-                await update.message.reply_text(f"✅ Global prices updated: {new_prices}")
-                context.user_data.pop("admin_mode", None)
-            except:
+                table = parse_price_table(txt)
+            except ValueError as e:
                 await update.message.reply_text(
-                    "❌ Invalid format. Use `year1:price1,year2:price2` (e.g., `2016-22:10$,2023:5$`)."
+                    f"❌ Invalid format ({e}). Use `year1:price1,year2:price2` (e.g., `2016-22:10$,2023:5$`)."
                 )
                 return
+            pricebook.set_global(table)
+            await update.message.reply_text(f"✅ Global prices updated: {format_price_table(table)}")
+            context.user_data.pop("admin_mode", None)
             return
 
     # Handle pending requests (count or buyer) via reply
     if update.message.reply_to_message:
         reply_id = str(update.message.reply_to_message.message_id)
-        if reply_id in data.get("pending_requests", {}):
-            req = data["pending_requests"].pop(reply_id)
-            save_data(data)
-            s_uid = req["seller_id"]
-            txt = update.message.text.strip()
-            user_pending = {k: v for k, v in data["pending_groups"].items() if v["seller_id"] == s_uid and v["status"] in ["approved_waiting_count", "approved_waiting_target"]}
-            if not user_pending:
-                await update.message.reply_text("⚠️ Pending submission not found.")
-                return
-            links_text = "\n".join([info["link"] for info in user_pending.values()])
-            if req["type"] == "count":
-                try:
-                    count = int(txt)
-                    if count <= 0:
-                        raise ValueError
-                except:
-                    await update.message.reply_text("❌ Invalid count. Please reply again with a positive integer.")
-                    return
-                for key, info in user_pending.items():
-                    if info["status"] == "approved_waiting_count":
-                        info["approved_count"] = count
-                        info["status"] = "approved_waiting_target"
-                save_data(data)
-                await update.message.reply_text(f"✅ Count set to {count} for user {s_uid}.")
-                # Notify seller
-                try:
-                    await context.bot.send_message(
-                        int(s_uid),
-                        f"✅ Your submission(s) were approved by admin ({count} groups):\n{links_text}\nAdmin will send buyer ID for transfer shortly."
-                    )
-                except:
-                    logger.warning(f"Failed to notify user {s_uid} of group approval.")
-                # Ask for buyer ID
-                sent_msg = await context.bot.send_message(
-                    ADMIN_ID,
-                    f"Please reply to this message with the Telegram @username or numeric ID of the buyer for these links of user {s_uid}:\n{links_text}"
-                )
-                data["pending_requests"][str(sent_msg.message_id)] = {"type": "buyer", "seller_id": s_uid, "time": now()}
-                save_data(data)
-                return
-            elif req["type"] == "buyer":
-                target_id = txt
-                for key, pg in user_pending.items():
-                    if pg["status"] == "approved_waiting_target":
-                        pg["ownership_status"] = "requested"
-                        pg["ownership_target_id"] = target_id
-                save_data(data)
-                try:
-                    await context.bot.send_message(
-                        int(s_uid),
-                        f"📢 Please transfer the group/folder ownership for:\n{links_text}\nTo: {target_id}\n\nAfter you transfer ownership, press the button below to notify admin.",
-                        reply_markup=InlineKeyboardMarkup([
-                            [InlineKeyboardButton("✅ Ownership Submitted", callback_data=f"submit_ownership:{s_uid}")]
-                        ])
-                    )
-                except:
-                    logger.warning(f"Failed to notify user {s_uid} of ownership target.")
-                await update.message.reply_text(f"✅ Ownership target set to {target_id} for {len(user_pending)} link(s) and seller notified.")
-                return
+        req = store.get_request(reply_id)
+        if req is not None:
+            async with locks.hold(("submission", request_submission_id(req))):
+                await handle_request_reply(update, context, reply_id)
+            return
 
     txt = (update.message.text or "").strip()
     uid = update.effective_user.id
@@ -1056,53 +4095,177 @@ async def button_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # ========================
 # App setup
 # ========================
+async def on_startup(app):
+    store.start()
+    restore_conversation_timeouts(app)
+    outbox.start(app.bot)
+    channel_digest.start()
+    unprompted = unprompted_submissions()
+    if unprompted:
+        logger.info(f"Asking again for the count or buyer of {len(unprompted)} approved submission(s)")
+        ask_in_background(app.bot, unprompted)
+    sweeper.start(app.job_queue)
+    metrics.gauge("bot_update_backlog", lambda: app.update_queue.backlog)
+    metrics.gauge("bot_outbox_pending", outbox.pending)
+    metrics.gauge("bot_digest_pending", channel_digest.pending)
+    metrics.gauge("bot_expiry_watched", lambda: len(sweeper.deadlines))
+    metrics.gauge("bot_throttle_buckets", lambda: sum(map(len, inbound_throttle.limits.values())))
+    if METRICS_PORT:
+        await metrics.serve(app)
+    st = broadcaster.current()
+    if st is not None and st["status"] == "running":
+        logger.info(f"Resuming broadcast after {st['sent'] + st['failed']} recipient(s)")
+        broadcaster.schedule(app.job_queue)
+async def on_stop(app):
+    # The bot can still send here (shutdown closes its connection), so in-flight notifications
+    # go out now instead of waiting for the next start, collected channel posts included.
+    channel_digest.close()
+    for task in list(prompt_tasks):
+        task.cancel()
+    await outbox.close()
+    # Long polling confirms a batch of updates only with the next getUpdates call, so confirm
+    # the ones just drained; otherwise Telegram would deliver them again after the restart
+    if app.polling and app.last_update_id is not None:
+        try:
+            await app.bot.get_updates(offset=app.last_update_id + 1, timeout=0, limit=1)
+        except TelegramError as e:
+            logger.warning(f"Could not confirm processed updates: {e}")
+async def on_shutdown(app):
+    await metrics.close()
+    await store.close()
+# Webhook counterpart of Application.run_polling(): same lifecycle (initialize, post_init,
+# start, stop, post_stop, shutdown, post_shutdown), with WebhookServer feeding
+# app.update_queue. If the server cannot bind or setWebhook fails, the bot falls back to
+# long polling.
+async def run_webhook(app):
+    # Every request must carry the secret: without it anyone reaching the port could post
+    # updates as any user, the admin included. setWebhook hands a generated one to Telegram;
+    # behind a proxy that registers the webhook itself, WEBHOOK_SECRET has to be set.
+    secret = WEBHOOK_SECRET
+    if WEBHOOK_URL and not secret:
+        secret = secrets.token_urlsafe(32)
+    if not secret:
+        raise SystemExit("Webhook mode needs WEBHOOK_SECRET when WEBHOOK_URL is empty")
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        with contextlib.suppress(NotImplementedError):
+            loop.add_signal_handler(sig, stop.set)
+    server = WebhookServer(app.update_queue, app.bot, WEBHOOK_PATH, secret, WEBHOOK_LISTEN, WEBHOOK_PORT)
+    await app.initialize()
+    try:
+        if app.post_init:
+            await app.post_init(app)
+        try:
+            await server.start()
+            if WEBHOOK_URL:
+                await app.bot.set_webhook(
+                    url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                    secret_token=secret,
+                    max_connections=WEBHOOK_MAX_CONNECTIONS,
+                    allowed_updates=Update.ALL_TYPES,
+                )
+            logger.info(f"Serving webhook on {WEBHOOK_LISTEN}:{server.port}{WEBHOOK_PATH}")
+        except (OSError, TelegramError) as e:
+            logger.error(f"Webhook setup failed ({e}), falling back to polling")
+            await server.close()
+            app.polling = True
+            await app.updater.start_polling() # also deletes the webhook
+        await app.start()
+        await stop.wait()
+    finally:
+        if app.updater.running:
+            await app.updater.stop()
+        await server.close()
+        if app.running:
+            await app.stop()
+            if app.post_stop:
+                await app.post_stop(app)
+        await app.shutdown()
+        if app.post_shutdown:
+            await app.post_shutdown(app)
 def main():
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+    use_store(open_store())
+    app = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .base_url(BOT_API_URL)
+        .request(InstrumentedRequest(connection_pool_size=256))
+        .application_class(MarketplaceApplication)
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .update_queue(UpdateQueue(UPDATE_QUEUE_SIZE))
+        .persistence(StorePersistence(CONVERSATION_FLUSH_SECONDS))
+        .post_init(on_startup)
+        .post_stop(on_stop)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
     sell_conv = ConversationHandler(
         entry_points=[CommandHandler("sell", cmd_sell_entry), MessageHandler(filters.Regex("🛍 Sell$"), cmd_sell_entry)],
-        states={
+        states=with_expiry("sell", {
             SELL_TYPE: [CallbackQueryHandler(sell_choose_type, pattern="^sell_type_")],
             SELL_LINK: [MessageHandler(filters.TEXT & ~filters.COMMAND, sell_receive_link)],
             SELL_YEAR: [MessageHandler(filters.TEXT & ~filters.COMMAND, sell_receive_year)],
-        },
+        }),
         fallbacks=[CommandHandler("cancel", universal_cancel)],
-        conversation_timeout=600,
+        conversation_timeout=CONVERSATION_TIMEOUT,
+        name="sell",
+        persistent=True,
     )
     withdraw_conv = ConversationHandler(
         entry_points=[CommandHandler("withdraw", cmd_withdraw_entry), MessageHandler(filters.Regex("💸 Withdraw$"), cmd_withdraw_entry)],
-        states={
+        states=with_expiry("withdraw", {
             WITHDRAW_METHOD: [CallbackQueryHandler(withdraw_choose_method, pattern="^method_")],
             WITHDRAW_ADDRESS: [MessageHandler(filters.TEXT & ~filters.COMMAND, withdraw_get_address)],
             WITHDRAW_AMOUNT: [MessageHandler(filters.TEXT & ~filters.COMMAND, withdraw_get_amount)],
-        },
+        }),
         fallbacks=[CommandHandler("cancel", universal_cancel)],
-        conversation_timeout=600,
+        conversation_timeout=CONVERSATION_TIMEOUT,
+        name="withdraw",
+        persistent=True,
     )
     admin_conv = ConversationHandler(
         entry_points=[CommandHandler("admin", admin_panel_entry), MessageHandler(filters.Regex("🧑‍💻 Admin$"), admin_panel_entry)],
-        states={
+        states=with_expiry("admin", {
             ADMIN_PANEL: [CallbackQueryHandler(admin_panel_callback, pattern="^admin_")],
             ADMIN_ADD_USER: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_add_user_handler)],
             ADMIN_ADD_AMOUNT: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_add_amount_handler)],
             ADMIN_INSPECT_USER: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_inspect_handler)],
             ADMIN_BROADCAST: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_broadcast_handler)],
-        },
+        }),
         fallbacks=[CommandHandler("cancel", universal_cancel)],
-        conversation_timeout=600,
+        conversation_timeout=CONVERSATION_TIMEOUT,
         allow_reentry=True,
+        name="admin",
+        persistent=True,
     )
     app.add_handler(sell_conv)
     app.add_handler(withdraw_conv)
     app.add_handler(admin_conv)
+    app.add_handler(CallbackQueryHandler(withdraw_history_callback, pattern="^whist:"))
     app.add_handler(CallbackQueryHandler(admin_callback_handler, pattern="^(approve_group|reject_group|approve_withdraw|reject_withdraw|submit_ownership|verify_ownership|reject_ownership):"))
     app.add_handler(CallbackQueryHandler(admin_panel_callback, pattern="^admin_"))
+    app.add_handler(CallbackQueryHandler(broadcast_control_callback, pattern="^broadcast:"))
+    app.add_handler(CallbackQueryHandler(review_callback, pattern="^review:"))
+    app.add_handler(CallbackQueryHandler(bulk_callback, pattern="^(review_pick|review_bulk|bulk):"))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, button_router))
     app.add_handler(CommandHandler("start", on_start))
     app.add_handler(CommandHandler("price", cmd_price))
     app.add_handler(CommandHandler("balance", cmd_balance))
     app.add_handler(CommandHandler("stats", cmd_stats))
+    app.add_handler(CommandHandler("metrics", cmd_metrics))
+    app.add_handler(CommandHandler("bulk", cmd_bulk))
     app.add_handler(CommandHandler("cancel", universal_cancel))
-    logger.info("Bot starting...")
-    app.run_polling()
+    logger.info(f"Bot starting ({BOT_MODE})...")
+    if BOT_MODE == "webhook":
+        asyncio.run(run_webhook(app))
+    else:
+        app.polling = True
+        app.run_polling()
 if __name__ == "__main__":
-    main()
+    if len(sys.argv) > 1 and sys.argv[1] == "migrate-sqlite":
+        migrate_json_to_sqlite(Path(sys.argv[2]) if len(sys.argv) > 2 else DATA_PATH, Path(sys.argv[3]) if len(sys.argv) > 3 else SQLITE_PATH)
+    elif len(sys.argv) > 1 and sys.argv[1] == "convert-snapshot":
+        convert_snapshot(Path(sys.argv[2]) if len(sys.argv) > 2 else DATA_PATH, Path(sys.argv[3]) if len(sys.argv) > 3 else DATA_PATH.with_suffix(".snap"))
+    else:
+        main()
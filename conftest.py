@@ -0,0 +1,43 @@
+import pytest
+import bot
+# Tests import bot.py as a module: the live store is never opened, each test opens its own under tmp_path
+@pytest.fixture(params=["json", "sqlite"])
+def open_store(request, tmp_path):
+    # Opens (or reopens, to check what was persisted) a store of each backend in tmp_path
+    def open_store():
+        if request.param == "sqlite":
+            return bot.SqliteStore(tmp_path / "data.sqlite3", False)
+        return bot.JsonStore(bot.PersistenceManager(tmp_path / "data.json", 1 << 30, 1e9, False))
+    return open_store
+@pytest.fixture
+def populate():
+    # A small marketplace touching every kind of record: users with custom prices, submissions
+    # in each state, open and closed withdrawals, requests, outbox, digest and conversations
+    def populate(store):
+        for uid in (1, 2, 3):
+            store.create_user(uid, bot.now())
+            store.credit(uid, 10.0 * uid)
+        store.set_prices(None, bot.format_price_table({"2016-22": 1000, "2023": 550}))
+        store.set_prices(2, bot.format_price_table({"2023": 700}))
+        sold = store.submit_groups(1, ["t.me/+sold1", "t.me/+sold2"], "2023", "single", bot.now())
+        store.set_submission_status(sold, bot.GroupStatus.WAITING_TARGET, approved_count=2)
+        store.set_ownership(sold, bot.OwnershipStatus.REQUESTED, target=3)
+        store.sell_submission(sold, 2, 11.0, bot.now())
+        waiting = store.submit_groups(2, ["https://t.me/+Folder"], "2016-22", "folder", bot.now())
+        store.set_submission_status(waiting, bot.GroupStatus.WAITING_COUNT)
+        store.open_request("501", "count", 2, waiting, bot.now())
+        rejected = store.submit_groups(3, ["t.me/+nope"], "2023", "single", bot.now())
+        store.set_submission_status(rejected, bot.GroupStatus.REJECTED)
+        store.submit_groups(3, ["t.me/+pending"], "2023", "single", bot.now())
+        approved = store.open_withdrawal(1, "binance", "addr1", 5.0, bot.now())
+        store.close_withdrawal(approved, bot.WithdrawalStatus.APPROVED, bot.now())
+        refunded = store.open_withdrawal(2, "usdt", "addr2", 7.5, bot.now())
+        store.close_withdrawal(refunded, bot.WithdrawalStatus.REJECTED, bot.now())
+        store.open_withdrawal(3, "binance", "addr3", 12.25, bot.now())
+        store.set_sell_enabled(False)
+        store.set_meta("broadcast", {"text": "hi", "cursor": 2})
+        store.outbox_add(bot.Outbox.entry(1, "queued"))
+        store.digest_add({"id": "d1", "chat_id": -100, "text": "posted", "time": bot.now()})
+        store.set_user_data(2, {"withdraw_method": "usdt"})
+        store.set_conversation("withdraw", (2, 2), bot.WITHDRAW_ADDRESS, bot.now())
+    return populate
@@ -0,0 +1,735 @@
+# End-to-end load test: bot.py against a local stand-in for the Telegram Bot API.
+#
+#   python loadtest.py                                  # 1000 users, JSON store, long polling
+#   python loadtest.py --users 5000 --backend sqlite --mode webhook
+#   python loadtest.py --latency-ms 80 --jitter-ms 40 --error-rate 0.01 --retry-after-rate 0.005
+#
+# FakeBotApi serves /bot<token>/<method> for the methods bot.py calls (getMe, deleteWebhook,
+# getUpdates, sendMessage, editMessageText, answerCallbackQuery, setMyCommands) and keeps the
+# messages the bot "sent" per chat. The sending methods can be slowed down and made to fail
+# with HTTP 502 (NetworkError in the bot) or 429 + retry_after (RetryAfter). bot.py itself
+# runs unmodified in a child process, in a fresh data directory, with BOT_API_URL pointed at
+# the fake; in webhook mode the updates are POSTed to its webhook server instead of polled.
+#
+# The traffic generator plays the ConversationHandler flows of bot.main() phase by phase, all
+# simulated users of a phase at once: /start; sell (/sell, type, links, year); the admin
+# approving every submission from the review queue and answering the buyer prompts; sellers
+# pressing "Ownership Submitted" and the admin verifying; withdraw (/withdraw, method,
+# address, amount); the admin approving the withdrawals; a broadcast to everyone. A step's
+# end-to-end latency runs from handing its update to the bot until the reply it waits for
+# reaches the fake API; for queued notifications ("notify:" rows) it runs from the step that
+# caused them. Per phase the report gives actions/s, latency percentiles, failed steps, Bot
+# API calls per action by method and the bot's CPU time. Each run appends one JSON line to
+# --output (loadtest_output.txt); the bot's own log is kept in --work-dir.
+import argparse
+import asyncio
+import collections
+import contextlib
+import datetime
+import itertools
+import json
+import os
+import random
+import re
+import shutil
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+from http import HTTPStatus
+from pathlib import Path
+import httpx
+HERE = Path(__file__).resolve().parent
+BOT_TOKEN = "123456:LOADTEST"
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "Marketplace", "username": "marketplace_load_bot", "can_join_groups": True, "can_read_all_group_messages": False, "supports_inline_queries": False}
+ADMIN_ID = 42
+LINKS_CHANNEL = -1001000000001
+WITHDRAW_CHANNEL = -1001000000002
+WEBHOOK_SECRET = "loadtest-secret"
+FIRST_UID = 1_000_000_000
+SEED = 1234
+PHASES = ("start", "sell", "review", "ownership", "withdraw", "payout", "broadcast")
+INJECTED_METHODS = {"sendMessage", "editMessageText", "answerCallbackQuery", "setMyCommands"} # What the latency/fault options apply to
+TEXT_PARAMS = {"text", "parse_mode", "callback_query_id", "url", "secret_token"} # Sent as plain strings, everything else JSON-encoded
+QUIET_SECONDS = 1.0 # A phase ends once the bot made no call for this long (or --settle ran out)
+BOT_START_TIMEOUT = 60
+BOT_STOP_TIMEOUT = 30
+WEBHOOK_MAX_CONNECTIONS = 40 # Parallel deliveries, as Telegram's default for setWebhook
+WEBHOOK_MAX_ATTEMPTS = 10
+WITHDRAW_AMOUNT = "0.05" # Less than what two verified links in "2023" pay
+# ========================
+# Fake Bot API server
+# ========================
+class ApiError(Exception):
+    def __init__(self, status: int, description: str, parameters=None):
+        super().__init__(description)
+        self.status = status
+        self.description = description
+        self.parameters = parameters
+def chat(chat_id: int):
+    return {"id": chat_id, "type": "private", "first_name": f"User {chat_id}"} if chat_id > 0 else {"id": chat_id, "type": "channel", "title": f"Channel {chat_id}"}
+def user(uid: int):
+    return {"id": uid, "is_bot": False, "first_name": f"User {uid}", "username": f"user{uid}"}
+def parse_params(content_type: str, body: bytes, query: str):
+    if content_type.startswith("application/json"):
+        return json.loads(body or b"{}")
+    params = {}
+    for name, value in urllib.parse.parse_qsl(query, keep_blank_values=True) + urllib.parse.parse_qsl(body.decode(), keep_blank_values=True):
+        try:
+            params[name] = value if name in TEXT_PARAMS else json.loads(value)
+        except ValueError:
+            params[name] = value
+    return params
+class FakeBotApi:
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0, retry_after_rate: float = 0.0, retry_after: int = 1, seed: int = SEED):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.retry_after_rate = retry_after_rate
+        self.retry_after = retry_after
+        self.rng = random.Random(seed)
+        self.calls = collections.Counter() # method -> calls, failed ones included
+        self.injected = collections.Counter() # "error" / "retry_after" -> calls failed on purpose
+        self.last_call = time.monotonic() # Of the last non-polling call
+        self.polled = asyncio.Event() # Set by the first getUpdates: the bot is up
+        self.sink = self.queue_update # Where deliver() hands updates; replaced in webhook mode
+        self.port = None
+        self._updates = collections.deque()
+        self._new_updates = asyncio.Event()
+        self._update_seq = itertools.count(1)
+        self._message_seq = itertools.count(1)
+        self._callback_seq = itertools.count(1)
+        self._messages = {} # (chat id, message id) -> message as last sent or edited
+        self._inbox = collections.defaultdict(list) # chat id -> message ids, oldest first
+        self._arrived = {} # (chat id, message id) -> perf_counter() when sent
+        self._waiters = collections.defaultdict(list) # chat id -> [(predicate, future)]
+        self._server = None
+        self._writers = set()
+    async def start(self, host: str = "127.0.0.1", port: int = 0):
+        self._server = await asyncio.start_server(self._serve, host, port)
+        self.port = self._server.sockets[0].getsockname()[1]
+    async def close(self):
+        if self._server is None:
+            return
+        self._server.close()
+        for writer in list(self._writers):
+            writer.close()
+        await self._server.wait_closed()
+        self._server = None
+    # ------------------------
+    # Bot API methods
+    # ------------------------
+    async def call(self, method: str, params: dict):
+        self.calls[method] += 1
+        if method != "getUpdates":
+            self.last_call = time.monotonic()
+        if method in INJECTED_METHODS:
+            delay = self.latency + (self.rng.uniform(0, self.jitter) if self.jitter else 0)
+            if delay:
+                await asyncio.sleep(delay)
+            roll = self.rng.random()
+            if roll < self.retry_after_rate:
+                self.injected["retry_after"] += 1
+                raise ApiError(429, f"Too Many Requests: retry after {self.retry_after}", {"retry_after": self.retry_after})
+            if roll < self.retry_after_rate + self.error_rate:
+                self.injected["error"] += 1
+                raise ApiError(502, "Bad Gateway")
+        handler = getattr(self, f"api_{method}", None)
+        if handler is None:
+            return True
+        return await handler(params)
+    async def api_getMe(self, params):
+        return BOT_USER
+    async def api_getWebhookInfo(self, params):
+        return {"url": "", "has_custom_certificate": False, "pending_update_count": len(self._updates)}
+    async def api_getUpdates(self, params):
+        offset = params.get("offset")
+        if offset is not None:
+            # Telegram forgets everything below the offset the bot confirms with
+            while self._updates and self._updates[0]["update_id"] < offset:
+                self._updates.popleft()
+        self.polled.set()
+        timeout = params.get("timeout") or 0
+        if not self._updates and timeout:
+            self._new_updates.clear()
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._new_updates.wait(), timeout)
+        return list(itertools.islice(self._updates, params.get("limit") or 100))
+    async def api_sendMessage(self, params):
+        chat_id = int(params["chat_id"])
+        msg = {"message_id": next(self._message_seq), "date": int(time.time()), "chat": chat(chat_id), "from": BOT_USER, "text": params.get("text", "")}
+        markup = params.get("reply_markup")
+        if isinstance(markup, dict) and "inline_keyboard" in markup:
+            msg["reply_markup"] = markup
+        key = (chat_id, msg["message_id"])
+        self._messages[key] = msg
+        self._arrived[key] = time.perf_counter()
+        self._inbox[chat_id].append(msg["message_id"])
+        self._notify(chat_id, msg)
+        return msg
+    async def api_editMessageText(self, params):
+        chat_id = int(params["chat_id"])
+        key = (chat_id, int(params["message_id"]))
+        msg = self._messages.get(key)
+        if msg is None:
+            raise ApiError(400, "Bad Request: message to edit not found")
+        markup = params.get("reply_markup")
+        markup = markup if isinstance(markup, dict) and "inline_keyboard" in markup else None
+        if msg["text"] == params.get("text", "") and msg.get("reply_markup") == markup:
+            raise ApiError(400, "Bad Request: message is not modified: specified new message content and reply markup are exactly the same as a current content and reply markup of the message")
+        msg["text"] = params.get("text", "")
+        msg["edit_date"] = int(time.time())
+        if markup:
+            msg["reply_markup"] = markup
+        else:
+            msg.pop("reply_markup", None)
+        self._arrived[key] = time.perf_counter()
+        self._notify(chat_id, msg)
+        return msg
+    # ------------------------
+    # Simulated users' side
+    # ------------------------
+    def queue_update(self, update):
+        self._updates.append(update)
+        self._new_updates.set()
+    def deliver(self, update):
+        self.sink(update)
+    def message_update(self, uid: int, text: str, reply_to=None):
+        msg = {"message_id": next(self._message_seq), "date": int(time.time()), "chat": chat(uid), "from": user(uid), "text": text}
+        if text.startswith("/"):
+            msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        if reply_to is not None:
+            msg["reply_to_message"] = reply_to
+        return {"update_id": next(self._update_seq), "message": msg}
+    def callback_update(self, uid: int, data: str, message):
+        query = {"id": str(next(self._callback_seq)), "from": user(uid), "chat_instance": str(uid), "data": data, "message": message}
+        return {"update_id": next(self._update_seq), "callback_query": query}
+    def expect(self, chat_id: int, predicate, history: bool = False):
+        # Future for the next message sent to (or edited in) chat_id that matches predicate;
+        # with history, one the chat already has counts too
+        fut = asyncio.get_running_loop().create_future()
+        if history:
+            found = self.find(chat_id, predicate)
+            if found:
+                fut.set_result(found[0])
+                return fut
+        self._waiters[chat_id].append((predicate, fut))
+        return fut
+    def forget(self, chat_id: int, fut):
+        self._waiters[chat_id] = [(p, f) for p, f in self._waiters[chat_id] if f is not fut]
+    def find(self, chat_id: int, predicate):
+        # Messages the chat has now that match predicate, oldest first
+        found = (self._messages[(chat_id, mid)] for mid in self._inbox.get(chat_id, ()))
+        return [dict(msg) for msg in found if predicate(msg)]
+    def arrived(self, msg):
+        return self._arrived[(msg["chat"]["id"], msg["message_id"])]
+    def _notify(self, chat_id: int, msg):
+        waiting = self._waiters.get(chat_id)
+        if not waiting:
+            return
+        for entry in list(waiting):
+            predicate, fut = entry
+            if fut.done():
+                waiting.remove(entry)
+            elif predicate(msg):
+                fut.set_result(dict(msg))
+                waiting.remove(entry)
+    # ------------------------
+    # HTTP
+    # ------------------------
+    async def handle(self, path: str, headers, body: bytes):
+        path, _, query = path.partition("?")
+        token, _, method = path.removeprefix("/bot").partition("/")
+        if not path.startswith("/bot") or token != BOT_TOKEN:
+            return 404, {"ok": False, "error_code": 404, "description": "Not Found"}
+        try:
+            params = parse_params(headers.get("content-type", ""), body, query)
+            return 200, {"ok": True, "result": await self.call(method, params)}
+        except ApiError as e:
+            payload = {"ok": False, "error_code": e.status, "description": e.description}
+            if e.parameters:
+                payload["parameters"] = e.parameters
+            return e.status, payload
+        except (KeyError, ValueError) as e:
+            return 400, {"ok": False, "error_code": 400, "description": f"Bad Request: {e!r}"}
+    async def _serve(self, reader, writer):
+        self._writers.add(writer)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                method, path, version = line.decode("latin-1").split(None, 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", "0")))
+                status, payload = await self.handle(path, headers, body)
+                data = json.dumps(payload).encode()
+                head = f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\nContent-Type: application/json\r\nContent-Length: {len(data)}\r\n\r\n"
+                writer.write(head.encode("latin-1") + data)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError, asyncio.CancelledError):
+            pass # CancelledError: a long poll still open when the server shuts down
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+class WebhookPusher:
+    # Telegram's side of a webhook: each update POSTed on its own, a bounded number in flight,
+    # retried after 503 busy (honouring Retry-After) or a failed connection
+    def __init__(self, url: str, secret: str, max_connections: int = WEBHOOK_MAX_CONNECTIONS):
+        self.url = url
+        self.secret = secret
+        self.client = httpx.AsyncClient(limits=httpx.Limits(max_connections=max_connections), timeout=30)
+        self.retries = 0
+        self.dropped = 0
+        self._tasks = set()
+    def push(self, update):
+        task = asyncio.create_task(self._post(update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+    async def _post(self, update):
+        for _ in range(WEBHOOK_MAX_ATTEMPTS):
+            try:
+                r = await self.client.post(self.url, json=update, headers={"X-Telegram-Bot-Api-Secret-Token": self.secret})
+                if r.status_code == 200:
+                    return
+                delay = float(r.headers.get("retry-after", "1"))
+            except httpx.HTTPError:
+                delay = 1.0
+            self.retries += 1
+            await asyncio.sleep(delay)
+        self.dropped += 1
+    async def close(self):
+        for task in list(self._tasks):
+            task.cancel()
+        await self.client.aclose()
+# ========================
+# The bot under test
+# ========================
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+def proc_usage(pid: int):
+    # (CPU seconds, RSS MB) of a process from /proc; (None, None) where that is unavailable
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        cpu = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+        with open(f"/proc/{pid}/status") as f:
+            rss = next(int(line.split()[1]) / 1024 for line in f if line.startswith("VmRSS:"))
+        return cpu, rss
+    except (OSError, ValueError, IndexError, StopIteration):
+        return None, None
+class BotProcess:
+    def __init__(self, args, api: FakeBotApi, workdir: Path):
+        self.args = args
+        self.api = api
+        self.workdir = workdir
+        self.webhook_port = free_port()
+        self.proc = None
+        self._log = None
+    async def start(self):
+        env = dict(
+            os.environ,
+            BOT_TOKEN=BOT_TOKEN,
+            BOT_API_URL=f"http://127.0.0.1:{self.api.port}/bot",
+            ADMIN_ID=str(ADMIN_ID),
+            LINKS_CHANNEL=str(LINKS_CHANNEL),
+            WITHDRAW_CHANNEL=str(WITHDRAW_CHANNEL),
+            STORAGE_BACKEND=self.args.backend,
+            JOURNAL_FSYNC="1" if self.args.fsync else "0",
+            GLOBAL_SEND_RATE=str(self.args.send_rate),
+            BOT_MODE=self.args.mode,
+            WEBHOOK_URL="",
+            WEBHOOK_LISTEN="127.0.0.1",
+            WEBHOOK_PORT=str(self.webhook_port),
+            WEBHOOK_SECRET=WEBHOOK_SECRET,
+        )
+        self._log = open(self.workdir / "bot.log", "wb")
+        self.proc = await asyncio.create_subprocess_exec(sys.executable, str(HERE / "bot.py"), cwd=self.workdir, env=env, stdout=self._log, stderr=subprocess.STDOUT)
+        deadline = time.monotonic() + BOT_START_TIMEOUT
+        while time.monotonic() < deadline:
+            if self.proc.returncode is not None:
+                break
+            if await self.ready():
+                return
+            await asyncio.sleep(0.1)
+        await self.stop()
+        sys.exit(f"bot.py did not come up; see {self.workdir / 'bot.log'}:\n{self.log_tail()}")
+    async def ready(self):
+        if self.args.mode != "webhook":
+            return self.api.polled.is_set()
+        try:
+            async with httpx.AsyncClient() as client:
+                return (await client.get(f"http://127.0.0.1:{self.webhook_port}/healthz", timeout=1)).status_code == 200
+        except httpx.HTTPError:
+            return False
+    def usage(self):
+        return proc_usage(self.proc.pid) if self.proc and self.proc.returncode is None else (None, None)
+    async def stop(self):
+        if self.proc is None:
+            return
+        if self.proc.returncode is None:
+            self.proc.send_signal(signal.SIGINT)
+            try:
+                await asyncio.wait_for(self.proc.wait(), BOT_STOP_TIMEOUT)
+            except asyncio.TimeoutError:
+                self.proc.kill()
+                await self.proc.wait()
+        self._log.close()
+    def log_tail(self, lines: int = 20):
+        with open(self.workdir / "bot.log", encoding="utf8", errors="replace") as f:
+            return "".join(collections.deque(f, lines))
+# ========================
+# Traffic generator
+# ========================
+def percentile(sorted_values, p):
+    # Nearest-rank percentile of an ascending list
+    return sorted_values[max(0, min(len(sorted_values) - 1, round(p / 100 * len(sorted_values)) - 1))]
+def has(*fragments):
+    return lambda msg: any(f in msg["text"] for f in fragments)
+def edit_of(message, *fragments):
+    return lambda msg: msg["message_id"] == message["message_id"] and any(f in msg["text"] for f in fragments)
+def buttons(msg, prefix: str):
+    rows = msg.get("reply_markup", {}).get("inline_keyboard", [])
+    return [b["callback_data"] for row in rows for b in row if b.get("callback_data", "").startswith(prefix)]
+class Phase:
+    def __init__(self, name: str, api: FakeBotApi, bot: BotProcess):
+        self.name = name
+        self.api = api
+        self.bot = bot
+        self.latencies = collections.defaultdict(list) # step -> seconds
+        self.failed = collections.Counter() # step -> steps that got no answer in time
+        self.actions = 0 # Steps taken, failed ones included
+        self.completed = 0
+        self._calls = collections.Counter(api.calls)
+        self._injected = collections.Counter(api.injected)
+        self._cpu = bot.usage()[0]
+        self._own_cpu = time.process_time()
+        self._started = time.perf_counter()
+        self.duration = None
+    def record(self, step: str, seconds: float, action: bool = True):
+        self.latencies[step].append(seconds)
+        self.actions += action
+        self.completed += action
+    def fail(self, step: str, action: bool = True):
+        self.failed[step] += 1
+        self.actions += action
+    def finish(self):
+        self.duration = time.perf_counter() - self._started
+    def result(self):
+        calls = collections.Counter(self.api.calls)
+        calls.subtract(self._calls)
+        injected = collections.Counter(self.api.injected)
+        injected.subtract(self._injected)
+        cpu, rss = self.bot.usage()
+        sent = sum(n for method, n in calls.items() if method != "getUpdates")
+        steps = {}
+        for step in sorted(set(self.latencies) | set(self.failed), key=lambda s: (s.startswith("notify:"), s)):
+            ms = sorted(x * 1000 for x in self.latencies[step])
+            steps[step] = {
+                "n": len(ms),
+                "failed": self.failed[step],
+                "mean_ms": statistics.fmean(ms) if ms else None,
+                "p50_ms": percentile(ms, 50) if ms else None,
+                "p90_ms": percentile(ms, 90) if ms else None,
+                "p99_ms": percentile(ms, 99) if ms else None,
+                "max_ms": ms[-1] if ms else None,
+            }
+        return {
+            "duration_s": self.duration,
+            "actions": self.actions,
+            "completed": self.completed,
+            "actions_per_s": self.completed / self.duration if self.duration else None,
+            "failed": sum(self.failed.values()),
+            "api_calls": {method: n for method, n in sorted(calls.items()) if n},
+            "api_calls_per_action": sent / self.actions if self.actions else None,
+            "injected": {kind: n for kind, n in injected.items() if n},
+            "bot_cpu_s": cpu - self._cpu if cpu is not None and self._cpu is not None else None,
+            "bot_rss_mb": rss,
+            "loadtest_cpu_s": time.process_time() - self._own_cpu, # The generator and fake API; when this nears the duration, the harness is the bottleneck
+            "steps": steps,
+        }
+class LoadTest:
+    def __init__(self, args, api: FakeBotApi, bot: BotProcess):
+        self.api = api
+        self.bot = bot
+        self.users = [FIRST_UID + i for i in range(args.users)]
+        self.step_timeout = args.step_timeout
+        self.notify_timeout = args.notify_timeout
+        self.send_rate = args.send_rate
+        self.settle = args.settle
+        self.think = args.think_ms / 1000
+        self.limit = asyncio.Semaphore(args.concurrency or args.users)
+        self.rng = random.Random(SEED)
+        self.phase = None
+        self.sellers = {} # uid -> submission id, once the seller was asked to transfer ownership
+        self.caused = {} # (uid, notification) -> perf_counter() of the step that queued it
+        self.credited = [] # sellers that were paid and can withdraw
+        self.withdrawers = [] # users with a pending withdrawal
+    # ------------------------
+    # Steps
+    # ------------------------
+    async def step(self, uid: int, name: str, update, predicate):
+        # Hands one update to the bot and waits for the reply that matches predicate
+        fut = self.api.expect(uid, predicate)
+        t = time.perf_counter()
+        self.api.deliver(update)
+        try:
+            msg = await asyncio.wait_for(fut, self.step_timeout)
+        except asyncio.TimeoutError:
+            self.api.forget(uid, fut)
+            self.phase.fail(name)
+            return None
+        self.phase.record(name, time.perf_counter() - t)
+        if self.think:
+            await asyncio.sleep(self.rng.uniform(0, 2 * self.think))
+        return msg
+    async def say(self, uid: int, name: str, text: str, predicate, reply_to=None):
+        return await self.step(uid, name, self.api.message_update(uid, text, reply_to), predicate)
+    async def press(self, uid: int, name: str, message, data: str, predicate):
+        return await self.step(uid, name, self.api.callback_update(uid, data, message), predicate)
+    async def notified(self, uid: int, name: str, predicate, timeout: float):
+        # A queued notification: latency from the step that caused it to its delivery
+        fut = self.api.expect(uid, predicate, history=True)
+        try:
+            msg = await asyncio.wait_for(fut, timeout)
+        except asyncio.TimeoutError:
+            self.api.forget(uid, fut)
+            self.phase.fail(f"notify: {name}", action=False)
+            return None
+        caused = self.caused.pop((uid, name), None)
+        if caused is not None:
+            self.phase.record(f"notify: {name}", self.api.arrived(msg) - caused, action=False)
+        return msg
+    async def each(self, uids, flow):
+        async def run(uid):
+            async with self.limit:
+                await flow(uid)
+        await asyncio.gather(*(run(uid) for uid in uids))
+    # ------------------------
+    # Phases
+    # ------------------------
+    async def run(self, name: str):
+        self.phase = Phase(name, self.api, self.bot)
+        await getattr(self, f"phase_{name}")()
+        self.phase.finish()
+        # Count the calls still caused by this phase (queued notifications) against it
+        deadline = time.monotonic() + self.settle
+        while time.monotonic() < deadline and time.monotonic() - self.api.last_call < QUIET_SECONDS:
+            await asyncio.sleep(0.1)
+        return self.phase.result()
+    async def phase_start(self):
+        async def flow(uid):
+            await self.say(uid, "/start", "/start", has("Welcome"))
+        await self.each(self.users, flow)
+    async def phase_sell(self):
+        async def flow(uid):
+            m = await self.say(uid, "/sell", "/sell", has("choose the type"))
+            if m is None:
+                return
+            m = await self.press(uid, "sell type", m, "sell_type_single", edit_of(m, "Send your"))
+            if m is None:
+                return
+            m = await self.say(uid, "links", f"t.me/+lt{uid}a t.me/+lt{uid}b", has("valid link"))
+            if m is None:
+                return
+            await self.say(uid, "year", "2023", has("submitted to admin"))
+        await self.each(self.users, flow)
+    async def review_queue(self, queue: str, action: str, notify: str):
+        # The admin opens a review queue and presses "Approve 1" until it is empty; the user
+        # behind each entry is sent `notify` through the outbox
+        failures = 0
+        page = None
+        while failures < 3:
+            if page is None:
+                panel = await self.say(ADMIN_ID, "/admin", "/admin", has("Admin Panel"))
+                page = panel and await self.press(ADMIN_ID, "open queue", panel, f"admin_pending_{queue}", edit_of(panel, "in queue", "No pending"))
+                if page is None:
+                    failures += 1
+                    continue
+            approve = buttons(page, f"{action}:")
+            if not approve:
+                return
+            item_id = approve[0].split(":")[1].split("|")[0]
+            owner = re.search(rf"#{item_id} 👤 (?:Seller )?(\d+)", page["text"])
+            pressed = time.perf_counter()
+            page = await self.press(ADMIN_ID, "approve", page, approve[0], edit_of(page, f"Approved: {item_id}\n"))
+            if page is None:
+                failures += 1
+            else:
+                failures = 0
+                if owner:
+                    self.caused[(int(owner.group(1)), notify)] = pressed
+    async def phase_review(self):
+        await self.review_queue("groups", "approve_group", "approved")
+        # Every approved single submission got a buyer prompt the admin answers by replying
+        prompts = self.api.find(ADMIN_ID, has("buyer for submission #"))
+        for prompt in prompts:
+            sub_id = prompt["text"].split("submission #", 1)[1].split()[0]
+            seller = int(prompt["text"].split(" of user ", 1)[1].split(":")[0])
+            replied = time.perf_counter()
+            m = await self.say(ADMIN_ID, "buyer reply", "@loadtest_buyer", has(f"target set to @loadtest_buyer for submission #{sub_id} "), reply_to=prompt)
+            if m is not None:
+                self.sellers[seller] = sub_id
+                self.caused[(seller, "transfer")] = replied
+    async def phase_ownership(self):
+        submitted = []
+        async def flow(uid):
+            await self.notified(uid, "approved", has("was approved by admin"), self.notify_timeout)
+            note = await self.notified(uid, "transfer", has("Please transfer"), self.notify_timeout)
+            if note is None:
+                return
+            sub_id = self.sellers[uid]
+            if await self.press(uid, "ownership submitted", note, f"submit_ownership:{sub_id}", edit_of(note, "Ownership submitted")):
+                submitted.append((uid, sub_id))
+        await self.each(self.sellers, flow)
+        for uid, sub_id in submitted:
+            # Pressed on the admin's notification when it has arrived (the admin chat gets one
+            # message a second), else on the admin's own confirmation for the submission
+            carriers = self.api.find(ADMIN_ID, has(f"ownership transfer for submission #{sub_id}:")) or self.api.find(ADMIN_ID, has(f"target set to @loadtest_buyer for submission #{sub_id} "))
+            if not carriers:
+                self.phase.fail("verify")
+                continue
+            if await self.press(ADMIN_ID, "verify", carriers[-1], f"verify_ownership:{sub_id}", edit_of(carriers[-1], f"Ownership verified for submission #{sub_id} ")):
+                self.caused[(uid, "credited")] = time.perf_counter()
+        async def paid(uid):
+            if await self.notified(uid, "credited", has("credited to your balance"), self.notify_timeout):
+                self.credited.append(uid)
+        await self.each([uid for uid, _ in submitted], paid)
+    async def phase_withdraw(self):
+        async def flow(uid):
+            m = await self.say(uid, "/withdraw", "/withdraw", has("Select withdraw method"))
+            if m is None:
+                return
+            m = await self.press(uid, "method", m, "method_binance", edit_of(m, "Selected"))
+            if m is None:
+                return
+            m = await self.say(uid, "address", str(uid), has("amount to withdraw"))
+            if m is None:
+                return
+            if await self.say(uid, "amount", WITHDRAW_AMOUNT, has("sent to admin")):
+                self.withdrawers.append(uid)
+        await self.each(self.credited, flow)
+    async def phase_payout(self):
+        await self.review_queue("withdrawals", "approve_withdraw", "payout")
+        async def flow(uid):
+            await self.notified(uid, "payout", has("has been approved and processed"), self.notify_timeout)
+        await self.each(self.withdrawers, flow)
+    async def phase_broadcast(self):
+        panel = await self.say(ADMIN_ID, "/admin", "/admin", has("Admin Panel"))
+        m = panel and await self.press(ADMIN_ID, "broadcast button", panel, "admin_broadcast", edit_of(panel, "Send broadcast text"))
+        if m is None:
+            return
+        # Every user gets one message, paced by the bot's global send rate
+        timeout = self.notify_timeout + len(self.users) / self.send_rate
+        progress = await self.say(ADMIN_ID, "broadcast text", "Load test broadcast", has("Broadcast queued"))
+        if progress is None:
+            return
+        for uid in self.users:
+            self.caused[(uid, "broadcast")] = self.api.arrived(progress)
+        async def flow(uid):
+            await self.notified(uid, "broadcast", has("Broadcast from admin"), timeout)
+        await self.each(self.users, flow)
+        done = self.api.expect(ADMIN_ID, edit_of(progress, "Finished"), history=True)
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(done, self.step_timeout)
+# ========================
+# Report
+# ========================
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=HERE, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+def fmt(value, spec="9.1f"):
+    return format(value, spec) if value is not None else f"{'-':>{spec.split('.')[0]}}"
+def print_phase(name, r):
+    print(f"\n== {name}: {r['completed']}/{r['actions']} actions in {r['duration_s']:.2f}s = {fmt(r['actions_per_s'], '.1f')}/s, "
+          f"{r['failed']} failed, {fmt(r['api_calls_per_action'], '.2f')} API calls/action, bot CPU {fmt(r['bot_cpu_s'], '.2f')}s (load test {r['loadtest_cpu_s']:.2f}s), RSS {fmt(r['bot_rss_mb'], '.0f')}MB")
+    print(f"   {'':28} {'n':>7} {'failed':>7} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for step, m in r["steps"].items():
+        print(f"   {step:28} {m['n']:7} {m['failed']:7} {fmt(m['p50_ms'])} {fmt(m['p90_ms'])} {fmt(m['p99_ms'])} {fmt(m['max_ms'])}")
+    calls = ", ".join(f"{method} {n}" for method, n in r["api_calls"].items())
+    injected = ", ".join(f"{kind} {n}" for kind, n in r["injected"].items())
+    print(f"   API calls: {calls}" + (f" (injected: {injected})" if injected else ""))
+async def run(args):
+    workdir = args.work_dir or Path(tempfile.mkdtemp(prefix="bot-loadtest-"))
+    shutil.rmtree(workdir, ignore_errors=True)
+    workdir.mkdir(parents=True)
+    api = FakeBotApi(args.latency_ms / 1000, args.jitter_ms / 1000, args.error_rate, args.retry_after_rate, args.retry_after, SEED)
+    await api.start()
+    bot = BotProcess(args, api, workdir)
+    pusher = None
+    if args.mode == "webhook":
+        pusher = WebhookPusher(f"http://127.0.0.1:{bot.webhook_port}/telegram", WEBHOOK_SECRET)
+        api.sink = pusher.push
+    phases = {}
+    try:
+        await bot.start()
+        test = LoadTest(args, api, bot)
+        for name in args.phases.split(","):
+            phases[name] = await test.run(name)
+            print_phase(name, phases[name])
+    finally:
+        await bot.stop()
+        if pusher is not None:
+            await pusher.close()
+        await api.close()
+    result = {
+        "time": datetime.datetime.utcnow().isoformat() + "Z",
+        "revision": git_revision(),
+        "python": sys.version.split()[0],
+        "mode": args.mode,
+        "backend": args.backend,
+        "users": args.users,
+        "fsync": args.fsync,
+        "send_rate": args.send_rate,
+        "latency_ms": args.latency_ms,
+        "jitter_ms": args.jitter_ms,
+        "error_rate": args.error_rate,
+        "retry_after_rate": args.retry_after_rate,
+        "webhook_retries": pusher.retries if pusher else None,
+        "phases": phases,
+    }
+    print(f"\nBot log: {workdir / 'bot.log'}")
+    return result
+def main():
+    parser = argparse.ArgumentParser(description="Load-test bot.py end to end against a fake Bot API server")
+    parser.add_argument("--users", type=int, default=1000, help="simulated users")
+    parser.add_argument("--phases", default=",".join(PHASES), help=f"comma-separated, in order: {', '.join(PHASES)}")
+    parser.add_argument("--mode", choices=("polling", "webhook"), default="polling", help="how the bot receives updates")
+    parser.add_argument("--backend", choices=("json", "sqlite"), default="json")
+    parser.add_argument("--fsync", action="store_true", help="fsync every journal append, as the bot does by default")
+    parser.add_argument("--send-rate", type=float, default=25, help="the bot's GLOBAL_SEND_RATE")
+    parser.add_argument("--concurrency", type=int, default=0, help="users active at once within a phase (0 = all)")
+    parser.add_argument("--think-ms", type=float, default=0, help="mean pause between a user's steps")
+    parser.add_argument("--latency-ms", type=float, default=0, help="added to every sending API call")
+    parser.add_argument("--jitter-ms", type=float, default=0, help="uniform extra latency on top")
+    parser.add_argument("--error-rate", type=float, default=0, help="share of sending calls failed with HTTP 502")
+    parser.add_argument("--retry-after-rate", type=float, default=0, help="share of sending calls failed with 429 retry_after")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after seconds in injected 429s")
+    parser.add_argument("--step-timeout", type=float, default=30, help="seconds a user waits for a reply before the step counts as failed")
+    parser.add_argument("--notify-timeout", type=float, default=300, help="seconds a user waits for a queued notification")
+    parser.add_argument("--settle", type=float, default=10, help="longest wait after a phase for its queued notifications")
+    parser.add_argument("--work-dir", type=Path, help="the bot's data directory (emptied first; default: a new temp dir)")
+    parser.add_argument("--output", type=Path, default=HERE / "loadtest_output.txt", help="results file, one JSON line per run (appended)")
+    args = parser.parse_args()
+    unknown = set(args.phases.split(",")) - set(PHASES)
+    if unknown:
+        parser.error(f"unknown phase(s): {', '.join(sorted(unknown))}")
+    result = asyncio.run(run(args))
+    with open(args.output, "a", encoding="utf8") as f:
+        f.write(json.dumps(result) + "\n")
+if __name__ == "__main__":
+    main()
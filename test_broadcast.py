@@ -0,0 +1,75 @@
+import asyncio
+import time
+import types
+import pytest
+from telegram.error import Forbidden
+import bot
+USERS = list(range(101, 111))
+class FakeBot:
+    # Users in `blocked` have blocked the bot; pause_after pauses the broadcast once that many were sent
+    def __init__(self, engine, blocked=(), pause_after=None):
+        self.engine = engine
+        self.blocked = blocked
+        self.pause_after = pause_after
+        self.sent = []
+        self.progress = []
+    async def send_message(self, chat_id, text, **kwargs):
+        if chat_id in self.blocked:
+            raise Forbidden("bot was blocked by the user")
+        self.sent.append(chat_id)
+        if len(self.sent) == self.pause_after:
+            self.engine.state["status"] = "paused"
+    async def edit_message_text(self, text, chat_id, message_id, reply_markup=None):
+        self.progress.append(text)
+@pytest.fixture
+def store(open_store, monkeypatch):
+    monkeypatch.setattr(bot, "send_limiter", bot.RateLimiter(1000, 1000))
+    monkeypatch.setattr(bot, "BROADCAST_PAGE_SIZE", 4)
+    monkeypatch.setattr(bot, "BROADCAST_CONCURRENCY", 3)
+    store = open_store()
+    for uid in USERS:
+        store.create_user(uid, bot.now())
+    return store
+def begin(store, text="hello"):
+    # Started as the admin panel does, with the job run by the test instead of a JobQueue
+    engine = bot.BroadcastEngine(store)
+    engine.start(types.SimpleNamespace(run_once=lambda *args, **kwargs: None), text, bot.ADMIN_ID, 1)
+    return engine
+def test_broadcast_reaches_every_user_once(store):
+    engine = begin(store)
+    fake = FakeBot(engine, blocked={103, 107})
+    asyncio.run(engine.run(fake))
+    assert sorted(fake.sent) == [uid for uid in USERS if uid not in (103, 107)]
+    saved = store.get_meta("broadcast")
+    assert (saved["status"], saved["sent"], saved["failed"]) == ("done", 8, 2)
+    assert fake.progress[-1] == "📢 Broadcast — ✅ Finished\nSent: 8 | Failed: 2 | Users: 10"
+def test_paused_broadcast_resumes_after_a_restart(store, open_store):
+    engine = begin(store)
+    first = FakeBot(engine, pause_after=2)
+    asyncio.run(engine.run(first))
+    # The page in flight is finished, then the cursor is saved
+    assert store.get_meta("broadcast")["status"] == "paused" and len(first.sent) == 4
+    resumed = bot.BroadcastEngine(open_store())
+    assert resumed.is_active()
+    resumed.state["status"] = "running"
+    second = FakeBot(resumed)
+    asyncio.run(resumed.run(second))
+    assert sorted(first.sent + second.sent) == USERS
+    assert resumed.state["status"] == "done" and resumed.state["sent"] == 10
+def test_rate_limiter_paces_each_chat_and_backs_off():
+    limiter = bot.RateLimiter(1000, 20)
+    async def run():
+        start = time.monotonic()
+        await asyncio.gather(*(limiter.acquire(chat_id) for chat_id in range(5)))
+        other_chats = time.monotonic() - start
+        for _ in range(3):
+            await limiter.acquire(1)
+        same_chat = time.monotonic() - start
+        limiter.retry_after(0.2)
+        blocked_at = time.monotonic()
+        await limiter.acquire(99)
+        return other_chats, same_chat, time.monotonic() - blocked_at
+    other_chats, same_chat, blocked = asyncio.run(run())
+    assert other_chats < 0.05
+    assert same_chat >= 0.14
+    assert blocked >= 0.19
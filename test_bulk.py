@@ -0,0 +1,69 @@
+import asyncio
+import types
+import pytest
+import bot
+@pytest.fixture
+def store(open_store, monkeypatch):
+    # The module's store and services, with admin prompts sent to a fake bot without pacing
+    store = open_store()
+    for name, service in (("store", store), ("outbox", bot.Outbox(store, 1)), ("sweeper", bot.ExpirySweeper(store)), ("send_limiter", bot.RateLimiter(1000, 1000))):
+        monkeypatch.setattr(bot, name, service)
+    for uid in (1, 2):
+        store.create_user(uid, bot.now())
+    return store
+def admin_context():
+    prompts = []
+    async def send_message(chat_id, text, **kwargs):
+        prompts.append(text)
+        return types.SimpleNamespace(message_id=900 + len(prompts))
+    return types.SimpleNamespace(bot=types.SimpleNamespace(send_message=send_message), user_data={}, prompts=prompts)
+def moderate(context, sub_ids, approve):
+    async def run():
+        subs = await bot.bulk_moderate(context, sub_ids, approve)
+        await asyncio.gather(*bot.prompt_tasks)
+        return subs
+    return asyncio.run(run())
+def notices(store):
+    return {entry["chat_id"]: entry["text"] for entry in store.outbox_entries()}
+def test_bulk_reject_notifies_each_seller_once(store):
+    subs = [store.submit_groups(uid, [f"t.me/+r{uid}{i}"], "2023", "single", bot.now()) for uid in (1, 2) for i in range(2)]
+    store.set_submission_status(subs[0], bot.GroupStatus.REJECTED)
+    decided = moderate(admin_context(), subs, approve=False)
+    assert [sub.id for sub in decided] == subs[1:]
+    assert store.submissions(statuses=[bot.GroupStatus.PENDING]) == {}
+    assert store.link_entry("t.me/+r21").status == bot.GroupStatus.REJECTED
+    sent = notices(store)
+    assert set(sent) == {1, 2}
+    assert sent[2].count("was rejected") == 2 and "t.me/+r20" in sent[2] and "t.me/+r21" in sent[2]
+    assert bot.bulk_notice(False, len(decided), len(subs)) == "❌ Rejected 3 submission(s), 1 already handled"
+def test_bulk_approve_asks_for_counts_and_buyers(store):
+    single = store.submit_groups(1, ["t.me/+s1", "t.me/+s2"], "2023", "single", bot.now())
+    folder = store.submit_groups(2, ["t.me/addlist/f1"], "2023", "folder", bot.now())
+    context = admin_context()
+    moderate(context, [single, folder], approve=True)
+    assert store.get_submission(single).status == bot.GroupStatus.WAITING_TARGET
+    assert store.get_submission(single).approved_count == 2
+    assert store.get_submission(folder).status == bot.GroupStatus.WAITING_COUNT
+    # Only the single submission's seller hears now; the folder's waits for the count
+    assert list(notices(store)) == [1]
+    assert sorted((req.type, req.submission_id) for req in store.pending_requests().values()) == [("buyer", single), ("count", folder)]
+    assert len(context.prompts) == 2
+def test_review_picks_feed_the_bulk_action(store):
+    subs = [store.submit_groups(1, [f"t.me/+p{i}"], "2023", "single", bot.now()) for i in range(3)]
+    context = admin_context()
+    edits = []
+    async def answer(*args, **kwargs):
+        pass
+    async def edit_message_text(text, **kwargs):
+        edits.append(text)
+    def press(data):
+        q = types.SimpleNamespace(data=data, answer=answer, edit_message_text=edit_message_text, from_user=types.SimpleNamespace(id=bot.ADMIN_ID))
+        asyncio.run(bot.bulk_callback(types.SimpleNamespace(callback_query=q), context))
+    press("review_pick:page|g.0")
+    assert context.user_data["review_selected"] == subs
+    press(f"review_pick:{subs[1]}|g.0")
+    assert context.user_data["review_selected"] == [subs[0], subs[2]]
+    press("review_bulk:reject|g.0")
+    assert [store.get_submission(sub_id) is None for sub_id in subs] == [True, False, True]
+    assert context.user_data["review_selected"] == []
+    assert edits[-1].startswith("❌ Rejected 2 submission(s)")
@@ -0,0 +1,50 @@
+import asyncio
+import types
+import pytest
+import bot
+SELLER = 2001
+@pytest.fixture
+def admin(open_store, monkeypatch):
+    # Presses an admin button against a fresh store -> (store, the texts the message was edited to, messages sent)
+    store = open_store()
+    monkeypatch.setattr(bot, "store", store)
+    monkeypatch.setattr(bot, "outbox", bot.Outbox(store, 1))
+    monkeypatch.setattr(bot, "sweeper", bot.ExpirySweeper(store))
+    edits, sent = [], []
+    async def answer(*args, **kwargs):
+        pass
+    async def edit_message_text(text, **kwargs):
+        edits.append(text)
+    async def send_message(chat_id, text, **kwargs):
+        sent.append((chat_id, text))
+        return types.SimpleNamespace(message_id=500 + len(sent))
+    def press(data):
+        q = types.SimpleNamespace(data=data, answer=answer, edit_message_text=edit_message_text, from_user=types.SimpleNamespace(id=bot.ADMIN_ID))
+        context = types.SimpleNamespace(bot=types.SimpleNamespace(send_message=send_message), user_data={})
+        asyncio.run(bot.admin_callback_handler(types.SimpleNamespace(callback_query=q), context))
+    store.create_user(SELLER, bot.now())
+    return store, press, edits, sent
+def test_button_acts_on_its_submission(admin):
+    store, press, edits, sent = admin
+    first = store.submit_groups(SELLER, ["t.me/+one"], "2023", "single", bot.now())
+    second = store.submit_groups(SELLER, ["t.me/+two"], "2023", "single", bot.now())
+    press(f"reject_group:{second}")
+    assert store.get_submission(second) is None
+    assert store.get_submission(first).status == bot.GroupStatus.PENDING
+    assert edits == [f"❌ Submission #{second} (1 link(s)) rejected."]
+    press(f"reject_group:{second}")
+    assert edits[-1].startswith("⌛ This button has expired")
+def test_old_seller_button_acts_on_the_only_pending_submission(admin):
+    store, press, edits, sent = admin
+    sub_id = store.submit_groups(SELLER, ["t.me/+one", "t.me/+two"], "2023", "single", bot.now())
+    press(f"approve_group:{SELLER}")
+    assert store.get_submission(sub_id).status == bot.GroupStatus.WAITING_TARGET
+    assert edits == [f"✅ Submission #{sub_id} (2 link(s)) approved."]
+    assert sent[0][0] == bot.ADMIN_ID and f"submission #{sub_id}" in sent[0][1]
+def test_old_seller_button_with_several_pending_submissions_has_expired(admin):
+    store, press, edits, sent = admin
+    subs = [store.submit_groups(SELLER, [link], "2023", "single", bot.now()) for link in ("t.me/+one", "t.me/+two")]
+    press(f"reject_group:{SELLER}")
+    assert [store.get_submission(sub_id).status for sub_id in subs] == [bot.GroupStatus.PENDING] * 2
+    assert edits[0].startswith("⌛ This button has expired")
+    assert sent == []
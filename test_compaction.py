@@ -0,0 +1,57 @@
+import asyncio
+import json
+import threading
+import pytest
+import bot
+def canonical(d):
+    d = dict(d, **{name: dict(d[name].items()) for name in bot.LAZY_SECTIONS})
+    return json.dumps(d, sort_keys=True, default=bot.json_default)
+def open_json_store(path, snapshot_format):
+    return bot.JsonStore(bot.PersistenceManager(path, 1 << 30, 1e9, False, snapshot_format))
+def read_snapshot(path, snapshot_format):
+    if snapshot_format == "json":
+        return bot.read_json_snapshot(path)
+    d, _, snapshot = bot.read_binary_snapshot(path.with_suffix(".snap"))
+    d = dict(d, **{name: dict(d[name].items()) for name in bot.LAZY_SECTIONS})
+    snapshot.close()
+    return d
+@pytest.mark.parametrize("snapshot_format", ["json", "binary"])
+def test_ops_during_compaction_stay_out_of_the_snapshot(tmp_path, populate, monkeypatch, snapshot_format):
+    path = tmp_path / "data.json"
+    store = open_json_store(path, snapshot_format)
+    populate(store)
+    asyncio.run(store.persistence.compact())
+    # Restarted, so a binary snapshot's records are decoded lazily
+    store = open_json_store(path, snapshot_format)
+    store.credit(1, 1.0)
+    frozen = canonical(store.data)
+    seq = store.data["journal_seq"]
+    encoding, resume = threading.Event(), threading.Event()
+    write_snapshot = store.persistence._write_snapshot
+    def paused(*args):
+        encoding.set()
+        resume.wait(5)
+        return write_snapshot(*args)
+    monkeypatch.setattr(store.persistence, "_write_snapshot", paused)
+    async def run():
+        compaction = asyncio.create_task(store.persistence.compact())
+        await asyncio.to_thread(encoding.wait, 5)
+        # Change users, withdrawals and links in place while the worker thread has the snapshot
+        store.credit(2, 3.0)
+        store.set_prices(1, bot.format_price_table({"2023": 900}))
+        (wid, _), = store.pending_withdrawals().items()
+        store.close_withdrawal(wid, bot.WithdrawalStatus.REJECTED, bot.now())
+        (pending,) = [sub.id for sub in store.submissions().values() if sub.status == bot.GroupStatus.PENDING]
+        store.set_submission_status(pending, bot.GroupStatus.WAITING_TARGET, approved_count=1)
+        store.sell_submission(pending, 1, 4.0, bot.now())
+        store.submit_groups(1, ["t.me/+late"], "2023", "single", bot.now())
+        store.create_user(4, bot.now())
+        resume.set()
+        await compaction
+    asyncio.run(run())
+    snapshot = read_snapshot(path, snapshot_format)
+    assert snapshot["journal_seq"] == seq
+    assert canonical(snapshot) == frozen
+    restarted = open_json_store(path, snapshot_format)
+    assert restarted.persistence.ops_since_compact == 7
+    assert canonical(restarted.data) == canonical(store.data) != frozen
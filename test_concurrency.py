@@ -0,0 +1,90 @@
+import asyncio
+import datetime
+import pytest
+from telegram import Chat, Message, Update, User
+from telegram.ext import ApplicationBuilder, TypeHandler
+import bot
+import loadtest
+def message_update(update_id, uid, text):
+    message = Message(update_id, datetime.datetime.now(datetime.timezone.utc), Chat(uid, Chat.PRIVATE), from_user=User(uid, "u", False), text=text)
+    return Update(update_id, message=message)
+def test_same_key_waits_other_keys_do_not():
+    locks = bot.KeyedLocks()
+    order = []
+    async def worker(name, keys, delay):
+        async with locks.hold(*keys):
+            order.append(f"{name} in")
+            await asyncio.sleep(delay)
+            order.append(f"{name} out")
+    async def run():
+        await asyncio.gather(
+            worker("a", [("balance", 1)], 0.05),
+            worker("b", [("balance", 1)], 0),
+            worker("c", [("balance", 2)], 0),
+        )
+    asyncio.run(run())
+    assert order.index("b in") > order.index("a out")
+    assert order.index("c out") < order.index("a out")
+    assert locks._locks == {}
+def test_keys_taken_in_any_order_do_not_deadlock():
+    locks = bot.KeyedLocks()
+    async def worker(keys):
+        for _ in range(20):
+            async with locks.hold(*keys):
+                await asyncio.sleep(0)
+    async def run():
+        await asyncio.wait_for(asyncio.gather(
+            worker([("submission", "1"), ("balance", 1)]),
+            worker([("balance", 1), ("submission", "1")]),
+        ), 5)
+    asyncio.run(run())
+    assert locks._locks == {}
+def test_busy_user_is_parked_and_others_go_ahead():
+    async def run():
+        api = loadtest.FakeBotApi() # Answers the getMe of initialize()
+        await api.start()
+        app = (
+            ApplicationBuilder().application_class(bot.MarketplaceApplication).token(loadtest.BOT_TOKEN)
+            .base_url(f"http://127.0.0.1:{api.port}/bot").updater(None).concurrent_updates(8).update_queue(bot.UpdateQueue(10)).build()
+        )
+        await app.initialize()
+        try:
+            await scenario(app)
+        finally:
+            await app.shutdown()
+            await api.close()
+    async def scenario(app):
+        seen, release = [], asyncio.Event()
+        async def handle(update, context):
+            seen.append((update.effective_user.id, update.message.text))
+            if update.message.text == "slow":
+                await release.wait()
+        app.add_handler(TypeHandler(Update, handle))
+        first = asyncio.create_task(app.process_update(message_update(1, 1001, "slow")))
+        await asyncio.sleep(0)
+        # Arrives while the first one is still running: parked behind it, counted until processed
+        await app.process_update(message_update(2, 1001, "next"))
+        assert app.update_queue.backlog == 1
+        await app.process_update(message_update(3, 1002, "other user"))
+        assert seen == [(1001, "slow"), (1002, "other user")]
+        release.set()
+        await first
+        assert seen[-1] == (1001, "next")
+        assert app.update_queue.backlog == 0 and app.pending == {}
+    asyncio.run(run())
+def test_update_queue_counts_updates_until_processed():
+    async def run():
+        queue = bot.UpdateQueue(2)
+        queue.put_nowait("a")
+        queue.put_nowait("b")
+        queue.get_nowait()
+        # Taken off the queue but not processed yet: still no room
+        with pytest.raises(asyncio.QueueFull):
+            queue.put_nowait("c")
+        waiting = asyncio.create_task(queue.put("c"))
+        await asyncio.sleep(0)
+        assert not waiting.done()
+        queue.task_done()
+        await asyncio.wait_for(waiting, 1)
+        assert queue.backlog == 2
+    asyncio.run(run())
@@ -0,0 +1,58 @@
+import asyncio
+import bot
+CHANNEL, OTHER = -1001, -1002
+def texts(store, chat_id):
+    return [entry["text"] for entry in store.outbox_entries() if entry["chat_id"] == chat_id]
+def test_posts_go_out_as_one_digest_per_channel(open_store):
+    store = open_store()
+    digest = bot.ChannelDigest(store, bot.Outbox(store, 1), 0.05, 50)
+    async def run():
+        digest.post(CHANNEL, "first\nline two")
+        digest.post(CHANNEL, "second")
+        digest.post(OTHER, "alone")
+        assert store.outbox_entries() == [] and digest.pending() == 3
+        await asyncio.sleep(0.2)
+    asyncio.run(run())
+    assert texts(store, CHANNEL) == ["🗂 Digest: 2 new event(s)\n\nfirst\nline two\n\nsecond"]
+    assert texts(store, OTHER) == ["alone"]
+    assert store.digest_entries() == [] and digest.pending() == 0
+def test_a_full_digest_is_flushed_at_once(open_store):
+    store = open_store()
+    digest = bot.ChannelDigest(store, bot.Outbox(store, 1), 3600, 3)
+    async def run():
+        for i in range(4):
+            digest.post(CHANNEL, f"event {i}")
+    asyncio.run(run())
+    assert texts(store, CHANNEL) == ["🗂 Digest: 3 new event(s)\n\nevent 0\n\nevent 1\n\nevent 2"]
+    assert [entry["text"] for entry in store.digest_entries()] == ["event 3"]
+def test_long_digest_is_split_at_the_message_limit(open_store):
+    store = open_store()
+    digest = bot.ChannelDigest(store, bot.Outbox(store, 1), 3600, 100)
+    post = "x" * 1000
+    async def run():
+        for _ in range(10):
+            digest.post(CHANNEL, post)
+        digest.close()
+    asyncio.run(run())
+    sent = texts(store, CHANNEL)
+    assert len(sent) > 1 and all(len(text) <= bot.TELEGRAM_MESSAGE_LIMIT for text in sent)
+    assert "".join(sent).count(post) == 10
+def test_collected_posts_survive_a_restart(open_store):
+    store = open_store()
+    async def run():
+        bot.ChannelDigest(store, bot.Outbox(store, 1), 3600, 50).post(CHANNEL, "before the restart")
+    asyncio.run(run())
+    store = open_store()
+    assert texts(store, CHANNEL) == []
+    async def restart():
+        digest = bot.ChannelDigest(store, bot.Outbox(store, 1), 3600, 50)
+        digest.start()
+        digest.post(CHANNEL, "after")
+        digest.close()
+    asyncio.run(restart())
+    assert texts(store, CHANNEL) == ["🗂 Digest: 2 new event(s)\n\nbefore the restart\n\nafter"]
+    assert open_store().digest_entries() == []
+def test_zero_seconds_posts_right_away(open_store):
+    store = open_store()
+    bot.ChannelDigest(store, bot.Outbox(store, 1), 0, 50).post(CHANNEL, "now")
+    assert texts(store, CHANNEL) == ["now"] and store.digest_entries() == []
@@ -0,0 +1,38 @@
+import asyncio
+import pytest
+import bot
+def open_json_store(path, snapshot_format):
+    return bot.JsonStore(bot.PersistenceManager(path, 1 << 30, 1e9, False, snapshot_format))
+@pytest.mark.parametrize("snapshot_format", ["json", "binary"])
+def test_replay_skips_ops_already_in_the_snapshot(tmp_path, snapshot_format):
+    path = tmp_path / "data.json"
+    store = open_json_store(path, snapshot_format)
+    store.create_user(1, bot.now())
+    for _ in range(3):
+        store.credit(1, 5.0)
+    wid = store.open_withdrawal(1, "binance", "addr", 4.0, bot.now())
+    folded = [(p, p.read_bytes()) for _, p in store.persistence.segments()]
+    asyncio.run(store.persistence.compact())
+    assert store.persistence.segments() == []
+    # Crash after the snapshot was written but before the folded segments were removed
+    for p, journal in folded:
+        p.write_bytes(journal)
+    store.credit(1, 1.0)
+    store.close_withdrawal(wid, bot.WithdrawalStatus.REJECTED, bot.now())
+    restarted = open_json_store(path, snapshot_format)
+    assert restarted.persistence.ops_since_compact == 2
+    assert restarted.data["journal_seq"] == store.data["journal_seq"]
+    assert restarted.get_user(1).balance == 16.0
+    assert restarted.get_withdrawal(wid).status == bot.WithdrawalStatus.REJECTED
+    assert restarted.pending_withdrawals() == {}
+def test_replay_skips_a_torn_tail(tmp_path):
+    path = tmp_path / "data.json"
+    store = open_json_store(path, "json")
+    store.create_user(1, bot.now())
+    store.credit(1, 5.0)
+    (_, segment), = store.persistence.segments()
+    with open(segment, "a", encoding="utf8") as f:
+        f.write('{"op": "balance_credited", "seq": 3, "uid": 1, "amo')
+    restarted = open_json_store(path, "json")
+    assert restarted.get_user(1).balance == 5.0
+    assert restarted.data["journal_seq"] == 2
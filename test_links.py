@@ -0,0 +1,44 @@
+import pytest
+import bot
+SELLER, OTHER = 2001, 2002
+@pytest.mark.parametrize("link, canonical", [
+    ("https://t.me/+AbC123", "t.me/+AbC123"),
+    ("t.me/joinchat/AbC123", "t.me/+AbC123"),
+    ("http://telegram.me/+AbC123/", "t.me/+AbC123"),
+    ("https://www.t.me/SomeGroup", "t.me/somegroup"),
+    ("T.ME/addlist/XyZ", "t.me/addlist/XyZ"),
+    (" t.me/+AbC123 ", "t.me/+AbC123"),
+])
+def test_canonical_link(link, canonical):
+    assert bot.canonical_link(link) == canonical
+def test_invite_hashes_stay_case_sensitive():
+    assert bot.canonical_link("t.me/+abc") != bot.canonical_link("t.me/+ABC")
+@pytest.fixture
+def store(open_store, monkeypatch):
+    # bot.taken_links() reads the module's store
+    store = open_store()
+    monkeypatch.setattr(bot, "store", store)
+    for uid in (SELLER, OTHER):
+        store.create_user(uid, bot.now())
+    return store
+def test_listed_link_is_taken_under_any_spelling(store):
+    store.submit_groups(SELLER, ["https://t.me/+Hash1"], "2023", "single", bot.now())
+    links = ["t.me/joinchat/Hash1", "telegram.me/+Hash1", "t.me/+hash1"]
+    assert bot.taken_links(OTHER, links) == links[:2]
+    assert bot.taken_links(SELLER, links) == links[:2]
+def test_repeats_within_one_submission_are_taken(store):
+    assert bot.taken_links(SELLER, ["t.me/+New", "https://t.me/+New", "t.me/Public", "t.me/public"]) == ["https://t.me/+New", "t.me/public"]
+def test_rejected_link_stays_blocked_only_for_its_seller(store):
+    sub_id = store.submit_groups(SELLER, ["t.me/+Hash2"], "2023", "single", bot.now())
+    store.set_submission_status(sub_id, bot.GroupStatus.REJECTED)
+    assert store.link_entry("t.me/+Hash2").status == bot.GroupStatus.REJECTED
+    assert bot.taken_links(SELLER, ["t.me/joinchat/Hash2"]) == ["t.me/joinchat/Hash2"]
+    assert bot.taken_links(OTHER, ["t.me/joinchat/Hash2"]) == []
+def test_sold_link_stays_taken_and_the_index_is_persisted(store, open_store):
+    sub_id = store.submit_groups(SELLER, ["t.me/+Hash3"], "2023", "single", bot.now())
+    store.set_submission_status(sub_id, bot.GroupStatus.WAITING_TARGET, approved_count=1)
+    store.sell_submission(sub_id, 1, 5.5, bot.now())
+    reopened = open_store()
+    entry = reopened.link_entry("t.me/+Hash3")
+    assert (entry.owner, entry.status) == (SELLER, bot.GroupStatus.SOLD)
+    assert bot.link_taken(entry, OTHER) and bot.link_taken(entry, SELLER)
@@ -0,0 +1,72 @@
+import asyncio
+import types
+import pytest
+from telegram.ext import CommandHandler, ConversationHandler
+import bot
+@pytest.fixture
+def metrics(monkeypatch):
+    metrics = bot.Metrics()
+    monkeypatch.setattr(bot, "metrics", metrics)
+    return metrics
+def test_histogram_quantiles():
+    hist = bot.Histogram((1, 2, 5))
+    for value in (0.5, 1, 1.5, 2, 3, 10):
+        hist.observe(value)
+    assert hist.counts == [2, 2, 1, 1] and hist.count == 6 and hist.sum == 18
+    assert (hist.quantile(0.3), hist.quantile(0.5), hist.quantile(0.8), hist.quantile(1)) == (1, 2, 5, float("inf"))
+def test_render_prometheus_text(metrics):
+    metrics.inc("bot_updates_shed_total", "sell")
+    metrics.inc("bot_updates_shed_total", "sell", value=2)
+    metrics.inc("bot_api_errors_total", 'say "hi"\n', "400")
+    metrics.observe("bot_update_seconds", 0.003)
+    metrics.observe("bot_update_seconds", 0.2)
+    metrics.observe("bot_journal_append_bytes", 300)
+    metrics.gauge("bot_outbox_pending", lambda: 7)
+    lines = metrics.render().splitlines()
+    assert "# TYPE bot_updates_shed_total counter" in lines
+    assert 'bot_updates_shed_total{action="sell"} 3' in lines
+    assert 'bot_api_errors_total{method="say \\"hi\\"\\n",code="400"} 1' in lines
+    assert 'bot_update_seconds_bucket{le="0.0025"} 0' in lines
+    assert 'bot_update_seconds_bucket{le="0.005"} 1' in lines
+    assert 'bot_update_seconds_bucket{le="0.25"} 2' in lines
+    assert 'bot_update_seconds_bucket{le="+Inf"} 2' in lines
+    assert "bot_update_seconds_count 2" in lines
+    assert 'bot_journal_append_bytes_bucket{le="256"} 0' in lines and 'bot_journal_append_bytes_bucket{le="1024"} 1' in lines
+    assert "bot_outbox_pending 7" in lines
+    # Gauges nobody registered are declared but have no sample
+    assert "# TYPE bot_digest_pending gauge" in lines and not any(line.startswith("bot_digest_pending ") for line in lines)
+def test_handlers_are_timed_once_with_their_errors(metrics):
+    async def cmd_ok(update, context):
+        return "ok"
+    async def cmd_broken(update, context):
+        raise RuntimeError("boom")
+    conversation = ConversationHandler(entry_points=[CommandHandler("broken", cmd_broken)], states={}, fallbacks=[])
+    handler = CommandHandler("ok", cmd_ok)
+    for h in (handler, conversation, handler):
+        bot.instrument_handler(h)
+    async def run():
+        assert await handler.callback(None, None) == "ok"
+        with pytest.raises(RuntimeError):
+            await conversation.entry_points[0].callback(None, None)
+    asyncio.run(run())
+    timings = metrics.series["bot_handler_seconds"]
+    assert {labels: hist.count for labels, hist in timings.items()} == {("cmd_ok",): 1, ("cmd_broken",): 1}
+    assert metrics.series["bot_handler_errors_total"] == {("cmd_broken",): 1}
+def test_metrics_endpoint(metrics, monkeypatch):
+    monkeypatch.setattr(bot, "METRICS_LISTEN", "127.0.0.1")
+    monkeypatch.setattr(bot, "METRICS_PORT", 0)
+    metrics.inc("bot_updates_shed_total", "other")
+    async def run():
+        await metrics.serve(types.SimpleNamespace(update_queue=bot.UpdateQueue(1), bot=None))
+        try:
+            reader, writer = await asyncio.open_connection("127.0.0.1", metrics.server.port)
+            writer.write(b"GET /metrics HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n")
+            response = await reader.read()
+            writer.close()
+        finally:
+            await metrics.close()
+        return response
+    head, _, body = asyncio.run(run()).partition(b"\r\n\r\n")
+    assert head.startswith(b"HTTP/1.1 200")
+    assert b"text/plain; version=0.0.4" in head
+    assert 'bot_updates_shed_total{action="other"} 1' in body.decode().splitlines()
@@ -0,0 +1,35 @@
+import asyncio
+import json
+import bot
+def contents(store):
+    # Everything a handler can read back, with records as their JSON dicts
+    users = dict(store.iter_users())
+    return json.loads(json.dumps({
+        "users": {uid: (u.balance, u.sales, u.custom_prices, u.start_time) for uid, u in users.items()},
+        "groups": {uid: store.group_count(uid) for uid in users},
+        "history": {uid: store.withdrawal_history(uid, limit=100) for uid in users},
+        "submissions": store.submissions(),
+        "links": {link: store.link_entry(link) for link in ("t.me/+sold1", "t.me/+folder", "t.me/+nope", "t.me/+pending")},
+        "withdrawals": store.pending_withdrawals(),
+        "requests": store.pending_requests(),
+        "stats": store.stats(),
+        "top_sellers": store.top_sellers(10),
+        "prices": store.global_prices(),
+        "sell_enabled": store.sell_enabled(),
+        "broadcast": store.get_meta("broadcast"),
+        "outbox": store.outbox_entries(),
+        "digest": store.digest_entries(),
+        "user_data": store.all_user_data(),
+        "conversations": sorted(store.conversations("withdraw").items()),
+        "review": [store.review_page(queue, 0, 10) for queue in ("groups", "withdrawals")],
+    }, default=bot.json_default))
+def test_migrate_json_to_sqlite(tmp_path, populate):
+    source = bot.JsonStore(bot.PersistenceManager(tmp_path / "data.json", 1 << 30, 1e9, False))
+    populate(source)
+    asyncio.run(source.persistence.compact())
+    source.credit(3, 1.0) # Still in the journal, not yet in data.json
+    bot.migrate_json_to_sqlite(tmp_path / "data.json", tmp_path / "data.sqlite3")
+    target = bot.SqliteStore(tmp_path / "data.sqlite3", False)
+    expected, migrated = contents(source), contents(target)
+    for name in expected:
+        assert migrated[name] == expected[name], name
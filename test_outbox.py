@@ -0,0 +1,71 @@
+import asyncio
+import pytest
+from telegram.error import BadRequest, NetworkError
+import bot
+class FakeBot:
+    # Records what was sent; failures[chat_id] lists errors to raise on the next sends there
+    def __init__(self, failures=None, slow=()):
+        self.sent = []
+        self.failures = failures or {}
+        self.slow = slow
+    async def send_message(self, chat_id, text, reply_markup=None, parse_mode=None):
+        if chat_id in self.slow:
+            await asyncio.sleep(0.5)
+        errors = self.failures.get(chat_id)
+        if errors:
+            raise errors.pop(0)
+        self.sent.append((chat_id, text))
+@pytest.fixture(autouse=True)
+def fast_sends(monkeypatch):
+    monkeypatch.setattr(bot, "send_limiter", bot.RateLimiter(1000, 1000))
+    monkeypatch.setattr(bot, "OUTBOX_BACKOFF_MAX", 0)
+def deliver(store, fake, until, workers=2):
+    # Starts an outbox on the store, waits until(fake) holds (or a second passes), then stops it
+    async def run():
+        outbox = bot.Outbox(store, workers)
+        outbox.start(fake)
+        for _ in range(100):
+            if until(fake):
+                break
+            await asyncio.sleep(0.01)
+        await outbox.close()
+    asyncio.run(run())
+def test_undelivered_entries_survive_a_restart(open_store):
+    store = open_store()
+    outbox = bot.Outbox(store, 1)
+    for i in range(3):
+        outbox.enqueue(1, f"msg {i}")
+    outbox.enqueue(2, "other chat")
+    store = open_store()
+    fake = FakeBot()
+    deliver(store, fake, lambda fake: len(fake.sent) == 4)
+    assert [text for chat_id, text in fake.sent if chat_id == 1] == ["msg 0", "msg 1", "msg 2"]
+    assert store.outbox_entries() == []
+    assert open_store().outbox_entries() == []
+def test_transient_failures_are_retried_in_order(open_store):
+    store = open_store()
+    outbox = bot.Outbox(store, 1)
+    outbox.enqueue(1, "first")
+    outbox.enqueue(1, "second")
+    fake = FakeBot(failures={1: [NetworkError("timed out"), NetworkError("timed out")]})
+    deliver(store, fake, lambda fake: len(fake.sent) == 2)
+    assert fake.sent == [(1, "first"), (1, "second")]
+    assert store.outbox_entries() == []
+def test_permanent_failure_drops_only_that_message(open_store):
+    store = open_store()
+    outbox = bot.Outbox(store, 1)
+    outbox.enqueue(1, "to a blocked chat")
+    outbox.enqueue(1, "next one")
+    fake = FakeBot(failures={1: [BadRequest("Chat not found")]})
+    deliver(store, fake, lambda fake: len(fake.sent) == 1)
+    assert fake.sent == [(1, "next one")]
+    assert store.outbox_entries() == []
+def test_slow_chat_does_not_hold_up_the_others(open_store):
+    store = open_store()
+    outbox = bot.Outbox(store, 1)
+    outbox.enqueue(1, "slow")
+    for chat_id in (2, 3, 4):
+        outbox.enqueue(chat_id, "fast")
+    fake = FakeBot(slow={1})
+    deliver(store, fake, lambda fake: len(fake.sent) == 4, workers=2)
+    assert [chat_id for chat_id, _ in fake.sent] == [2, 3, 4, 1]
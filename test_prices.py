@@ -0,0 +1,47 @@
+import pytest
+import bot
+@pytest.mark.parametrize("value, cents", [("11", 1100), ("11$", 1100), ("$5.5", 550), ("10.05 $", 1005), (" 0.99", 99)])
+def test_parse_price(value, cents):
+    assert bot.parse_price(value) == cents
+@pytest.mark.parametrize("value", ["", "abc", "5.555", "-3", "1,5"])
+def test_parse_price_rejects(value):
+    with pytest.raises(ValueError):
+        bot.parse_price(value)
+def test_price_table_round_trip():
+    table = bot.parse_price_table("2016-22: 10$, 2023: 5.5, ")
+    assert table == {"2016-22": 1000, "2023": 550}
+    assert bot.format_price_table(table) == {"2016-22": "10$", "2023": "5.50$"}
+@pytest.mark.parametrize("text", ["", "2023 5$", ": 5$", "2023: 5$, 2024: lots"])
+def test_bad_price_table_is_rejected_whole(text):
+    with pytest.raises(ValueError):
+        bot.parse_price_table(text)
+@pytest.fixture
+def book(open_store):
+    store = open_store()
+    for uid in (1, 2):
+        store.create_user(uid, bot.now())
+    book = bot.PriceBook(store, 1)
+    book.set_global({"2016-22": 1000, "2023": 550})
+    return book
+def test_custom_prices_override_the_global_ones(book):
+    book.set_custom(1, {"2023": 700})
+    assert (book.price(1, "2023"), book.price(1, "2016-22"), book.price(1, "2030")) == (700, 1000, None)
+    assert book.price(2, "2023") == 550
+    assert "✨ *Your Custom Prices:*\n📅 2023: 7$" in book.text(1)
+    assert "Custom" not in book.text(2)
+def test_cached_tables_follow_price_changes(book):
+    assert book.price(1, "2023") == 550
+    book.set_global({"2023": 600})
+    assert book.price(1, "2023") == 600 and book.price(1, "2016-22") is None
+    book.set_custom(1, {"2023": 650})
+    assert book.price(1, "2023") == 650
+    # A cache of one: user 2 evicts user 1, who is rebuilt from the store
+    assert book.price(2, "2023") == 600
+    assert list(book._users) == [2]
+    assert book.price(1, "2023") == 650
+def test_prices_are_stored_normalized(book, open_store):
+    book.set_custom(2, {"2023": 1005})
+    store = open_store()
+    assert store.global_prices() == {"2016-22": "10$", "2023": "5.50$"}
+    assert store.get_user(2).custom_prices == {"2023": "10.05$"}
+    assert bot.PriceBook(store, 10).price(2, "2023") == 1005
@@ -0,0 +1,46 @@
+import bot
+def ids(page):
+    return [item_id for _, item_id in page[0]]
+def fill(store):
+    # Seven pending submissions from two sellers, two that left the queue, and withdrawals
+    for uid in (1, 2):
+        store.create_user(uid, bot.now())
+        store.credit(uid, 100.0)
+    subs = [store.submit_groups(1 + i % 2, [f"t.me/+queued{i}"], "2023", "single", bot.now()) for i in range(9)]
+    store.set_submission_status(subs[1], bot.GroupStatus.WAITING_TARGET, approved_count=1)
+    store.set_submission_status(subs[4], bot.GroupStatus.REJECTED)
+    wids = [store.open_withdrawal(1, "binance", "addr", 1.0, bot.now()) for _ in range(3)]
+    store.close_withdrawal(wids[0], bot.WithdrawalStatus.APPROVED, bot.now())
+    return [sub_id for i, sub_id in enumerate(subs) if i not in (1, 4)], wids[1:]
+def test_pages_walk_the_queue_both_ways(open_store):
+    store = open_store()
+    pending, _ = fill(store)
+    first = store.review_page("groups", 0, 3)
+    assert ids(first) == pending[:3] and first[1:] == (False, True, 7)
+    second = store.review_page("groups", first[0][-1][0], 3)
+    assert ids(second) == pending[3:6] and second[1:] == (True, True, 7)
+    last = store.review_page("groups", second[0][-1][0], 3)
+    assert ids(last) == pending[6:] and last[1:] == (True, False, 7)
+    back = store.review_page("groups", last[0][0][0], 3, backward=True)
+    assert ids(back) == ids(second) and back[1:3] == (True, True)
+def test_pages_stay_put_when_items_are_handled(open_store):
+    store = open_store()
+    pending, _ = fill(store)
+    first = store.review_page("groups", 0, 3)
+    # Handled on the first page meanwhile: the next page still starts after it
+    store.set_submission_status(pending[0], bot.GroupStatus.REJECTED)
+    store.submit_groups(1, ["t.me/+late"], "2023", "single", bot.now())
+    second = store.review_page("groups", first[0][-1][0], 3)
+    assert ids(second) == pending[3:6] and second[3] == 7
+    refreshed = store.review_page("groups", 0, 3)
+    assert ids(refreshed) == pending[1:4] and not refreshed[1]
+def test_withdrawal_queue_lists_pending_ones(open_store):
+    store = open_store()
+    _, open_wids = fill(store)
+    page = store.review_page("withdrawals", 0, 10)
+    assert ids(page) == open_wids and page[1:] == (False, False, 2)
+    store.close_withdrawal(open_wids[0], bot.WithdrawalStatus.REJECTED, bot.now())
+    assert ids(open_store().review_page("withdrawals", 0, 10)) == open_wids[1:]
+def test_cursor_round_trips_through_base_36():
+    for n in (0, 35, 36, 123456789):
+        assert int(bot.to_b36(n), 36) == n
@@ -0,0 +1,67 @@
+import asyncio
+import datetime
+import pytest
+import bot
+SELLER, BUYER = 2001, 2002
+def hours_ago(hours):
+    return (datetime.datetime.utcnow() - datetime.timedelta(hours=hours)).isoformat() + "Z"
+@pytest.fixture
+def sweep(monkeypatch):
+    # Runs one sweep over a fresh sweeper and returns the messages it queued, per chat
+    def sweep(store):
+        monkeypatch.setattr(bot, "outbox", bot.Outbox(store, 1))
+        sweeper = bot.ExpirySweeper(store)
+        sweeper.load()
+        asyncio.run(sweeper.sweep(None))
+        sent = {}
+        for entry in store.outbox_entries():
+            sent.setdefault(entry["chat_id"], []).append(entry["text"])
+        return sent
+    return sweep
+def submit(store, monkeypatch, link, submitted, approved):
+    store.create_user(SELLER, bot.now())
+    sub_id = store.submit_groups(SELLER, [link], "2023", "single", hours_ago(submitted))
+    with monkeypatch.context() as m:
+        m.setattr(bot, "now", lambda: hours_ago(approved))
+        store.set_submission_status(sub_id, bot.GroupStatus.WAITING_TARGET, approved_count=1)
+    return sub_id
+def test_unanswered_review_expires(open_store, sweep):
+    store = open_store()
+    store.create_user(SELLER, bot.now())
+    sub_id = store.submit_groups(SELLER, ["t.me/+stale"], "2023", "single", hours_ago(bot.SUBMISSION_REVIEW_TTL_HOURS + 1))
+    sent = sweep(store)
+    assert store.get_submission(sub_id) is None
+    assert store.link_entry("t.me/+stale").status == bot.GroupStatus.EXPIRED
+    assert "expired" in sent[SELLER][0]
+def test_deal_ttl_runs_from_the_approval(open_store, sweep, monkeypatch):
+    store = open_store()
+    ttl = bot.SUBMISSION_DEAL_TTL_HOURS
+    fresh = submit(store, monkeypatch, "t.me/+fresh", submitted=ttl + 5, approved=1)
+    stale = submit(store, monkeypatch, "t.me/+stale", submitted=ttl + 5, approved=ttl + 1)
+    sweep(store)
+    assert store.get_submission(fresh).status == bot.GroupStatus.WAITING_TARGET
+    assert store.get_submission(stale) is None
+@pytest.mark.parametrize("ownership", [bot.OwnershipStatus.REQUESTED, bot.OwnershipStatus.TRANSFERRED])
+def test_deal_with_a_transfer_is_escalated_not_expired(open_store, sweep, monkeypatch, ownership):
+    store = open_store()
+    ttl = bot.SUBMISSION_DEAL_TTL_HOURS
+    sub_id = submit(store, monkeypatch, "t.me/+handed", submitted=2 * ttl, approved=2 * ttl)
+    with monkeypatch.context() as m:
+        m.setattr(bot, "now", lambda: hours_ago(ttl + 1))
+        store.set_ownership(sub_id, bot.OwnershipStatus.REQUESTED, target=BUYER)
+        if ownership == bot.OwnershipStatus.TRANSFERRED:
+            store.set_ownership(sub_id, ownership)
+    sent = sweep(store)
+    sub = store.get_submission(sub_id)
+    assert sub.status == bot.GroupStatus.WAITING_TARGET and sub.ownership_status == ownership
+    assert store.link_entry("t.me/+handed").status == bot.GroupStatus.WAITING_TARGET
+    assert SELLER not in sent
+    assert f"#{sub_id} 👤 {SELLER} ➝ 👤 {BUYER}, transfer {ownership}" in sent[bot.ADMIN_ID][0]
+def test_pending_withdrawal_is_brought_back(open_store, sweep, monkeypatch):
+    store = open_store()
+    store.create_user(SELLER, bot.now())
+    store.credit(SELLER, 5.0)
+    wid = store.open_withdrawal(SELLER, "binance", "addr", 5.0, hours_ago(bot.WITHDRAWAL_REMIND_HOURS + 1))
+    sent = sweep(store)
+    assert store.get_withdrawal(wid).status == bot.WithdrawalStatus.PENDING
+    assert f"#{wid} 👤 {SELLER}" in sent[bot.ADMIN_ID][0]
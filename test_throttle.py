@@ -0,0 +1,48 @@
+import datetime
+import pytest
+from telegram import Chat, Message, Update, User
+import bot
+def message_update(uid, text):
+    message = Message(1, datetime.datetime.now(datetime.timezone.utc), Chat(uid, Chat.PRIVATE), from_user=User(uid, "u", False), text=text)
+    return Update(1, message=message)
+@pytest.mark.parametrize("spec, limit", [("5/600", (5, 600.0)), ("20/0.5", (20, 0.5)), ("0", None), ("", None)])
+def test_parse_limit(spec, limit):
+    assert bot.parse_limit(spec) == limit
+@pytest.mark.parametrize("spec", ["0/10", "5/0", "5", "x/10"])
+def test_parse_limit_rejects(spec):
+    with pytest.raises(ValueError):
+        bot.parse_limit(spec)
+def test_bucket_allows_a_burst_then_refills():
+    limit = bot.InboundLimit(3, 30)
+    t = limit.rotate_at - 30
+    assert [limit.allow(1, t) for _ in range(4)] == [True, True, True, False]
+    assert limit.allow(2, t)
+    assert not limit.allow(1, t + 9)
+    assert limit.allow(1, t + 10) and not limit.allow(1, t + 10)
+    assert all(limit.allow(1, t + 100) for _ in range(3))
+def test_idle_buckets_are_dropped():
+    limit = bot.InboundLimit(2, 10)
+    start = limit.rotate_at - 1
+    for uid in range(100):
+        limit.allow(uid, start)
+    limit.allow(1000, start + 1)
+    assert len(limit) == 101
+    # A whole window later, only the user seen during the last one is left
+    limit.allow(1000, start + 11)
+    assert len(limit) == 1
+@pytest.fixture
+def shed(monkeypatch):
+    monkeypatch.setattr(bot, "metrics", bot.Metrics())
+    return bot.metrics.series["bot_updates_shed_total"]
+def test_actions_have_separate_limits(shed):
+    throttle = bot.InboundThrottle({"sell": (2, 600), "withdraw": None, "other": (3, 60)})
+    sells = [throttle.allow(message_update(1001, "/sell")) for _ in range(3)]
+    keyboard = throttle.allow(message_update(1001, "🛍 Sell"))
+    assert sells == [True, True, False] and not keyboard
+    assert all(throttle.allow(message_update(1001, "💸 Withdraw")) for _ in range(10))
+    assert [throttle.allow(message_update(1001, "2023")) for _ in range(4)] == [True, True, True, False]
+    assert shed == {("sell",): 2, ("other",): 1}
+def test_admin_is_never_throttled(shed):
+    throttle = bot.InboundThrottle({"sell": (1, 600), "other": (1, 600)})
+    assert all(throttle.allow(message_update(bot.ADMIN_ID, "/sell")) for _ in range(5))
+    assert shed == {}
@@ -0,0 +1,86 @@
+import asyncio
+import json
+import pytest
+from telegram.ext import ApplicationBuilder, CommandHandler
+import bot
+import loadtest
+SECRET = "s3cret"
+# An update as Telegram posts it to the webhook
+START_UPDATE = {
+    "update_id": 712,
+    "message": {
+        "message_id": 5,
+        "date": 1700000000,
+        "chat": {"id": 1001, "type": "private", "first_name": "Ann"},
+        "from": {"id": 1001, "is_bot": False, "first_name": "Ann"},
+        "text": "/start",
+        "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+    },
+}
+async def post(port, body, secret=SECRET):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    payload = json.dumps(body).encode()
+    head = ["POST /hook HTTP/1.1", "Host: localhost", "Connection: close", f"Content-Length: {len(payload)}"]
+    if secret is not None:
+        head.append(f"X-Telegram-Bot-Api-Secret-Token: {secret}")
+    writer.write(("\r\n".join(head) + "\r\n\r\n").encode() + payload)
+    response = await reader.read()
+    writer.close()
+    head, _, body = response.partition(b"\r\n\r\n")
+    status_line, *lines = head.decode().split("\r\n")
+    headers = dict(line.split(": ", 1) for line in lines)
+    return int(status_line.split()[1]), headers, body
+def serve(test, queue_size=4, secret=SECRET):
+    async def run():
+        api = loadtest.FakeBotApi() # Answers the getMe of initialize()
+        await api.start()
+        app = ApplicationBuilder().token(loadtest.BOT_TOKEN).base_url(f"http://127.0.0.1:{api.port}/bot").updater(None).build()
+        await app.initialize()
+        server = bot.WebhookServer(bot.UpdateQueue(queue_size), app.bot, "/hook", secret, "127.0.0.1", 0)
+        await server.start()
+        try:
+            await test(app, server)
+        finally:
+            await server.close()
+            await app.shutdown()
+            await api.close()
+    asyncio.run(run())
+def test_bad_secret_is_forbidden():
+    async def test(app, server):
+        for secret in ("wrong", None):
+            status, _, _ = await post(server.port, START_UPDATE, secret)
+            assert status == 403
+        assert server.update_queue.empty()
+    serve(test)
+def test_no_secret_rejects_everything():
+    async def test(app, server):
+        for secret in ("", None, "anything"):
+            status, _, _ = await post(server.port, START_UPDATE, secret)
+            assert status == 403
+        assert server.update_queue.empty()
+    serve(test, secret="")
+def test_webhook_mode_refuses_to_start_without_a_secret(monkeypatch):
+    monkeypatch.setattr(bot, "WEBHOOK_URL", "")
+    monkeypatch.setattr(bot, "WEBHOOK_SECRET", "")
+    with pytest.raises(SystemExit):
+        asyncio.run(bot.run_webhook(None))
+def test_full_queue_asks_for_a_retry():
+    async def test(app, server):
+        status, _, _ = await post(server.port, START_UPDATE)
+        assert status == 200
+        status, headers, _ = await post(server.port, dict(START_UPDATE, update_id=713))
+        assert status == 503
+        assert headers["Retry-After"] == "1"
+        assert server.rejected == 1 and server.update_queue.qsize() == 1
+    serve(test, queue_size=1)
+def test_update_is_dispatched():
+    async def test(app, server):
+        seen = []
+        async def on_start(update, context):
+            seen.append((update.update_id, update.effective_user.id, update.message.text))
+        app.add_handler(CommandHandler("start", on_start))
+        status, _, body = await post(server.port, START_UPDATE)
+        assert (status, body) == (200, b"ok")
+        await app.process_update(server.update_queue.get_nowait())
+        assert seen == [(712, 1001, "/start")]
+    serve(test)
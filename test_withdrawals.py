@@ -0,0 +1,70 @@
+import asyncio
+import threading
+import types
+import bot
+UID = 1001
+def withdraw_update(amount, replies):
+    async def reply_text(text, **kwargs):
+        replies.append(text)
+    return types.SimpleNamespace(
+        effective_user=types.SimpleNamespace(id=UID),
+        message=types.SimpleNamespace(text=str(amount), reply_text=reply_text),
+    )
+def withdraw_context():
+    return types.SimpleNamespace(user_data={"withdraw_method": "binance", "withdraw_address": "addr"})
+def test_concurrent_requests_cannot_overdraw(open_store, monkeypatch):
+    store = open_store()
+    store.create_user(UID, bot.now())
+    store.credit(UID, 10.0)
+    monkeypatch.setattr(bot, "store", store)
+    # Side effects of an accepted request stay out of the module's singletons
+    monkeypatch.setattr(bot, "outbox", bot.Outbox(store, 1))
+    monkeypatch.setattr(bot, "channel_digest", bot.ChannelDigest(store, bot.outbox, 0, 1))
+    monkeypatch.setattr(bot, "sweeper", bot.ExpirySweeper(store))
+    replies = []
+    async def run():
+        await asyncio.gather(*(bot.withdraw_get_amount(withdraw_update(3, replies), withdraw_context()) for _ in range(10)))
+    asyncio.run(run())
+    assert sum(reply.startswith("✅ Withdrawal request") for reply in replies) == 3
+    assert sum(reply.startswith("⚠️ Insufficient balance") for reply in replies) == 7
+    assert store.get_user(UID).balance == 1.0
+    assert sorted(wd.amount for wd in store.pending_withdrawals(UID).values()) == [3.0, 3.0, 3.0]
+def test_concurrent_connections_cannot_overdraw(tmp_path):
+    # Several SQLite connections (processes) reserving from the same balance at once
+    path = tmp_path / "data.sqlite3"
+    store = bot.SqliteStore(path, False)
+    store.create_user(UID, bot.now())
+    store.credit(UID, 10.0)
+    opened = []
+    def worker():
+        conn = bot.SqliteStore(path, False)
+        for _ in range(3):
+            wid = conn.open_withdrawal(UID, "binance", "addr", 1.5, bot.now())
+            if wid is not None:
+                opened.append(wid)
+        conn.conn.close()
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(opened) == 6
+    assert store.get_user(UID).balance == 1.0
+    assert len(store.pending_withdrawals(UID)) == 6
+def test_reject_refunds_exactly_once(open_store):
+    store = open_store()
+    store.create_user(UID, bot.now())
+    store.credit(UID, 10.0)
+    approved = store.open_withdrawal(UID, "binance", "addr", 2.5, bot.now())
+    rejected = store.open_withdrawal(UID, "binance", "addr", 4.0, bot.now())
+    assert store.open_withdrawal(UID, "binance", "addr", 4.0, bot.now()) is None
+    assert store.get_user(UID).balance == 3.5
+    store.close_withdrawal(approved, bot.WithdrawalStatus.APPROVED, bot.now())
+    store.close_withdrawal(rejected, bot.WithdrawalStatus.REJECTED, bot.now())
+    store.close_withdrawal(rejected, bot.WithdrawalStatus.REJECTED, bot.now()) # A second press of the button
+    assert store.get_user(UID).balance == 7.5
+    assert store.pending_withdrawals() == {}
+    restarted = open_store()
+    assert restarted.get_user(UID).balance == 7.5
+    assert restarted.get_withdrawal(rejected).status == bot.WithdrawalStatus.REJECTED
+    assert restarted.get_withdrawal(approved).status == bot.WithdrawalStatus.APPROVED